@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Message
+from .models import Message, Conversation, UnreadCounter
 
 # Register your models here.
 admin.site.register(Message)
+admin.site.register(Conversation)
+admin.site.register(UnreadCounter)
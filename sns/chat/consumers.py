@@ -0,0 +1,170 @@
+import json
+import logging
+import uuid
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from sns.broadcast import BroadcastBatchMixin
+from django.contrib.auth import get_user_model
+from .models import Message
+from .services import get_direct_message_group_name, mark_conversation_as_read
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+
+class DirectMessageConsumer(BroadcastBatchMixin, AsyncWebsocketConsumer):
+    """ダイレクトメッセージ用のWebSocketコンシューマー（ユーザーごとのグループに配信）"""
+
+    async def connect(self):
+        """WebSocket接続時の処理"""
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.user_group_name = get_direct_message_group_name(self.user.id)
+
+        await self.channel_layer.group_add(
+            self.user_group_name,
+            self.channel_name
+        )
+
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        """WebSocket切断時の処理"""
+        # 属性が存在しない場合（認証失敗等）は何もしない
+        if not hasattr(self, 'user_group_name'):
+            return
+
+        await self.channel_layer.group_discard(
+            self.user_group_name,
+            self.channel_name
+        )
+
+    async def receive(self, text_data):
+        """WebSocketからメッセージを受信した時の処理"""
+        try:
+            text_data_json = json.loads(text_data)
+            message_type = text_data_json.get('type', 'direct_message')
+            partner_id = self.parse_user_id(text_data_json.get('receiver_id'))
+
+            if partner_id is None or partner_id == self.user.id:
+                await self.send_error('Invalid receiver_id')
+                return
+
+            if message_type == 'direct_message':
+                await self.handle_direct_message(partner_id, text_data_json)
+            elif message_type in ('typing', 'stop_typing'):
+                await self.handle_typing(partner_id, message_type)
+            elif message_type == 'read':
+                await self.handle_read(partner_id)
+            else:
+                # 未知のメッセージタイプ
+                await self.send_error(f'Unknown message type: {message_type}')
+
+        except json.JSONDecodeError:
+            await self.send_error('Invalid JSON format')
+        except Exception as e:
+            await self.send_error(f'Server error: {str(e)}')
+
+    async def handle_direct_message(self, partner_id, data):
+        """メッセージの処理"""
+        message_content = data.get('message', '').strip()
+
+        if not message_content:
+            await self.send_error('Message content cannot be empty')
+            return
+
+        # メッセージをデータベースに保存（シグナルでWebSocket送信される）
+        try:
+            message = await self.save_message(partner_id, message_content)
+        except Exception:
+            logger.exception('ダイレクトメッセージの保存に失敗しました')
+            await self.send_error('Failed to save message')
+            return
+        if message is None:
+            await self.send_error('Receiver not found')
+
+    async def handle_typing(self, partner_id, message_type):
+        """タイピング中・停止の処理（相手のグループにだけ送る）"""
+        await self.channel_layer.group_send(
+            get_direct_message_group_name(partner_id),
+            {
+                'type': 'user_typing' if message_type == 'typing' else 'user_stop_typing',
+                'user_id': str(self.user.id),
+                'username': self.user.username,
+            }
+        )
+
+    async def handle_read(self, partner_id):
+        """相手から届いたメッセージをまとめて既読にする（既読通知はコミット後に送信キューから送る）"""
+        await self.mark_conversation_as_read(partner_id)
+
+    async def send_error(self, message):
+        await self.send(text_data=json.dumps({
+            'type': 'error',
+            'message': message
+        }))
+
+    @staticmethod
+    def parse_user_id(value):
+        try:
+            return uuid.UUID(str(value))
+        except ValueError:
+            return None
+
+    # グループメッセージハンドラー
+    async def direct_message(self, event):
+        """メッセージをWebSocketに送信"""
+        await self.send(text_data=json.dumps({
+            'type': 'direct_message',
+            'message_id': event['message_id'],
+            'message': event['message'],
+            'sender_id': event['sender_id'],
+            'receiver_id': event['receiver_id'],
+            'timestamp': event['timestamp'],
+        }))
+
+    async def user_typing(self, event):
+        """タイピング中通知をWebSocketに送信"""
+        await self.send(text_data=json.dumps({
+            'type': 'user_typing',
+            'user_id': event['user_id'],
+            'username': event['username'],
+        }))
+
+    async def user_stop_typing(self, event):
+        """タイピング停止通知をWebSocketに送信"""
+        await self.send(text_data=json.dumps({
+            'type': 'user_stop_typing',
+            'user_id': event['user_id'],
+            'username': event['username'],
+        }))
+
+    async def read_receipt(self, event):
+        """既読通知をWebSocketに送信"""
+        await self.send(text_data=json.dumps({
+            'type': 'read_receipt',
+            'reader_id': event['reader_id'],
+            'read_at': event['read_at'],
+            'read_count': event['read_count'],
+        }))
+
+    # データベース操作（非同期化）
+    @database_sync_to_async
+    def save_message(self, partner_id, content):
+        """メッセージをデータベースに保存（相手が存在しない場合はNone）"""
+        try:
+            receiver = User.objects.get(id=partner_id)
+        except User.DoesNotExist:
+            return None
+        return Message.objects.create(sender=self.user, receiver=receiver, content=content)
+
+    @database_sync_to_async
+    def mark_conversation_as_read(self, partner_id):
+        try:
+            partner = User.objects.get(id=partner_id)
+        except User.DoesNotExist:
+            return 0, None
+        return mark_conversation_as_read(self.user, partner)
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from chat.consumers import DirectMessageConsumer
+from chat.services import get_direct_message_group_name
+
+User = get_user_model()
+
+
+def with_user(application, user):
+    """スコープにユーザーを設定するだけのASGIラッパー（認証ミドルウェアを通さない）"""
+    async def app(scope, receive, send):
+        return await application(dict(scope, user=user), receive, send)
+    return app
+
+
+class Command(BaseCommand):
+    help = 'DirectMessageConsumerに多数のソケットを接続し、メッセージ配信のレイテンシを計測する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=1000)
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--timeout', type=float, default=10.0)
+
+    def handle(self, *args, **options):
+        latencies = asyncio.run(self.run(options['sockets'], options['messages'], options['timeout']))
+        if not latencies:
+            self.stdout.write(self.style.ERROR('メッセージを受信できませんでした'))
+            return
+
+        latencies.sort()
+        p99_index = min(len(latencies) - 1, int(len(latencies) * 0.99))
+        self.stdout.write(
+            f"sockets={options['sockets']} delivered={len(latencies)}/{options['messages']} "
+            f"p50={statistics.median(latencies):.2f}ms p99={latencies[p99_index]:.2f}ms max={latencies[-1]:.2f}ms"
+        )
+
+    async def run(self, socket_count, message_count, timeout):
+        # 接続処理はDBに触れないので保存していないユーザーで十分
+        users = [User(id=uuid.uuid4(), username=f'loadtest_{i}') for i in range(socket_count)]
+        application = DirectMessageConsumer.as_asgi()
+        communicators = []
+        for user in users:
+            communicator = WebsocketCommunicator(with_user(application, user), '/ws/chat/')
+            connected, _ = await communicator.connect()
+            if connected:
+                communicators.append((user, communicator))
+
+        channel_layer = get_channel_layer()
+        sent_at = {}
+        latencies = []
+        delivered = asyncio.Event()
+
+        async def receive_all(communicator):
+            while True:
+                data = json.loads(await communicator.receive_from(timeout=None))
+                started = sent_at.pop(data.get('message_id'), None)
+                if started is not None:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    if len(latencies) >= message_count:
+                        delivered.set()
+
+        receivers = [asyncio.create_task(receive_all(communicator)) for _, communicator in communicators]
+
+        for _ in range(message_count):
+            (sender, _), (receiver, _) = random.sample(communicators, 2)
+            message_id = str(uuid.uuid4())
+            sent_at[message_id] = time.perf_counter()
+            await channel_layer.group_send(
+                get_direct_message_group_name(receiver.id),
+                {
+                    'type': 'direct_message',
+                    'message_id': message_id,
+                    'message': 'loadtest',
+                    'sender_id': str(sender.id),
+                    'receiver_id': str(receiver.id),
+                    'timestamp': '',
+                }
+            )
+            # 送信側のイベントループを他のタスクに譲る
+            await asyncio.sleep(0)
+
+        try:
+            await asyncio.wait_for(delivered.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        for task in receivers:
+            task.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        for _, communicator in communicators:
+            await communicator.disconnect()
+        return latencies
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Message, Conversation
+
+
+class Command(BaseCommand):
+    help = 'メッセージテーブルから会話一覧（Conversation）を再構築する'
+
+    def handle(self, *args, **options):
+        pairs = set()
+        for sender_id, receiver_id in Message.objects.filter(
+            sender__isnull=False, receiver__isnull=False
+        ).values_list('sender_id', 'receiver_id').distinct():
+            pairs.add(frozenset((sender_id, receiver_id)))
+
+        for pair in pairs:
+            user1_id, user2_id = tuple(pair)
+            Conversation.objects.rebuild_pair(user1_id, user2_id)
+
+        self.stdout.write(self.style.SUCCESS(f'{len(pairs)}件の会話を再構築しました'))
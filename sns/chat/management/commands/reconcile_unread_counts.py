@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import UnreadCounter
+
+
+class Command(BaseCommand):
+    help = '未読メッセージ数のカウンターをメッセージテーブルと照合して修正する'
+
+    def handle(self, *args, **options):
+        repaired = UnreadCounter.objects.reconcile()
+        self.stdout.write(self.style.SUCCESS(f'{repaired}件のカウンターを修正しました'))
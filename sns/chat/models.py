@@ -2,8 +2,12 @@ from django.db import models
 import uuid
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.db.models import Q, F, Count
+from django.db.models.functions import Greatest
+from django.core.cache import cache
 from django.utils import timezone
+
 class MessageManager(models.Manager):
     def get_from_sender(self, sender_id):
         return self.filter(sender_id=sender_id)
@@ -22,9 +26,24 @@ class MessageManager(models.Manager):
         return messages
     
     def get_unread_count(self, user):
-        """指定ユーザーの未読メッセージ数を取得"""
+        """指定ユーザーの未読メッセージ数を取得（集計済みのカウンターを参照）"""
+        return UnreadCounter.objects.get_count(user.id)
+
+    def count_unread(self, user):
+        """未読メッセージ数をメッセージテーブルから数え直す"""
         return self.filter(receiver=user, is_read=False, is_deleted=False).count()
     
+    def mark_conversation_as_read(self, user, partner, until=None):
+        """partnerから届いたuntilまでの未読メッセージを1回のUPDATEで既読にする"""
+        read_at = timezone.now()
+        messages = self.filter(sender=partner, receiver=user, is_read=False, is_deleted=False)
+        if until is not None:
+            messages = messages.filter(created_at__lte=until)
+
+        read_count = messages.update(is_read=True, read_at=read_at, updated_at=read_at)
+        Conversation.objects.record_read(user.id, partner.id, read_count)
+        return read_count, read_at
+
     def get_latest_message_between_users(self, user1, user2):
         """2人のユーザー間の最新メッセージを取得"""
         return self.filter(
@@ -85,9 +104,16 @@ class Message(models.Model):
     def mark_as_read(self):
         """メッセージを既読にする"""
         if not self.is_read:
+            read_at = timezone.now()
+            # 既読フラグの更新は条件付きUPDATEにして二重にカウントを減らさない
+            updated = Message.objects.filter(pk=self.pk, is_read=False).update(
+                is_read=True, read_at=read_at, updated_at=read_at
+            )
             self.is_read = True
-            self.read_at = timezone.now()
-            self.save()
+            self.read_at = read_at
+            self.updated_at = read_at
+            if updated and not self.is_deleted:
+                Conversation.objects.record_read(self.receiver_id, self.sender_id, updated)
 
     def clean(self):
         if self.sender == self.receiver:
@@ -98,4 +124,194 @@ class Message(models.Model):
         super(Message, self).save(*args, **kwargs)
 
     def __str__(self):
-        return self.content
\ No newline at end of file
+        return self.content
+
+class ConversationManager(models.Manager):
+    def get_summaries(self, user):
+        """会話相手・最新メッセージ・未読数を1クエリで取得"""
+        return self.filter(user=user, last_message_at__isnull=False).order_by('-last_message_at').values(
+            'partner_id',
+            'partner__username',
+            'partner__profile__display_name',
+            'last_message__content',
+            'last_message_at',
+            'unread_count',
+        )
+
+    def record_message(self, message):
+        """新規メッセージを送信者・受信者それぞれの会話に反映"""
+        if message.sender_id is None or message.receiver_id is None or message.is_deleted:
+            return
+
+        self._apply(message.sender_id, message.receiver_id, message, unread_delta=0)
+        self._apply(message.receiver_id, message.sender_id, message, unread_delta=0 if message.is_read else 1)
+        if not message.is_read:
+            UnreadCounter.objects.adjust(message.receiver_id, 1)
+
+    def record_read(self, user_id, partner_id, count):
+        """既読になった件数だけ未読数を減らす"""
+        if user_id is None or partner_id is None or count <= 0:
+            return
+        self.filter(user_id=user_id, partner_id=partner_id).update(
+            unread_count=Greatest(F('unread_count') - count, 0)
+        )
+        UnreadCounter.objects.adjust(user_id, -count)
+
+    def _apply(self, user_id, partner_id, message, unread_delta):
+        fields = {
+            'last_message': message,
+            'last_message_at': message.created_at,
+            'unread_count': F('unread_count') + unread_delta,
+        }
+        if self.filter(user_id=user_id, partner_id=partner_id).update(**fields):
+            return
+        try:
+            with transaction.atomic():
+                self.create(
+                    user_id=user_id,
+                    partner_id=partner_id,
+                    last_message=message,
+                    last_message_at=message.created_at,
+                    unread_count=unread_delta,
+                )
+        except IntegrityError:
+            # 同時に作成された場合は更新し直す
+            self.filter(user_id=user_id, partner_id=partner_id).update(**fields)
+
+    def rebuild(self, user_id, partner_id):
+        """メッセージテーブルから1方向の会話を再計算"""
+        latest = Message.objects.filter(
+            Q(sender_id=user_id, receiver_id=partner_id) | Q(sender_id=partner_id, receiver_id=user_id),
+            is_deleted=False,
+        ).order_by('-created_at').first()
+
+        previous = self.filter(user_id=user_id, partner_id=partner_id).values_list('unread_count', flat=True).first() or 0
+
+        if latest is None:
+            self.filter(user_id=user_id, partner_id=partner_id).delete()
+            UnreadCounter.objects.adjust(user_id, -previous)
+            return None
+
+        unread_count = Message.objects.filter(
+            sender_id=partner_id, receiver_id=user_id, is_read=False, is_deleted=False
+        ).count()
+        UnreadCounter.objects.adjust(user_id, unread_count - previous)
+
+        conversation, _ = self.update_or_create(
+            user_id=user_id,
+            partner_id=partner_id,
+            defaults={
+                'last_message': latest,
+                'last_message_at': latest.created_at,
+                'unread_count': unread_count,
+            },
+        )
+        return conversation
+
+    def rebuild_pair(self, user1_id, user2_id):
+        if user1_id is None or user2_id is None:
+            return
+        self.rebuild(user1_id, user2_id)
+        self.rebuild(user2_id, user1_id)
+
+
+class Conversation(models.Model):
+    """ユーザーごとの会話一覧（Messageから非正規化して保持）"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='conversations')
+    partner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ConversationManager()
+
+    class Meta:
+        unique_together = ('user', 'partner')
+        indexes = [
+            models.Index(fields=['user', '-last_message_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.partner}"
+
+
+class UnreadCounterManager(models.Manager):
+    @staticmethod
+    def cache_key(user_id):
+        return f'chat:unread_count:{user_id}'
+
+    def get_count(self, user_id):
+        """未読メッセージ数をO(1)で取得（共有キャッシュ → カウンター行の順に参照）"""
+        timeout = settings.CHAT_UNREAD_COUNT_CACHE_TIMEOUT
+        key = self.cache_key(user_id) if timeout else None
+        count = cache.get(key) if key else None
+        if count is None:
+            count = self.filter(user_id=user_id).values_list('count', flat=True).first() or 0
+            if key:
+                cache.set(key, count, timeout)
+        return count
+
+    def invalidate(self, user_id):
+        """未読数のキャッシュを消す（トランザクション中に古い値が再キャッシュされた場合に備えてコミット後にも消す）"""
+        if not settings.CHAT_UNREAD_COUNT_CACHE_TIMEOUT:
+            return
+        key = self.cache_key(user_id)
+        cache.delete(key)
+        transaction.on_commit(lambda: cache.delete(key))
+
+    def adjust(self, user_id, delta):
+        """未読数を差分で更新"""
+        if user_id is None or delta == 0:
+            return
+        if not self.filter(user_id=user_id).update(count=Greatest(F('count') + delta, 0)):
+            try:
+                with transaction.atomic():
+                    self.create(user_id=user_id, count=max(delta, 0))
+            except IntegrityError:
+                self.filter(user_id=user_id).update(count=Greatest(F('count') + delta, 0))
+        self.invalidate(user_id)
+
+    def reconcile(self):
+        """メッセージテーブルから未読数を数え直してずれを修正し、修正件数を返す"""
+        pair_counts = {
+            (row['receiver_id'], row['sender_id']): row['total']
+            for row in Message.objects.filter(
+                is_read=False, is_deleted=False, sender__isnull=False, receiver__isnull=False
+            ).values('receiver_id', 'sender_id').annotate(total=Count('id'))
+        }
+
+        repaired = 0
+        for conversation in Conversation.objects.only('id', 'user_id', 'partner_id', 'unread_count'):
+            expected = pair_counts.get((conversation.user_id, conversation.partner_id), 0)
+            if conversation.unread_count != expected:
+                Conversation.objects.filter(id=conversation.id).update(unread_count=expected)
+                repaired += 1
+
+        totals = {}
+        for (receiver_id, _), total in pair_counts.items():
+            totals[receiver_id] = totals.get(receiver_id, 0) + total
+
+        existing = dict(self.values_list('user_id', 'count'))
+        for user_id in set(existing) | set(totals):
+            expected = totals.get(user_id, 0)
+            if existing.get(user_id) == expected:
+                continue
+            self.update_or_create(user_id=user_id, defaults={'count': expected})
+            self.invalidate(user_id)
+            repaired += 1
+
+        return repaired
+
+
+class UnreadCounter(models.Model):
+    """ユーザーごとの未読メッセージ数（/chat/unread-count用に集計済みの値を保持）"""
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='unread_counter')
+    count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UnreadCounterManager()
+
+    def __str__(self):
+        return f"{self.user} - {self.count}"
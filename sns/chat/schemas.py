@@ -43,5 +43,11 @@ class MessageReadOutputSchema(Schema):
     success: bool
     read_at: datetime
 
+class ConversationReadOutputSchema(Schema):
+    success: bool
+    read_count: int
+    read_at: datetime
+    unread_count: int
+
 class UsersHaveHistoryWithUserOutputSchema(Schema):
     users: list[uuid.UUID]
\ No newline at end of file
@@ -0,0 +1,47 @@
+from sns.broadcast import broadcast_on_commit
+
+
+def get_direct_message_group_name(user_id):
+    """ユーザーごとのDM用WebSocketグループ名"""
+    return f'direct_messages_{user_id}'
+
+
+def send_read_receipt(reader, partner_id, read_at, read_count):
+    """既読になったことを送信者側のWebSocketグループに通知"""
+    broadcast_on_commit(
+        get_direct_message_group_name(partner_id),
+        {
+            'type': 'read_receipt',
+            'reader_id': str(reader.id),
+            'read_at': read_at.isoformat(),
+            'read_count': read_count,
+        }
+    )
+
+
+def mark_conversation_as_read(user, partner, until=None):
+    """partnerから届いたメッセージをuntilまで既読にし、既読になった分をpartnerに通知"""
+    from .models import Message
+
+    read_count, read_at = Message.objects.mark_conversation_as_read(user, partner, until)
+    if read_count:
+        send_read_receipt(user, partner.id, read_at, read_count)
+    return read_count, read_at
+
+
+def send_direct_message(message):
+    """新しいメッセージを送信者・受信者のWebSocketグループに配信"""
+    if message.sender_id is None or message.receiver_id is None:
+        return
+
+    event = {
+        'type': 'direct_message',
+        'message_id': str(message.id),
+        'message': message.content,
+        'sender_id': str(message.sender_id),
+        'receiver_id': str(message.receiver_id),
+        'timestamp': message.created_at.isoformat(),
+    }
+    # 送信者の別タブ・別端末にも反映させる
+    for user_id in (message.receiver_id, message.sender_id):
+        broadcast_on_commit(get_direct_message_group_name(user_id), event)
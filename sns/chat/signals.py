@@ -0,0 +1,15 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from .models import Message, Conversation
+from .services import send_direct_message
+
+
+@receiver(post_save, sender=Message)
+def update_conversation_on_message_save(sender, instance, created, **kwargs):
+    """メッセージ保存時に会話一覧を更新"""
+    if created:
+        Conversation.objects.record_message(instance)
+        send_direct_message(instance)
+    else:
+        # 既読・削除・復元などは該当ペアだけ再計算する
+        Conversation.objects.rebuild_pair(instance.sender_id, instance.receiver_id)
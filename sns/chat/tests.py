@@ -1,3 +1,146 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest.mock import patch
+from urllib.parse import urlencode
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from ninja_jwt.tokens import AccessToken
+
+from users.models import User
+from .models import Message, Conversation, UnreadCounter
+from .services import get_direct_message_group_name
+
+
+class ConversationListQueryCountTests(TestCase):
+    """会話一覧のクエリ数が会話相手の数に比例しないことを確認"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('me', 'password')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def create_conversations(self, count):
+        for i in range(count):
+            partner = User.objects.create_user(f'partner{User.objects.count()}', 'password')
+            Message.objects.create(sender=self.user, receiver=partner, content='hello')
+            Message.objects.create(sender=partner, receiver=self.user, content=f'reply {i}')
+
+    def test_conversation_list_query_count_is_constant(self):
+        self.create_conversations(1)
+        # JWTAuthのユーザー取得 + 会話一覧
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/chat/conversations', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+
+        self.create_conversations(10)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/chat/conversations', **self.auth)
+        conversations = response.json()
+        self.assertEqual(len(conversations), 11)
+        for conversation in conversations:
+            self.assertEqual(conversation['unread_count'], 1)
+            self.assertTrue(conversation['last_message'].startswith('reply'))
+
+
+class UnreadCounterTests(TestCase):
+    """未読数のカウンターの増減と照合"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('me', 'password')
+        self.partner = User.objects.create_user('partner', 'password')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def test_counter_follows_create_and_read(self):
+        messages = [Message.objects.create(sender=self.partner, receiver=self.user, content=str(i)) for i in range(3)]
+        Message.objects.create(sender=self.user, receiver=self.partner, content='sent')
+        self.assertEqual(Message.objects.get_unread_count(self.user), 3)
+        self.assertEqual(Message.objects.get_unread_count(self.partner), 1)
+
+        messages[0].mark_as_read()
+        # 2回目は既読済みなので減らさない
+        messages[0].mark_as_read()
+        self.assertEqual(Message.objects.get_unread_count(self.user), 2)
+
+    @override_settings(CHAT_UNREAD_COUNT_CACHE_TIMEOUT=300)
+    def test_unread_count_does_not_count_messages(self):
+        for i in range(5):
+            Message.objects.create(sender=self.partner, receiver=self.user, content=str(i))
+        self.client.get('/api/chat/unread-count', **self.auth)
+        # JWTAuthのユーザー取得だけ（未読数はキャッシュから）
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/chat/unread-count', **self.auth)
+        self.assertEqual(response.json(), {'unread_count': 5})
+
+    @override_settings(CHAT_UNREAD_COUNT_CACHE_TIMEOUT=0)
+    def test_process_local_cache_is_not_used(self):
+        Message.objects.create(sender=self.partner, receiver=self.user, content='hi')
+        self.assertEqual(Message.objects.get_unread_count(self.user), 1)
+        # 別のワーカーでの既読化を想定（このプロセスのキャッシュは消されない）
+        UnreadCounter.objects.filter(user=self.user).update(count=0)
+        self.assertEqual(Message.objects.get_unread_count(self.user), 0)
+
+    def test_reconcile_repairs_drift(self):
+        for i in range(4):
+            Message.objects.create(sender=self.partner, receiver=self.user, content=str(i))
+        UnreadCounter.objects.filter(user=self.user).update(count=40)
+        Conversation.objects.filter(user=self.user).update(unread_count=0)
+        # シグナルを通らない既読化でもずれる
+        oldest = Message.objects.filter(receiver=self.user).order_by('created_at').first()
+        Message.objects.filter(id=oldest.id).update(is_read=True)
+
+        self.assertEqual(UnreadCounter.objects.reconcile(), 2)
+        self.assertEqual(Message.objects.get_unread_count(self.user), 3)
+        self.assertEqual(Conversation.objects.get(user=self.user).unread_count, 3)
+        self.assertEqual(UnreadCounter.objects.reconcile(), 0)
+
+
+class MarkConversationAsReadTests(TestCase):
+    """会話単位の一括既読"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('me', 'password')
+        self.partner = User.objects.create_user('partner', 'password')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def read(self, **params):
+        with patch('sns.broadcast.broadcast_queue.enqueue') as enqueue:
+            with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    f'/api/chat/conversations/{self.partner.id}/read?{urlencode(params)}', **self.auth
+                )
+        return response, len(queries), enqueue
+
+    def test_query_count_does_not_depend_on_unread_messages(self):
+        for i in range(3):
+            Message.objects.create(sender=self.partner, receiver=self.user, content=str(i))
+        response, few, _ = self.read()
+        self.assertEqual(response.json()['read_count'], 3)
+
+        for i in range(30):
+            Message.objects.create(sender=self.partner, receiver=self.user, content=str(i))
+        response, many, enqueue = self.read()
+        self.assertEqual(response.json()['read_count'], 30)
+        self.assertEqual(response.json()['unread_count'], 0)
+        self.assertEqual(few, many)
+
+        # 送信者のグループに既読通知を1回送る
+        enqueue.assert_called_once()
+        group, event = enqueue.call_args.args
+        self.assertEqual(group, get_direct_message_group_name(self.partner.id))
+        self.assertEqual(event['type'], 'read_receipt')
+        self.assertEqual(event['read_count'], 30)
+
+    def test_until_watermark(self):
+        messages = [Message.objects.create(sender=self.partner, receiver=self.user, content=str(i)) for i in range(4)]
+        created_at = timezone.now() - timedelta(minutes=10)
+        Message.objects.filter(id__in=[message.id for message in messages[:2]]).update(created_at=created_at)
+
+        response, _, _ = self.read(until=(created_at + timedelta(seconds=1)).isoformat())
+        self.assertEqual(response.json()['read_count'], 2)
+        self.assertEqual(response.json()['unread_count'], 2)
+        self.assertEqual(self.read()[0].json()['read_count'], 2)
+        # 既読にするものが無ければ通知しない
+        _, _, enqueue = self.read()
+        enqueue.assert_not_called()
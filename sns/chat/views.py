@@ -1,10 +1,10 @@
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth import get_user_model
-from django.db.models import Q, Max, Count
 from ninja import Router
 from ninja_jwt.authentication import JWTAuth
 import uuid
-from .models import Message
+from .models import Message, Conversation
+from .services import mark_conversation_as_read as mark_read_and_notify
 from .schemas import (
     MessageSchema, 
     MessageListInputSchema, 
@@ -13,6 +13,7 @@ from .schemas import (
     MessageCreateOutputSchema,
     MessageReadInputSchema,
     MessageReadOutputSchema,
+    ConversationReadOutputSchema,
     WhoSentMessage,
     UsersHaveHistoryWithUserOutputSchema,
 )
@@ -123,50 +124,54 @@ def mark_message_as_read(request, message_id: str):
         from ninja.errors import HttpError
         raise HttpError(400, f"メッセージの既読処理に失敗しました: {str(e)}")
 
+@router.post('/conversations/{user_id}/read', response=ConversationReadOutputSchema, auth=JWTAuth())
+def mark_conversation_as_read(request, user_id: uuid.UUID, until: str = None):
+    """特定ユーザーから届いたメッセージをuntilまでまとめて既読にする"""
+    from ninja.errors import HttpError
+    partner = get_object_or_404(User, id=user_id)
+    current_user = request.user
+
+    until_datetime = None
+    if until:
+        from datetime import datetime
+        from django.utils import timezone
+        try:
+            until_datetime = datetime.fromisoformat(until.replace('Z', '+00:00'))
+        except ValueError:
+            raise HttpError(400, "untilパラメータの形式が正しくありません")
+        if until_datetime.tzinfo is None:
+            until_datetime = timezone.make_aware(until_datetime)
+
+    try:
+        read_count, read_at = mark_read_and_notify(current_user, partner, until_datetime)
+    except Exception as e:
+        raise HttpError(400, f"メッセージの既読処理に失敗しました: {str(e)}")
+
+    return ConversationReadOutputSchema(
+        success=True,
+        read_count=read_count,
+        read_at=read_at,
+        unread_count=Message.objects.get_unread_count(current_user),
+    )
+
 @router.get('/conversations', auth=JWTAuth())
 def get_conversations(request):
     """会話相手一覧を取得（最新メッセージ付き）"""
     try:
-        current_user = request.user
-        
-        # 自分が送信または受信したメッセージがあるユーザーを取得
-        sent_to_users = Message.objects.filter(
-            sender=current_user, is_deleted=False
-        ).values_list('receiver', flat=True).distinct()
-        
-        received_from_users = Message.objects.filter(
-            receiver=current_user, is_deleted=False
-        ).values_list('sender', flat=True).distinct()
-        
-        # 重複を除いてユーザーIDのセットを作成
-        user_ids = set(sent_to_users) | set(received_from_users)
-        user_ids.discard(None)  # null値を除外
-        
-        conversations = []
-        for user_id in user_ids:
-            try:
-                user = User.objects.get(id=user_id)
-                latest_message = Message.objects.get_latest_message_between_users(current_user, user)
-                unread_count = Message.objects.filter(
-                    sender=user, receiver=current_user, is_read=False, is_deleted=False
-                ).count()
-                
-                conversations.append({
-                    'user_id': user.id,
-                    'username': user.username,
-                    'display_name': getattr(user, 'display_name', user.username),
-                    'last_message': latest_message.content if latest_message else '',
-                    'last_message_time': latest_message.created_at if latest_message else None,
-                    'unread_count': unread_count
-                })
-            except User.DoesNotExist:
-                continue
-        
-        # 最新メッセージの時間順でソート
-        conversations.sort(key=lambda x: x['last_message_time'] or '', reverse=True)
-        
-        return conversations
-        
+        summaries = Conversation.objects.get_summaries(request.user)
+
+        return [
+            {
+                'user_id': summary['partner_id'],
+                'username': summary['partner__username'],
+                'display_name': summary['partner__profile__display_name'] or summary['partner__username'],
+                'last_message': summary['last_message__content'] or '',
+                'last_message_time': summary['last_message_at'],
+                'unread_count': summary['unread_count'],
+            }
+            for summary in summaries
+        ]
+
     except Exception as e:
         from ninja.errors import HttpError
         raise HttpError(400, f"会話一覧の取得に失敗しました: {str(e)}")
@@ -69,9 +69,20 @@ class TagAdmin(admin.ModelAdmin):
     search_fields = ('name',)
     readonly_fields = ('id', 'created_at', 'updated_at')
     
+    def get_changelist_instance(self, request):
+        """表示するページのタグのサークル数をまとめて取得（行ごとにCOUNTしない）"""
+        changelist = super().get_changelist_instance(request)
+        tags = list(changelist.result_list)
+        counts = Tag.objects.get_circle_counts([tag.pk for tag in tags])
+        for tag in tags:
+            tag.cached_circle_count = counts[tag.pk]
+        return changelist
+
     def circle_count(self, obj):
         """このタグを使用しているサークル数"""
-        return obj.circles.count()
+        if hasattr(obj, 'cached_circle_count'):
+            return obj.cached_circle_count
+        return Tag.objects.get_circle_counts([obj.pk])[obj.pk]
     circle_count.short_description = 'サークル数'
 
 @admin.register(Circle)
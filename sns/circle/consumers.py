@@ -1,9 +1,19 @@
+import asyncio
 import json
+import logging
+import uuid
 from functools import wraps
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from sns.broadcast import BroadcastBatchMixin
 from django.contrib.auth import get_user_model
 from .models import Circle, CircleMessage
+from .notifications import get_circle_notification_group_name, get_circle_chat_group_name
+from .presence import presence_registry, get_presence_store, HEARTBEAT_INTERVAL
+from .write_behind import get_write_behind
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
@@ -20,7 +30,7 @@ def authenticated_websocket(func):
 
 
 def circle_member_required(func):
-    """サークルメンバーシップチェックデコレータ"""
+    """サークルメンバーシップチェックデコレータ（結果はコンシューマーに保持し、メッセージごとには確認しない）"""
     @wraps(func)
     async def wrapper(self, *args, **kwargs):
         # 認証チェックも含む
@@ -36,18 +46,24 @@ def circle_member_required(func):
         if not is_member:
             await self.close()
             return
+
+        # 退会・BANされた時はmembership_revokedイベントで取り消される
+        self.circle_pk = uuid.UUID(str(circle_id))
+        self.is_circle_member = True
             
         return await func(self, *args, **kwargs)
     return wrapper
 
 
-class CircleChatConsumer(AsyncWebsocketConsumer):
+class CircleChatConsumer(BroadcastBatchMixin, AsyncWebsocketConsumer):
     """サークルチャット用のWebSocketコンシューマー"""
     
+    @circle_member_required
     async def connect(self):
         """WebSocket接続時の処理"""
-        self.circle_id = self.scope['url_route']['kwargs']['circle_id']
-        self.circle_group_name = f'circle_chat_{self.circle_id}'
+        # URLのサークルIDは大文字やハイフンなしでも受け付けるので、配信・退会の通知と同じ正規化した形を使う
+        self.circle_id = str(self.circle_pk)
+        self.circle_group_name = get_circle_chat_group_name(self.circle_pk)
         self.user = self.scope['user']
         
         # グループに参加
@@ -57,16 +73,28 @@ class CircleChatConsumer(AsyncWebsocketConsumer):
         )
         
         await self.accept()
-        
-        # 参加通知をグループに送信
-        await self.channel_layer.group_send(
+
+        # 参加通知は接続ごとに送らず、presenceとしてまとめて送信される
+        await presence_registry.join(
+            self.circle_id,
             self.circle_group_name,
-            {
-                'type': 'user_joined',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-            }
+            self.channel_layer,
+            self.user.id,
+            self.user.username,
         )
+        # 複数ワーカーで共有するオンライン状況に登録し、定期的に期限を延ばす
+        await self.update_presence()
+        self.presence_heartbeat_task = asyncio.create_task(self.presence_heartbeat())
+
+        # 接続したクライアントには現在のオンライン状況をすぐに送る
+        online = await sync_to_async(get_presence_store().get_online_members, thread_sensitive=False)(self.circle_id)
+        await self.send(text_data=json.dumps({
+            'type': 'presence',
+            'joined': [],
+            'left': [],
+            'online_count': len(online),
+            'online': online,
+        }))
     
     async def disconnect(self, close_code):
         """WebSocket切断時の処理"""
@@ -74,15 +102,12 @@ class CircleChatConsumer(AsyncWebsocketConsumer):
         if not hasattr(self, 'circle_group_name') or not hasattr(self, 'user'):
             return
             
-        # 退出通知をグループに送信
-        await self.channel_layer.group_send(
-            self.circle_group_name,
-            {
-                'type': 'user_left',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-            }
-        )
+        # 退出通知はpresenceとしてまとめて送信される
+        await presence_registry.leave(self.circle_id, self.user.id)
+
+        if hasattr(self, 'presence_heartbeat_task'):
+            self.presence_heartbeat_task.cancel()
+            await sync_to_async(get_presence_store().remove, thread_sensitive=False)(self.circle_id, self.channel_name)
         
         # グループから退出
         await self.channel_layer.group_discard(
@@ -110,6 +135,8 @@ class CircleChatConsumer(AsyncWebsocketConsumer):
                 await self.handle_typing(text_data_json)
             elif message_type == 'stop_typing':
                 await self.handle_stop_typing(text_data_json)
+            elif message_type == 'heartbeat':
+                await self.update_presence()
             else:
                 # 未知のメッセージタイプ
                 await self.send(text_data=json.dumps({
@@ -130,6 +157,13 @@ class CircleChatConsumer(AsyncWebsocketConsumer):
     
     async def handle_chat_message(self, data):
         """チャットメッセージの処理"""
+        if not self.is_circle_member:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': 'You are no longer a member of this circle'
+            }))
+            return
+
         message_content = data.get('message', '').strip()
         
         if not message_content:
@@ -139,30 +173,50 @@ class CircleChatConsumer(AsyncWebsocketConsumer):
             }))
             return
         
+        write_behind = get_write_behind()
+        if write_behind is not None:
+            # write-behind: ジャーナルに追記してすぐに配信し、DBにはまとめて保存される
+            message = await write_behind.submit(self.circle_pk, self.user, message_content)
+            await self.send(text_data=json.dumps({
+                'type': 'message_ack',
+                'message_id': str(message.id),
+                'client_message_id': data.get('client_message_id'),
+            }))
+            return
+
         # メッセージをデータベースに保存（シグナルでWebSocket送信される）
-        await self.save_message(message_content)
+        # メンバーであることは接続時に確認済みなので、ここではCircleの取得もメンバー確認もしない
+        try:
+            await self.save_message(message_content)
+        except Exception:
+            logger.exception('サークルチャットのメッセージの保存に失敗しました')
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': 'Failed to save message'
+            }))
     
     async def handle_typing(self, data):
-        """タイピング中の処理"""
-        await self.channel_layer.group_send(
-            self.circle_group_name,
-            {
-                'type': 'user_typing',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-            }
-        )
+        """タイピング中の処理（ユーザーごとに間引いて送信）"""
+        await presence_registry.typing(self.circle_id, self.user.id, self.user.username)
     
     async def handle_stop_typing(self, data):
-        """タイピング停止の処理"""
-        await self.channel_layer.group_send(
-            self.circle_group_name,
-            {
-                'type': 'user_stop_typing',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-            }
+        """タイピング停止の処理（少し待ってから送信）"""
+        await presence_registry.stop_typing(self.circle_id, self.user.id)
+    
+    async def update_presence(self):
+        """オンライン状況の期限を延ばす"""
+        await sync_to_async(get_presence_store().touch, thread_sensitive=False)(
+            self.circle_id, self.channel_name, self.user.id, self.user.username
         )
+
+    async def presence_heartbeat(self):
+        """接続している間、HEARTBEAT_INTERVAL秒ごとにオンライン状況を更新"""
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.update_presence()
+            except Exception:
+                logger.exception('オンライン状況の更新に失敗しました')
     
     # グループメッセージハンドラー
     async def chat_message(self, event):
@@ -196,6 +250,37 @@ class CircleChatConsumer(AsyncWebsocketConsumer):
                 'username': event['username'],
             }))
     
+    async def presence(self, event):
+        """まとめられた参加・退出とオンライン状況をWebSocketに送信"""
+        user_id = str(self.user.id)
+        payload = {
+            'type': 'presence',
+            # 自分の参加・退出は通知しない
+            'joined': [member for member in event['joined'] if member['user_id'] != user_id],
+            'left': [member for member in event['left'] if member['user_id'] != user_id],
+        }
+        if 'online' in event:
+            payload['online'] = event['online']
+            payload['online_count'] = event['online_count']
+        if payload['joined'] or payload['left'] or 'online' in payload:
+            await self.send(text_data=json.dumps(payload))
+    
+    async def membership_revoked(self, event):
+        """退会・BANでメンバーでなくなったユーザーの接続を閉じる"""
+        user_ids = event.get('user_ids')
+        if user_ids is None:
+            # 対象が分からない場合（メンバーの一括削除など）は確認し直す
+            self.is_circle_member = await self.check_circle_membership()
+        elif str(self.user.id) in user_ids:
+            self.is_circle_member = False
+
+        if not self.is_circle_member:
+            await self.send(text_data=json.dumps({
+                'type': 'membership_revoked',
+                'circle_id': str(self.circle_pk),
+            }))
+            await self.close(code=4403)
+    
     async def user_typing(self, event):
         """タイピング中通知をWebSocketに送信"""
         # 自分のタイピングは通知しない
@@ -219,36 +304,20 @@ class CircleChatConsumer(AsyncWebsocketConsumer):
     # データベース操作（非同期化）
     @database_sync_to_async
     def check_circle_membership(self, circle_id=None):
-        """サークルメンバーシップを確認"""
-        try:
-            # circle_idが指定されていない場合はインスタンス変数を使用
-            if circle_id is None:
-                circle_id = self.circle_id
-                
-            circle = Circle.objects.get(id=circle_id)
-            return circle.members.filter(id=self.scope['user'].id).exists()
-        except Circle.DoesNotExist:
-            return False
+        """サークルメンバーシップを確認（共有キャッシュが有効な間はSQLを発行しない）"""
+        # circle_idが指定されていない場合はインスタンス変数を使用
+        if circle_id is None:
+            circle_id = self.circle_id
+
+        return Circle.objects.is_member(self.scope['user'], circle_id)
     
     @database_sync_to_async
     def save_message(self, content):
-        """メッセージをデータベースに保存"""
-        try:
-            circle = Circle.objects.get(id=self.circle_id)
-            message = CircleMessage.objects.create(
-                circle=circle,
-                user=self.scope['user'],
-                content=content
-            )
-            return message
-        except Circle.DoesNotExist:
-            return None
-        except Exception as e:
-            print(f"Error saving message: {e}")
-            return None
+        """メッセージをデータベースに保存（接続時に確認したサークルのPKをそのまま使う）"""
+        return CircleMessage.objects.create_member_message(self.circle_pk, self.scope['user'], content)
 
 
-class CircleNotificationConsumer(AsyncWebsocketConsumer):
+class CircleNotificationConsumer(BroadcastBatchMixin, AsyncWebsocketConsumer):
     """サークル通知用のWebSocketコンシューマー"""
     
     @authenticated_websocket
@@ -258,11 +327,21 @@ class CircleNotificationConsumer(AsyncWebsocketConsumer):
         
         # ユーザー固有の通知グループに参加
         self.notification_group_name = f'user_notifications_{self.user.id}'
+        # サークル全体向けの通知グループ（メンバー変更など）
+        self.circle_notification_group_name = get_circle_notification_group_name(
+            self.scope['url_route']['kwargs']['circle_id']
+        )
         
         await self.channel_layer.group_add(
             self.notification_group_name,
             self.channel_name
         )
+        # サークル全体の通知はメンバーにだけ配信する
+        if await database_sync_to_async(Circle.objects.is_member)(self.user, self.scope['url_route']['kwargs']['circle_id']):
+            await self.channel_layer.group_add(
+                self.circle_notification_group_name,
+                self.channel_name
+            )
         
         await self.accept()
     
@@ -276,6 +355,10 @@ class CircleNotificationConsumer(AsyncWebsocketConsumer):
             self.notification_group_name,
             self.channel_name
         )
+        await self.channel_layer.group_discard(
+            self.circle_notification_group_name,
+            self.channel_name
+        )
     
     async def receive(self, text_data):
         """WebSocketからメッセージを受信した時の処理"""
@@ -0,0 +1,112 @@
+import asyncio
+import multiprocessing
+import queue
+import statistics
+import time
+
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.layers import channel_layers
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+GROUP_NAME = 'channel_layer_benchmark'
+
+
+def run_worker(index, expected, timeout, ready, results):
+    """別プロセスでグループに参加し、届いたメッセージのレイテンシを記録する"""
+    async def run():
+        layer = channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP_NAME, channel)
+        ready.put(index)
+
+        latencies = []
+        while len(latencies) < expected:
+            try:
+                message = await asyncio.wait_for(layer.receive(channel), timeout)
+            except asyncio.TimeoutError:
+                break
+            latencies.append((time.time() - message['sent_at']) * 1000)
+
+        await layer.group_discard(GROUP_NAME, channel)
+        results.put((index, latencies, time.time()))
+
+    asyncio.run(run())
+
+
+class Command(BaseCommand):
+    help = '複数プロセス間でチャネルレイヤーのグループ配信が届くかを確認し、スループットを計測する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--timeout', type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        message_count = options['messages']
+        timeout = options['timeout']
+        self.stdout.write(f"backend={settings.CHANNEL_LAYERS[DEFAULT_CHANNEL_LAYER]['BACKEND']}")
+
+        # ワーカーは起動済みのDjangoを引き継ぐためforkで作る
+        context = multiprocessing.get_context('fork')
+        ready = context.Queue()
+        results = context.Queue()
+        processes = [
+            context.Process(target=run_worker, args=(index, message_count, timeout, ready, results))
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+
+        try:
+            for _ in range(workers):
+                ready.get(timeout=timeout)
+        except queue.Empty:
+            self.terminate(processes)
+            raise CommandError('ワーカーの起動がタイムアウトしました')
+
+        started = time.time()
+        asyncio.run(self.send_messages(message_count))
+
+        collected = []
+        try:
+            for _ in range(workers):
+                collected.append(results.get(timeout=timeout * 2 + message_count * 0.01))
+        except queue.Empty:
+            self.terminate(processes)
+            raise CommandError('ワーカーの結果が返ってきませんでした')
+
+        for process in processes:
+            process.join()
+
+        latencies = sorted(latency for _, worker_latencies, _ in collected for latency in worker_latencies)
+        finished = max(finished_at for _, _, finished_at in collected)
+        for index, worker_latencies, _ in sorted(collected):
+            self.stdout.write(f'worker {index}: {len(worker_latencies)}/{message_count}件受信')
+
+        if not latencies:
+            raise CommandError('別プロセスにメッセージが届きませんでした（プロセス間で共有できるチャネルレイヤーを設定してください）')
+
+        p99_index = min(len(latencies) - 1, int(len(latencies) * 0.99))
+        self.stdout.write(
+            f'delivered={len(latencies)}/{message_count * workers} '
+            f'throughput={len(latencies) / (finished - started):.0f}msg/s '
+            f'p50={statistics.median(latencies):.2f}ms p99={latencies[p99_index]:.2f}ms'
+        )
+        if len(latencies) < message_count * workers:
+            raise CommandError('一部のメッセージが届きませんでした')
+
+    async def send_messages(self, message_count):
+        layer = channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)
+        for sequence in range(message_count):
+            await layer.group_send(GROUP_NAME, {
+                'type': 'benchmark.message',
+                'sequence': sequence,
+                'sent_at': time.time(),
+            })
+
+    def terminate(self, processes):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,138 @@
+import asyncio
+import os
+import signal
+import statistics
+import tempfile
+import time
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from circle.models import Circle, CircleMessage
+from circle.write_behind import MessageWriteBehind
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'サークルチャットの保存を、1件ずつINSERTする現在の方法とwrite-behindで比較する（--crash-testで復元も確認）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=200, help='同時に送信するソケット数')
+        parser.add_argument('--interval-ms', type=int, default=50)
+        parser.add_argument('--crash-test', action='store_true', help='保存前にプロセスを強制終了し、ジャーナルから復元できるか確認する')
+
+    def handle(self, *args, **options):
+        user, circle = self.seed()
+
+        if options['crash_test']:
+            self.crash_test(user, circle, options['messages'], options['interval_ms'])
+            return
+
+        current = asyncio.run(self.run_current(user, circle, options['messages'], options['concurrency']))
+        with tempfile.TemporaryDirectory() as journal_dir:
+            write_behind = asyncio.run(self.run_write_behind(
+                user, circle, options['messages'], options['concurrency'], journal_dir, options['interval_ms']
+            ))
+
+        self.stdout.write(f"{'':>13} {'msg/s':>10} {'ack p50':>10} {'ack p99':>10}")
+        for name, (elapsed, latencies) in (('current', current), ('write-behind', write_behind)):
+            self.stdout.write(
+                f"{name:>13} {options['messages'] / elapsed:>10.0f} "
+                f"{statistics.median(latencies):>8.2f}ms {self.p99(latencies):>8.2f}ms"
+            )
+
+    def seed(self):
+        user, _ = User.objects.get_or_create(username='benchmark_chat_user')
+        circle, _ = Circle.objects.get_or_create(
+            name='benchmark_chat_circle',
+            defaults={'founder': user, 'description': 'benchmark', 'is_public': True},
+        )
+        return user, circle
+
+    def p99(self, latencies):
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+    async def run_concurrently(self, message_count, concurrency, send):
+        latencies = []
+        queue = list(range(message_count))
+
+        async def sender():
+            while queue:
+                index = queue.pop()
+                started = time.perf_counter()
+                await send(f'benchmark {index}')
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        return time.perf_counter() - started, latencies
+
+    async def run_current(self, user, circle, message_count, concurrency):
+        """CircleChatConsumer.save_messageと同じく1件ずつdatabase_sync_to_asyncでINSERT"""
+        save = database_sync_to_async(CircleMessage.objects.create_member_message)
+        return await self.run_concurrently(message_count, concurrency, lambda content: save(circle.pk, user, content))
+
+    async def run_write_behind(self, user, circle, message_count, concurrency, journal_dir, interval_ms):
+        """ackまでの時間と、全件がDBに保存されるまでの時間を計測"""
+        write_behind = MessageWriteBehind(journal_dir, interval_ms=interval_ms)
+        started = time.perf_counter()
+        _, latencies = await self.run_concurrently(
+            message_count, concurrency, lambda content: write_behind.submit(circle.pk, user, content)
+        )
+        while write_behind._pending or (write_behind._task and not write_behind._task.done()):
+            await asyncio.sleep(write_behind.interval)
+        elapsed = time.perf_counter() - started
+
+        if write_behind.stats['saved'] != message_count:
+            raise CommandError(f"保存された件数が一致しません: {write_behind.stats}")
+        return elapsed, latencies
+
+    def crash_test(self, user, circle, message_count, interval_ms):
+        """ackした直後にSIGKILLで落としても、ジャーナルから全件復元できることを確認"""
+        with tempfile.TemporaryDirectory() as journal_dir:
+            read_fd, write_fd = os.pipe()
+            # 子プロセスに親のDB接続を引き継がない
+            connections.close_all()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                self.crash_child(user, circle, message_count, journal_dir, write_fd)
+
+            os.close(write_fd)
+            with os.fdopen(read_fd) as pipe:
+                acked = [line.strip() for line in pipe if line.strip()]
+            _, status = os.waitpid(pid, 0)
+            if not os.WIFSIGNALED(status) or os.WTERMSIG(status) != signal.SIGKILL:
+                raise CommandError('子プロセスが強制終了されませんでした')
+
+            persisted_before = CircleMessage.objects.filter(id__in=acked).count()
+            recovered = MessageWriteBehind(journal_dir).recover()
+            persisted_after = CircleMessage.objects.filter(id__in=acked).count()
+            leftover = os.listdir(journal_dir)
+
+        self.stdout.write(
+            f'acked={len(acked)} persisted_before_recovery={persisted_before} '
+            f'recovered={recovered} persisted_after_recovery={persisted_after}'
+        )
+        if persisted_after != len(acked) or leftover:
+            raise CommandError('ackしたメッセージを復元できませんでした')
+        self.stdout.write(self.style.SUCCESS('ackした全てのメッセージが復元されました'))
+
+    def crash_child(self, user, circle, message_count, journal_dir, write_fd):
+        """ackしたIDを親に渡してから、DBに保存する前に自分をSIGKILLする"""
+        # 保存のtickが来ないように間隔を長くする
+        write_behind = MessageWriteBehind(journal_dir, interval_ms=60_000)
+
+        async def run():
+            with os.fdopen(write_fd, 'w') as pipe:
+                for index in range(message_count):
+                    message = await write_behind.submit(circle.pk, user, f'crash test {index}')
+                    pipe.write(f'{message.id}\n')
+
+        asyncio.run(run())
+        os.kill(os.getpid(), signal.SIGKILL)
@@ -0,0 +1,88 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from circle.models import Circle, CircleMessage, CircleNotification
+
+User = get_user_model()
+
+
+def legacy_circle_activity(circle_id, limit=50, until=None):
+    """比較用: 以前の実装（全件をPythonに読み込んでからソート）"""
+    if until is None:
+        until = timezone.now()
+    circle = Circle.objects.get(id=circle_id)
+    messages = CircleMessage.objects.filter(circle=circle, created_at__lt=until).values(
+        'id', 'content', 'user__id', 'user__username', 'created_at'
+    )
+    notifications = CircleNotification.objects.filter(circle=circle, created_at__lt=until).values(
+        'id', 'message', 'created_at'
+    )
+    activities = [
+        {'id': msg['id'], 'activity_type': 'message', 'activity_timestamp': msg['created_at']}
+        for msg in messages
+    ] + [
+        {'id': notif['id'], 'activity_type': 'notification', 'activity_timestamp': notif['created_at']}
+        for notif in notifications
+    ]
+    activities.sort(key=lambda x: x['activity_timestamp'], reverse=True)
+    return activities[:limit]
+
+
+class Command(BaseCommand):
+    help = 'サークルのアクティビティ取得を以前の実装と比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200_000, help='シードするメッセージ数')
+        parser.add_argument('--notifications', type=int, default=2_000, help='シードする通知数')
+        parser.add_argument('--limit', type=int, default=50)
+        parser.add_argument('--samples', type=int, default=20)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        circle = self.seed(options['messages'], options['notifications'], options['batch_size'])
+        limit = options['limit']
+        circle_id = str(circle.id)
+
+        current = self.measure(options['samples'], lambda: Circle.objects.get_circle_activity(circle_id, limit))
+        legacy = self.measure(options['samples'], lambda: legacy_circle_activity(circle_id, limit))
+
+        self.stdout.write(f"{'':>8} {'p50':>10} {'p99':>10}")
+        self.stdout.write(f"{'current':>8} {current[0]:>8.2f}ms {current[1]:>8.2f}ms")
+        self.stdout.write(f"{'legacy':>8} {legacy[0]:>8.2f}ms {legacy[1]:>8.2f}ms")
+
+    def seed(self, message_count, notification_count, batch_size):
+        user, _ = User.objects.get_or_create(username='benchmark_activity_user')
+        circle, created = Circle.objects.get_or_create(
+            name='benchmark_activity_circle',
+            defaults={'founder': user, 'description': 'benchmark', 'is_public': True},
+        )
+        if not created:
+            return circle
+
+        self.stdout.write(f'{message_count}件のメッセージと{notification_count}件の通知をシードします')
+        # bulk_createはsave()を通らないのでメンバーシップチェックは行われない
+        for offset in range(0, message_count, batch_size):
+            size = min(batch_size, message_count - offset)
+            CircleMessage.objects.bulk_create(
+                [CircleMessage(circle=circle, user=user, content='benchmark') for _ in range(size)]
+            )
+        for offset in range(0, notification_count, batch_size):
+            size = min(batch_size, notification_count - offset)
+            CircleNotification.objects.bulk_create(
+                [CircleNotification(circle=circle, message='benchmark') for _ in range(size)]
+            )
+        return circle
+
+    def measure(self, samples, func):
+        timings = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        p99_index = min(len(timings) - 1, int(len(timings) * 0.99))
+        return statistics.median(timings), timings[p99_index]
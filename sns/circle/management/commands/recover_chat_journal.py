@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from circle.write_behind import MessageWriteBehind
+
+
+class Command(BaseCommand):
+    help = 'write-behindのジャーナルに残っているチャットメッセージをDBに保存する（デプロイ時・障害後に実行）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--journal-dir', default=settings.CIRCLE_CHAT_WRITE_BEHIND['JOURNAL_DIR'])
+
+    def handle(self, *args, **options):
+        # 動いているワーカーのセグメントはロックされているので読み飛ばされる
+        recovered = MessageWriteBehind(options['journal_dir']).recover()
+        self.stdout.write(self.style.SUCCESS(f'{recovered}件のメッセージを復元しました'))
@@ -1,10 +1,18 @@
 from django.db import models
 from django.conf import settings
 from django.core.exceptions import ValidationError
+import time
 import uuid
 from .schemas import ResponseSchema
 import mimetypes
+import heapq
+from itertools import islice
 from django.utils import timezone
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.functions import Coalesce
+from sns.pagination import decode_cursor, InvalidCursor, paginate, paginate_by_created_at
+from sns.search import SearchDocument, get_search_backend, get_search_page
 
 class CircleCategory(models.TextChoices):
     STUDY = 'study', '学習'
@@ -19,12 +27,57 @@ class CircleCategory(models.TextChoices):
     def get_categories(cls):
         return [choice[1] for choice in cls.choices]
 
+def _invalidate_stats_cache(keys):
+    """集計のキャッシュを消す（トランザクション中に古い値が再キャッシュされた場合に備えてコミット後にも消す）"""
+    if not settings.CIRCLE_STATS_CACHE_TIMEOUT:
+        return
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+class TagManager(models.Manager):
+    # 人気のタグは上位MAX_POPULAR_LIMIT件をまとめてキャッシュし、limit件に切り詰めて返す
+    MAX_POPULAR_LIMIT = 100
+    POPULAR_CACHE_KEY = 'circle:popular_tags'
+
+    def get_circle_counts(self, tag_ids):
+        """タグごとのサークル数を{tag_id: 件数}で取得（1クエリで集計）"""
+        totals = {
+            row['tag_id']: row['total']
+            for row in Circle.tags.through.objects.filter(
+                tag_id__in=tag_ids
+            ).values('tag_id').annotate(total=models.Count('circle_id'))
+        }
+        return {tag_id: totals.get(tag_id, 0) for tag_id in tag_ids}
+
+    def get_popular(self, limit=20):
+        """サークル数の多い順にタグを返す（共有キャッシュの時はシグナルで無効化されるまでSQLを発行しない）"""
+        limit = max(1, min(limit, self.MAX_POPULAR_LIMIT))
+        timeout = settings.CIRCLE_STATS_CACHE_TIMEOUT
+        popular = cache.get(self.POPULAR_CACHE_KEY) if timeout else None
+        if popular is None:
+            popular = list(
+                self.annotate(circle_count=models.Count('circles')).order_by('-circle_count', 'name').values(
+                    'id', 'name', 'circle_count'
+                )[:self.MAX_POPULAR_LIMIT if timeout else limit]
+            )
+            if timeout:
+                cache.set(self.POPULAR_CACHE_KEY, popular, timeout)
+        return popular[:limit]
+
+    def invalidate_popular(self):
+        """サークルのタグやタグ自体が変わった時に人気のタグのキャッシュを消す"""
+        _invalidate_stats_cache([self.POPULAR_CACHE_KEY])
+
+
 class Tag(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = TagManager()
+
     def __str__(self):
         return self.name
 
@@ -38,7 +91,102 @@ class CircleManager(models.Manager):
     
     def get_circles_by_category(self, category):
         return self.get_queryset().filter(category=category)
-    
+
+    MEMBER_PREVIEW_COUNT = 5
+
+    def with_list_summary(self, circles):
+        """
+        一覧表示用に人数と先頭のメンバーを付ける（サークルの件数に関係なく3クエリ）
+
+        先頭のメンバーはusername順に取得し、Circle.member_previewでget_membersと同じく創始者を先頭にする。
+
+        member_countはサブクエリで数える（filter(members=...)した後にCount('members')で
+        annotateすると絞り込みのJOINが再利用されて1になるため）。
+        """
+        from django.contrib.auth import get_user_model
+        User = get_user_model()
+
+        member_count = Circle.members.through.objects.filter(
+            circle_id=models.OuterRef('pk')
+        ).order_by().values('circle_id').annotate(total=models.Count('*')).values('total')
+        preview = User.objects.select_related('profile').order_by('username')[:self.MEMBER_PREVIEW_COUNT]
+
+        return circles.select_related('founder__profile').annotate(
+            member_count=Coalesce(models.Subquery(member_count), 0)
+        ).prefetch_related(
+            'tags',
+            models.Prefetch('members', queryset=preview, to_attr='preview_members'),
+        )
+
+    def get_members(self, circle):
+        """
+        創始者を先頭に、残りをusername順に並べたメンバーのクエリセット
+
+        IDのリストを作らずに中間テーブルをサブクエリで参照し、表示名用のプロフィールも同じクエリで取得する。
+        創始者は作成時のシグナルでmembersに追加されるが、後から外された場合も含めるため条件に加える。
+        """
+        from django.contrib.auth import get_user_model
+        User = get_user_model()
+
+        member_ids = Circle.members.through.objects.filter(circle=circle).values('user_id')
+        return User.objects.filter(
+            models.Q(id__in=member_ids) | models.Q(id=circle.founder_id)
+        ).select_related('profile').annotate(
+            is_founder=models.Case(
+                models.When(id=circle.founder_id, then=1),
+                default=0,
+                output_field=models.IntegerField(),
+            )
+        ).order_by('-is_founder', 'username')
+
+    def get_member_page(self, circle, cursor=None, limit=50):
+        """(is_founder, username)のキーセットで創始者を先頭にメンバーを取得"""
+        members = self.get_members(circle)
+        if cursor:
+            is_founder, username = decode_cursor(cursor, 2)
+            if not isinstance(username, str):
+                raise InvalidCursor('username must be a string')
+            try:
+                is_founder = int(is_founder)
+            except (ValueError, TypeError) as e:
+                raise InvalidCursor(str(e))
+            members = members.filter(
+                models.Q(is_founder__lt=is_founder) |
+                models.Q(is_founder=is_founder, username__gt=username)
+            )
+
+        members, has_next, next_cursor = paginate(
+            members, limit, lambda member: (member.is_founder, member.username)
+        )
+        return {
+            'members': members,
+            'has_next': has_next,
+            'next_cursor': next_cursor,
+        }
+
+    CATEGORY_STATS_CACHE_KEY = 'circle:category_stats'
+
+    def get_category_stats(self):
+        """カテゴリーごとのサークル数を1回のGROUP BYで取得（共有キャッシュの時はシグナルで無効化されるまでキャッシュを返す）"""
+        timeout = settings.CIRCLE_STATS_CACHE_TIMEOUT
+        stats = cache.get(self.CATEGORY_STATS_CACHE_KEY) if timeout else None
+        if stats is None:
+            totals = {
+                row['category']: row['total']
+                for row in self.get_queryset().order_by().values('category').annotate(total=models.Count('id'))
+            }
+            stats = [
+                {'category': value, 'circle_count': totals.get(value, 0)}
+                for value, _ in CircleCategory.choices
+            ]
+            if timeout:
+                cache.set(self.CATEGORY_STATS_CACHE_KEY, stats, timeout)
+        return stats
+
+    def invalidate_category_stats(self):
+        """サークルの作成・変更・削除時にカテゴリー別のサークル数のキャッシュを消す"""
+        _invalidate_stats_cache([self.CATEGORY_STATS_CACHE_KEY])
+
     def join_circle(self, user, circle):
         if circle.founder == user:
             return ResponseSchema(status="error", error_code="founder", message="あなたはこのサークルの創始者です")
@@ -82,110 +230,147 @@ class CircleManager(models.Manager):
         circle.save()
         return ResponseSchema(status="success", message="ユーザーをサークルから退会しました")
     
+    MEMBERSHIP_VERSION_KEY = 'circle:membership_version'
+
     def is_member(self, user, circle_id):
+        """所属サークルIDで判定（共有キャッシュが有効な間はSQLを発行しない）"""
+        if user is None or not user.is_authenticated:
+            return False
+
+        # circle_idのUUID形式をバリデーション
         try:
-            # circle_idのUUID形式をバリデーション
-            import uuid
-            try:
-                uuid.UUID(circle_id)
-            except ValueError:
-                return False
-                
-            circle = self.get(id=circle_id)
-            return circle.members.filter(id=user.id).exists()
-        except Circle.DoesNotExist:
+            circle_id = uuid.UUID(str(circle_id))
+        except ValueError:
             return False
-        
-    def get_history(self, user, circle_id, until=timezone.now()):
+
+        return str(circle_id) in self.get_member_circle_ids(user.id)
+
+    def get_member_circle_ids(self, user_id):
+        """ユーザーが所属するサークルIDの集合を取得"""
+        timeout = settings.CIRCLE_MEMBERSHIP_CACHE_TIMEOUT
+        key = self._membership_cache_key(user_id) if timeout else None
+        circle_ids = cache.get(key) if key else None
+        if circle_ids is None:
+            circle_ids = frozenset(
+                str(circle_id) for circle_id in Circle.members.through.objects.filter(
+                    user_id=user_id
+                ).values_list('circle_id', flat=True)
+            )
+            if key:
+                cache.set(key, circle_ids, timeout)
+        return circle_ids
+
+    def invalidate_membership(self, user_ids=None):
+        """メンバーシップのキャッシュを無効化（user_idsがNoneなら全ユーザー分）"""
+        if not settings.CIRCLE_MEMBERSHIP_CACHE_TIMEOUT:
+            return
+
+        def invalidate():
+            if user_ids is None:
+                cache.set(self.MEMBERSHIP_VERSION_KEY, self._next_membership_version(), None)
+            else:
+                cache.delete_many([self._membership_cache_key(user_id) for user_id in user_ids])
+
+        invalidate()
+        # トランザクション中に古い値が再キャッシュされた場合に備えてコミット後にも消す
+        transaction.on_commit(invalidate)
+
+    def _next_membership_version(self):
+        # 時刻ベースで単調増加させる（バージョンが追い出されても過去の値に戻らない）
+        return max(time.time_ns(), (cache.get(self.MEMBERSHIP_VERSION_KEY) or 0) + 1)
+
+    def _membership_cache_key(self, user_id):
+        version = cache.get(self.MEMBERSHIP_VERSION_KEY)
+        if version is None:
+            version = self._next_membership_version()
+            # 他のワーカーが先に設定した場合はそちらに合わせる
+            if not cache.add(self.MEMBERSHIP_VERSION_KEY, version, None):
+                version = cache.get(self.MEMBERSHIP_VERSION_KEY, version)
+        return f'circle:member_circle_ids:{version}:{user_id}'
+
+    def get_history(self, user, circle_id, until=None):
         try:
             circle = self.get(id=circle_id)
-            messages = circle.messages.filter(user=user)
+            messages = CircleMessage.objects.get_messages_by_circle(circle).filter(user=user)
             if until:
                 messages = messages.filter(created_at__lte=until)
             return messages.order_by('-created_at')
-        except CircleMessage.DoesNotExist:
+        except Circle.DoesNotExist:
             return []
     
     def get_circle_activity(self, circle_id, limit=50, until=None):
         """サークルのメッセージ、メディア、通知を統合して取得（ポインターページネーション対応）"""
-        from django.utils import timezone
-        
         if until is None:
             until = timezone.now()
-        
-        try:
-            circle = self.get(id=circle_id)
-            
-            # メッセージを取得（untilより前のもの）
-            messages = CircleMessage.objects.filter(
-                circle=circle,
-                created_at__lt=until
-            ).select_related('user').values(
-                'id', 'content', 'user__id', 'user__username', 'created_at'
-            )
-            
-            # 通知を取得（untilより前のもの）
-            notifications = CircleNotification.objects.filter(
-                circle=circle,
-                created_at__lt=until
-            ).values(
-                'id', 'message', 'created_at'
-            )
-            
-            # メッセージを統一形式に変換
-            message_activities = []
-            for msg in messages:
-                message_activities.append({
-                    'id': msg['id'],
-                    'activity_type': 'message',
-                    'activity_content': msg['content'] or '',
-                    'activity_user': msg['user__username'] or 'Unknown',
-                    'activity_timestamp': msg['created_at'],
-                    'user__id': msg['user__id'],
-                    'user__username': msg['user__username']
-                })
-            
-            # 通知を統一形式に変換
-            notification_activities = []
-            for notif in notifications:
-                notification_activities.append({
-                    'id': notif['id'],
-                    'activity_type': 'notification',
-                    'activity_content': notif['message'] or '',
-                    'activity_user': 'System',
-                    'activity_timestamp': notif['created_at']
-                })
-            
-            # 全てを統合してタイムスタンプでソート
-            all_activities = message_activities + notification_activities
-            all_activities.sort(key=lambda x: x['activity_timestamp'], reverse=True)
-            
-            # limit+1個取得して、次のページがあるかチェック
-            activities = all_activities[:limit + 1]
-            has_next = len(activities) > limit
-            
-            if has_next:
-                activities = activities[:limit]
-            
-            # 次のページのポインター（最後のアイテムのタイムスタンプ）
-            next_until = None
-            if has_next and activities:
-                next_until = activities[-1]['activity_timestamp']
-            
-            return {
-                'activities': activities,
-                'has_next': has_next,
-                'next_until': next_until,
-                'count': len(activities)
-            }
-            
-        except Circle.DoesNotExist:
+
+        if not self.filter(id=circle_id).exists():
             return {
                 'activities': [],
                 'has_next': False,
                 'next_until': None,
                 'count': 0
             }
+
+        # それぞれ(circle, created_at)のインデックスで新しい順にlimit+1件だけ取得
+        messages = CircleMessage.objects.filter(
+            circle_id=circle_id,
+            created_at__lt=until
+        ).order_by('-created_at').values(
+            'id', 'content', 'user__id', 'user__username', 'created_at'
+        )[:limit + 1]
+
+        notifications = CircleNotification.objects.filter(
+            circle_id=circle_id,
+            created_at__lt=until
+        ).order_by('-created_at').values(
+            'id', 'message', 'created_at'
+        )[:limit + 1]
+
+        message_activities = (
+            {
+                'id': msg['id'],
+                'activity_type': 'message',
+                'activity_content': msg['content'] or '',
+                'activity_user': msg['user__username'] or 'Unknown',
+                'activity_timestamp': msg['created_at'],
+                'user__id': msg['user__id'],
+                'user__username': msg['user__username']
+            }
+            for msg in messages
+        )
+
+        notification_activities = (
+            {
+                'id': notif['id'],
+                'activity_type': 'notification',
+                'activity_content': notif['message'] or '',
+                'activity_user': 'System',
+                'activity_timestamp': notif['created_at']
+            }
+            for notif in notifications
+        )
+
+        # どちらも新しい順に並んでいるので先頭limit+1件だけマージする
+        activities = list(islice(
+            heapq.merge(message_activities, notification_activities, key=lambda x: x['activity_timestamp'], reverse=True),
+            limit + 1
+        ))
+        has_next = len(activities) > limit
+
+        if has_next:
+            activities = activities[:limit]
+
+        # 次のページのポインター（最後のアイテムのタイムスタンプ）
+        next_until = None
+        if has_next and activities:
+            next_until = activities[-1]['activity_timestamp']
+
+        return {
+            'activities': activities,
+            'has_next': has_next,
+            'next_until': next_until,
+            'count': len(activities)
+        }
     
 class Circle(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -205,27 +390,16 @@ class Circle(models.Model):
 
     objects = CircleManager()
 
+    @property
+    def member_preview(self):
+        """with_list_summaryで取得した先頭のメンバー（創始者を先頭にする）"""
+        founder = [self.founder] if self.founder_id else []
+        others = [member for member in self.preview_members if member.id != self.founder_id]
+        return [*founder, *others][:Circle.objects.MEMBER_PREVIEW_COUNT]
+
     def get_all_members(self):
-        """創始者を含む全メンバーのクエリセットを返す"""
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
-        
-        # メンバーのIDリストを取得
-        member_ids = list(self.members.values_list('id', flat=True))
-        
-        # 創始者がメンバーリストに含まれていない場合は追加
-        if self.founder and self.founder.id not in member_ids:
-            member_ids.insert(0, self.founder.id)  # 創始者を先頭に配置
-        
-        # IDのリストに基づいてユーザーを取得し、創始者を先頭に配置
-        return User.objects.filter(id__in=member_ids).order_by(
-            models.Case(
-                models.When(id=self.founder.id, then=0),
-                default=1,
-                output_field=models.IntegerField()
-            ),
-            'username'
-        )
+        """創始者を含む全メンバーのクエリセットを返す（創始者が先頭）"""
+        return Circle.objects.get_members(self)
 
     def add_member(self, user):
         """メンバーを追加（BANチェック付き）"""
@@ -246,9 +420,52 @@ class Circle(models.Model):
         return self.name
 
 class CircleMessageManager(models.Manager):
+    SEARCH_DOC_TYPE = 'circlemessage'
+
     def get_messages_by_circle(self, circle):
-        return self.get_queryset().filter(circle=circle).order_by('created_at')
+        return self.get_queryset().filter(circle=circle, is_deleted=False).order_by('created_at')
+
+    def get_message_page(self, circle, cursor=None, limit=50):
+        """(created_at, id)のキーセットで新しい順にメッセージを取得"""
+        messages, has_next, next_cursor = paginate_by_created_at(
+            self.get_messages_by_circle(circle).select_related('user'), cursor, limit
+        )
+        return {
+            'messages': messages,
+            'has_next': has_next,
+            'next_cursor': next_cursor,
+        }
+
+    def iter_messages_by_circle(self, circle, chunk_size=2000):
+        """エクスポート用に古い順で少しずつ読み込む"""
+        return self.get_messages_by_circle(circle).order_by('created_at', 'id').values(
+            'id', 'user__id', 'user__username', 'content', 'created_at', 'updated_at'
+        ).iterator(chunk_size=chunk_size)
     
+    def search_messages(self, circle, query, cursor=None, limit=50):
+        """サークル内のメッセージを全文検索の索引から関連度順に取得"""
+        page = get_search_page(
+            self.get_messages_by_circle(circle).select_related('user'),
+            self.SEARCH_DOC_TYPE, query, scope=circle.id, fields=('body',), cursor=cursor, limit=limit,
+        )
+        return {
+            'messages': page['results'],
+            'has_next': page['has_next'],
+            'next_cursor': page['next_cursor'],
+        }
+
+    def update_search_index(self, messages, created=False):
+        """メッセージを索引に入れ、削除済みのメッセージは索引から外す（createdは全て新規作成したメッセージの場合）"""
+        messages = list(messages)
+        backend = get_search_backend()
+        backend.index(self.SEARCH_DOC_TYPE, [
+            SearchDocument(message.id, message.circle_id, '', message.content)
+            for message in messages if not message.is_deleted
+        ], replace=not created)
+        # 作成したばかりのものは索引に無いので外す必要もない
+        if not created:
+            backend.remove(self.SEARCH_DOC_TYPE, [message.id for message in messages if message.is_deleted])
+
     def get_messages_by_user(self, user):
         return self.get_queryset().filter(user=user)
     
@@ -256,6 +473,12 @@ class CircleMessageManager(models.Manager):
         message = self.model(circle=circle, user=user, content=content)
         message.save()
         return message
+
+    def create_member_message(self, circle_id, user, content):
+        """メンバーであることを確認済みの接続からメッセージを作成（Circleの取得とメンバー確認を省く）"""
+        message = self.model(circle_id=circle_id, user=user, content=content)
+        message.save(skip_clean=True)
+        return message
     
     def delete_message(self, message):
         message.is_deleted = True
@@ -272,19 +495,27 @@ class CircleMessage(models.Model):
     is_pinned = models.BooleanField(default=False)
     pinned_at = models.DateTimeField(null=True, blank=True)
     pinned_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True, related_name='pinned_messages')
-    created_at = models.DateTimeField(auto_now_add=True)
+    # write-behindでは受け付けた時刻を後からbulk_createで保存するので、auto_now_addで上書きしない
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
 
     objects = CircleMessageManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['circle', 'created_at']),
+            models.Index(fields=['circle', 'is_deleted', 'created_at']),
+        ]
+
     def clean(self):
         # ユーザーがサークルのメンバーかどうかをチェック
-        if self.user and self.circle and not self.circle.members.filter(id=self.user.id).exists():
+        if self.user and self.circle_id and not Circle.objects.is_member(self.user, self.circle_id):
             raise ValidationError(f"ユーザー '{self.user.username}' はサークル '{self.circle.name}' のメンバーではありません")
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, skip_clean=False, **kwargs):
         # cleanメソッドを呼び出してバリデーションを実行
-        self.clean()
+        if not skip_clean:
+            self.clean()
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -334,5 +565,10 @@ class CircleNotification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['circle', 'created_at']),
+        ]
+
     def __str__(self):
         return f"{self.circle.name} - {self.message}"
\ No newline at end of file
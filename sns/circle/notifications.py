@@ -0,0 +1,126 @@
+import threading
+import weakref
+
+from django.db import transaction
+
+
+def get_circle_notification_group_name(circle_id):
+    """サークル単位の通知用WebSocketグループ名"""
+    return f'circle_notifications_{circle_id}'
+
+
+def get_circle_chat_group_name(circle_id):
+    """サークルチャット用WebSocketグループ名"""
+    return f'circle_chat_{circle_id}'
+
+
+def build_chat_message_event(message):
+    """チャットメッセージをWebSocketグループに送るイベント"""
+    return {
+        'type': 'chat_message',
+        'message_id': str(message.id),
+        'message': message.content,
+        'user_id': str(message.user.id),
+        'username': message.user.username,
+        'timestamp': message.created_at.isoformat(),
+    }
+
+
+def build_member_message(action, usernames):
+    """メンバー変更の通知文を作成（複数人はまとめて1件にする）"""
+    verb = '参加しました' if action == 'joined' else '退出しました'
+    if len(usernames) == 1:
+        return f"ユーザー {usernames[0]} が{verb}"
+
+    shown = '、'.join(usernames[:3])
+    if len(usernames) > 3:
+        return f"ユーザー {shown} ほか{len(usernames) - 3}人が{verb}"
+    return f"ユーザー {shown} が{verb}"
+
+
+class MemberNotificationBuffer:
+    """
+    トランザクション中のメンバー変更を溜めておき、コミット時にまとめて通知する
+
+    transaction.on_commitに登録されたコールバックそのものなので、
+    ロールバックされた場合はバッファごと破棄される。
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    @property
+    def flushed(self):
+        return self.entries is None
+
+    def add(self, circle, action, usernames):
+        entry = self.entries.setdefault((circle.id, action), {'circle': circle, 'usernames': []})
+        entry['usernames'].extend(usernames)
+
+    def __call__(self):
+        from .models import CircleNotification
+
+        entries, self.entries = self.entries, None
+        notifications = [
+            CircleNotification(
+                circle=entry['circle'],
+                message=build_member_message(action, entry['usernames'])
+            )
+            for (_, action), entry in entries.items()
+            if entry['usernames']
+        ]
+        if not notifications:
+            return
+
+        CircleNotification.objects.bulk_create(notifications)
+        publish_circle_notifications(notifications)
+
+
+# トランザクション中のバッファ（スレッドごと、(接続名, 登録時のセーブポイントID)がキー）
+# 値は弱参照なので、ロールバックでDjangoがon_commitのコールバックを破棄するとバッファも消える
+_pending = threading.local()
+
+
+def _pending_buffers():
+    buffers = getattr(_pending, 'buffers', None)
+    if buffers is None:
+        buffers = _pending.buffers = weakref.WeakValueDictionary()
+    return buffers
+
+
+def queue_member_notification(circle, action, usernames, using=None):
+    """メンバー変更通知を現在のトランザクションのバッファに追加"""
+    connection = transaction.get_connection(using)
+    if connection.in_atomic_block:
+        savepoint_ids = frozenset(sid for sid in connection.savepoint_ids if sid)
+        for (alias, buffer_savepoint_ids), buffer in list(_pending_buffers().items()):
+            # 現在のセーブポイントをすべて含むバッファなら、ロールバックで一緒に破棄される
+            # （含まれない分のセーブポイントは解放済み、ロールバック済みなら辞書から消えている）
+            if alias == connection.alias and savepoint_ids <= buffer_savepoint_ids and not buffer.flushed:
+                buffer.add(circle, action, usernames)
+                return
+
+    buffer = MemberNotificationBuffer()
+    buffer.add(circle, action, usernames)
+    if connection.in_atomic_block:
+        _pending_buffers()[(connection.alias, savepoint_ids)] = buffer
+    # トランザクション外ではその場で実行される
+    transaction.on_commit(buffer, using=using)
+
+
+def publish_circle_notifications(notifications):
+    """通知をサークルごとのグループに1回ずつ送信（コミット後に呼ばれるので送信キューへ直接追加）"""
+    from sns.broadcast import broadcast_queue
+
+    for notification in notifications:
+        broadcast_queue.enqueue(
+            get_circle_notification_group_name(notification.circle.id),
+            {
+                'type': 'circle_notification',
+                'notification_id': str(notification.id),
+                'circle_id': str(notification.circle.id),
+                'circle_name': notification.circle.name,
+                'message': notification.message,
+                'timestamp': notification.created_at.isoformat(),
+            }
+        )
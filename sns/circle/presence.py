@@ -0,0 +1,361 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# 同じユーザーのtypingを送る最短間隔（秒）
+TYPING_INTERVAL = 3.0
+# stop_typingを送るまで待つ時間（この間にtypingが来たら取り消す）
+STOP_TYPING_DELAY = 1.5
+# 参加・退出をまとめて送る間隔
+PRESENCE_INTERVAL = 2.0
+# オンライン中の全員を送り直す間隔
+SNAPSHOT_INTERVAL = 30.0
+# 接続ごとにオンライン状況を更新する間隔と、更新が途絶えてから消えるまでの時間
+HEARTBEAT_INTERVAL = 20.0
+PRESENCE_TTL = 60.0
+
+
+class CirclePresence:
+    """1つのサークルについて、このプロセスが持っているWebSocket接続の状況"""
+
+    def __init__(self, circle_id, group_name, channel_layer):
+        self.circle_id = str(circle_id)
+        self.group_name = group_name
+        self.channel_layer = channel_layer
+        # user_id -> {'username': str, 'connections': int}
+        self.connections = {}
+        # 前回送信してから参加・退出したユーザー（user_id -> username）
+        self.joined = {}
+        self.left = {}
+        # user_id -> (最後にtypingを送った時刻, username)
+        self.typing = {}
+        self.stop_timers = {}
+        self.last_snapshot_at = 0.0
+        self.task = None
+
+    def add(self, user_id, username):
+        entry = self.connections.setdefault(user_id, {'username': username, 'connections': 0})
+        entry['connections'] += 1
+        if entry['connections'] > 1:
+            # 別タブからの接続は参加扱いにしない
+            return
+        if self.left.pop(user_id, None) is None:
+            self.joined[user_id] = username
+
+    def remove(self, user_id):
+        entry = self.connections.get(user_id)
+        if entry is None:
+            return False
+        entry['connections'] -= 1
+        if entry['connections'] > 0:
+            return False
+
+        del self.connections[user_id]
+        # 再接続のように送信前に参加→退出した場合は何も送らない
+        if self.joined.pop(user_id, None) is None:
+            self.left[user_id] = entry['username']
+        return True
+
+    def get_online_members(self):
+        return [
+            {'user_id': user_id, 'username': entry['username']}
+            for user_id, entry in sorted(self.connections.items(), key=lambda item: item[1]['username'])
+        ]
+
+    def pop_changes(self):
+        joined = [{'user_id': user_id, 'username': username} for user_id, username in self.joined.items()]
+        left = [{'user_id': user_id, 'username': username} for user_id, username in self.left.items()]
+        self.joined.clear()
+        self.left.clear()
+        return joined, left
+
+
+class PresenceRegistry:
+    """
+    サークルチャットのオンライン状況とタイピング状態を管理する
+
+    - typingはユーザーごとにTYPING_INTERVAL秒に1回だけグループへ送る
+    - stop_typingはSTOP_TYPING_DELAY秒待ってから送る（その間にtypingが来たら送らない）
+    - 参加・退出は接続ごとに送らず、PRESENCE_INTERVAL秒ごとにまとめて1回送る
+    - SNAPSHOT_INTERVAL秒ごとにオンライン中の全員を送り直す
+
+    状態はこのプロセスのメモリ上だけにあり、DBにはアクセスしない。
+    全ワーカー分のオンライン一覧はget_presence_store()の保存先から取る。
+    """
+
+    def __init__(self):
+        self.circles = {}
+
+    def _get(self, circle_id):
+        return self.circles.get(str(circle_id))
+
+    async def join(self, circle_id, group_name, channel_layer, user_id, username):
+        presence = self._get(circle_id)
+        if presence is None:
+            presence = CirclePresence(circle_id, group_name, channel_layer)
+            self.circles[presence.circle_id] = presence
+        presence.add(str(user_id), username)
+        if presence.task is None or presence.task.done():
+            presence.task = asyncio.create_task(self._run(presence))
+
+    async def leave(self, circle_id, user_id):
+        presence = self._get(circle_id)
+        if presence is None:
+            return
+        user_id = str(user_id)
+        if presence.remove(user_id):
+            self._cancel_stop_timer(presence, user_id)
+            typing = presence.typing.pop(user_id, None)
+            if typing is not None:
+                # 入力中のまま切断した場合は待たずに止める
+                await self._send_stop_typing(presence, user_id, typing[1])
+
+    async def typing(self, circle_id, user_id, username):
+        presence = self._get(circle_id)
+        if presence is None:
+            return
+        user_id = str(user_id)
+        self._cancel_stop_timer(presence, user_id)
+
+        now = time.monotonic()
+        last_sent = presence.typing.get(user_id)
+        if last_sent is not None and now - last_sent[0] < TYPING_INTERVAL:
+            return
+        presence.typing[user_id] = (now, username)
+        await presence.channel_layer.group_send(presence.group_name, {
+            'type': 'user_typing',
+            'user_id': user_id,
+            'username': username,
+        })
+
+    async def stop_typing(self, circle_id, user_id):
+        presence = self._get(circle_id)
+        if presence is None:
+            return
+        user_id = str(user_id)
+        if user_id not in presence.typing or user_id in presence.stop_timers:
+            return
+
+        loop = asyncio.get_running_loop()
+        presence.stop_timers[user_id] = loop.call_later(
+            STOP_TYPING_DELAY,
+            lambda: asyncio.ensure_future(self._expire_typing(presence, user_id)),
+        )
+
+    def get_online_members(self, circle_id):
+        """このプロセスに接続中のユーザー一覧（usernameの昇順）"""
+        presence = self._get(circle_id)
+        if presence is None:
+            return []
+        return presence.get_online_members()
+
+    def _cancel_stop_timer(self, presence, user_id):
+        timer = presence.stop_timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def _expire_typing(self, presence, user_id):
+        presence.stop_timers.pop(user_id, None)
+        typing = presence.typing.pop(user_id, None)
+        if typing is not None:
+            await self._send_stop_typing(presence, user_id, typing[1])
+
+    async def _send_stop_typing(self, presence, user_id, username):
+        await presence.channel_layer.group_send(presence.group_name, {
+            'type': 'user_stop_typing',
+            'user_id': user_id,
+            'username': username,
+        })
+
+    async def _run(self, presence):
+        """参加・退出をまとめて送る（サークルの接続がなくなったら終了）"""
+        try:
+            while True:
+                await asyncio.sleep(PRESENCE_INTERVAL)
+                await self._flush(presence)
+                if not presence.connections:
+                    break
+        finally:
+            presence.task = None
+            if not presence.connections and self.circles.get(presence.circle_id) is presence:
+                del self.circles[presence.circle_id]
+
+    async def _flush(self, presence):
+        joined, left = presence.pop_changes()
+        now = time.monotonic()
+        send_snapshot = presence.connections and now - presence.last_snapshot_at >= SNAPSHOT_INTERVAL
+        if not joined and not left and not send_snapshot:
+            return
+
+        event = {
+            'type': 'presence',
+            'joined': joined,
+            'left': left,
+        }
+        if send_snapshot:
+            # 一覧は全ワーカー分をまとめた保存先から取る
+            online = await sync_to_async(get_presence_store().get_online_members, thread_sensitive=False)(presence.circle_id)
+            event['online'] = online
+            event['online_count'] = len(online)
+            presence.last_snapshot_at = now
+        await presence.channel_layer.group_send(presence.group_name, event)
+
+
+presence_registry = PresenceRegistry()
+
+
+def _unique_members(rows):
+    """(user_id, username)の一覧を同じユーザーの別タブをまとめてusername順にする"""
+    members = {user_id: username for user_id, username in rows}
+    return [
+        {'user_id': user_id, 'username': username}
+        for user_id, username in sorted(members.items(), key=lambda item: item[1])
+    ]
+
+
+class MemoryPresenceStore:
+    """プロセス内だけで持つオンライン状況（ワーカー1つの開発用）"""
+
+    def __init__(self, ttl=PRESENCE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # circle_id -> {channel_name: (expires, user_id, username)}
+        self._circles = {}
+
+    def touch(self, circle_id, channel_name, user_id, username):
+        with self._lock:
+            connections = self._circles.setdefault(str(circle_id), {})
+            connections[channel_name] = (time.time() + self.ttl, str(user_id), username)
+
+    def remove(self, circle_id, channel_name):
+        with self._lock:
+            connections = self._circles.get(str(circle_id))
+            if connections is not None:
+                connections.pop(channel_name, None)
+                if not connections:
+                    del self._circles[str(circle_id)]
+
+    def get_online_members(self, circle_id):
+        now = time.time()
+        with self._lock:
+            connections = self._circles.get(str(circle_id), {})
+            for channel_name in [name for name, (expires, _, _) in connections.items() if expires < now]:
+                del connections[channel_name]
+            rows = [(user_id, username) for _, user_id, username in connections.values()]
+        return _unique_members(rows)
+
+
+class RedisPresenceStore:
+    """
+    Redisに置くオンライン状況（channels_redisと同じRedisを使う）
+
+    サークルごとにSorted Set（接続 -> 期限）とHash（接続 -> ユーザー）を持ち、
+    期限の切れた接続は読み出し時に取り除く。
+    """
+
+    def __init__(self, url, ttl=PRESENCE_TTL, prefix='circle_presence'):
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+
+    def _keys(self, circle_id):
+        key = f'{self.prefix}:{circle_id}'
+        return key, f'{key}:users'
+
+    def touch(self, circle_id, channel_name, user_id, username):
+        key, users_key = self._keys(circle_id)
+        expires = time.time() + self.ttl
+        pipe = self.client.pipeline()
+        pipe.zadd(key, {channel_name: expires})
+        pipe.hset(users_key, channel_name, json.dumps([str(user_id), username]))
+        # サークルに誰もいなくなったらキーごと消える
+        pipe.expire(key, int(self.ttl))
+        pipe.expire(users_key, int(self.ttl))
+        pipe.execute()
+
+    def remove(self, circle_id, channel_name):
+        key, users_key = self._keys(circle_id)
+        pipe = self.client.pipeline()
+        pipe.zrem(key, channel_name)
+        pipe.hdel(users_key, channel_name)
+        pipe.execute()
+
+    def get_online_members(self, circle_id):
+        key, users_key = self._keys(circle_id)
+        now = time.time()
+        expired = self.client.zrangebyscore(key, '-inf', now)
+        if expired:
+            pipe = self.client.pipeline()
+            pipe.zrem(key, *expired)
+            pipe.hdel(users_key, *expired)
+            pipe.execute()
+
+        channel_names = self.client.zrangebyscore(key, now, '+inf')
+        if not channel_names:
+            return []
+        rows = [json.loads(value) for value in self.client.hmget(users_key, channel_names) if value is not None]
+        return _unique_members(rows)
+
+
+class SQLitePresenceStore:
+    """SQLiteチャネルレイヤーと同じファイルに置くオンライン状況（ローカルで複数ワーカーを試す時用）"""
+
+    def __init__(self, path, ttl=PRESENCE_TTL):
+        self.path = str(path)
+        self.ttl = ttl
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS circle_presence ('
+            'circle_id TEXT NOT NULL, channel TEXT NOT NULL, user_id TEXT NOT NULL, username TEXT NOT NULL, '
+            'expires REAL NOT NULL, PRIMARY KEY (circle_id, channel))'
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def touch(self, circle_id, channel_name, user_id, username):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO circle_presence (circle_id, channel, user_id, username, expires) VALUES (?, ?, ?, ?, ?)',
+            (str(circle_id), channel_name, str(user_id), username, time.time() + self.ttl),
+        )
+
+    def remove(self, circle_id, channel_name):
+        self._connection().execute(
+            'DELETE FROM circle_presence WHERE circle_id = ? AND channel = ?',
+            (str(circle_id), channel_name),
+        )
+
+    def get_online_members(self, circle_id):
+        connection = self._connection()
+        now = time.time()
+        connection.execute('DELETE FROM circle_presence WHERE circle_id = ? AND expires < ?', (str(circle_id), now))
+        rows = connection.execute(
+            'SELECT user_id, username FROM circle_presence WHERE circle_id = ?', (str(circle_id),)
+        ).fetchall()
+        return _unique_members(rows)
+
+
+_presence_store = None
+
+
+def get_presence_store():
+    """settings.CIRCLE_PRESENCEで指定された保存先を取得"""
+    global _presence_store
+    if _presence_store is None:
+        config = getattr(settings, 'CIRCLE_PRESENCE', {'BACKEND': 'circle.presence.MemoryPresenceStore'})
+        _presence_store = import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+    return _presence_store
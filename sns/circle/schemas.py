@@ -23,10 +23,53 @@ class CircleSchema(Schema):
     created_at: datetime
     updated_at: datetime
 
+class MemberSummarySchema(Schema):
+    id: uuid.UUID
+    username: str
+    display_name: Optional[str] = None
+    pfp: Optional[str] = None
+
+    @staticmethod
+    def resolve_display_name(obj):
+        profile = getattr(obj, 'profile', None)
+        return profile.display_name if profile else None
+
+    @staticmethod
+    def resolve_pfp(obj):
+        profile = getattr(obj, 'profile', None)
+        return profile.pfp.url if profile and profile.pfp else None
+
+class CircleListSchema(Schema):
+    """一覧用のサークル（メンバーは人数と先頭の数人だけ）"""
+    id: uuid.UUID
+    name: str
+    description: Optional[str] = None
+    founder: Optional[UserSchema] = None
+    category: str
+    tags: list[TagSchema]
+    member_count: int
+    member_preview: list[MemberSummarySchema]
+    is_public: bool
+    created_at: datetime
+    updated_at: datetime
+
+class CircleMemberSchema(MemberSummarySchema):
+    is_founder: bool
+
+class CircleMemberPageSchema(Schema):
+    members: list[CircleMemberSchema]
+    has_next: bool
+    next_cursor: Optional[str] = None
+
 class CircleCategorySchema(Schema):
     category: str
     circle_count: int
 
+class TagStatsSchema(Schema):
+    id: uuid.UUID
+    name: str
+    circle_count: int
+
 class ResponseSchema(Schema):
     status: Literal["success", "error"]
     error_code: Optional[str] = None
@@ -40,6 +83,11 @@ class CircleMessageSchema(Schema):
     created_at: datetime
     updated_at: datetime
 
+class CircleMessagePageSchema(Schema):
+    messages: list[CircleMessageSchema]
+    has_next: bool
+    next_cursor: Optional[str] = None
+
 class CircleMessageCreateSchema(Schema):
     content: str
 
@@ -56,4 +104,13 @@ class CircleMediaSchema(Schema):
 
 class CircleMediaCreateSchema(Schema):
     media: str
-    label: Optional[str] = None
\ No newline at end of file
+    label: Optional[str] = None
+
+class OnlineMemberSchema(Schema):
+    user_id: uuid.UUID
+    username: str
+
+class CircleOnlineMembersSchema(Schema):
+    circle_id: uuid.UUID
+    online_count: int
+    members: list[OnlineMemberSchema]
@@ -1,7 +1,10 @@
-from django.db.models.signals import post_save, m2m_changed
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
-from .models import Circle, CircleMessage, CircleNotification
+from .models import Circle, CircleMessage, Tag
+from .notifications import queue_member_notification, get_circle_chat_group_name, build_chat_message_event
+from sns.broadcast import broadcast_on_commit
+from sns.search import get_search_backend
 
 
 @receiver(post_save, sender=Circle)
@@ -11,6 +14,33 @@ def add_founder_to_members(sender, instance, created, **kwargs):
         instance.members.add(instance.founder)
 
 
+@receiver(post_save, sender=Circle)
+def invalidate_category_stats_on_save(sender, instance, **kwargs):
+    """サークルの作成・カテゴリー変更時にカテゴリー別のサークル数のキャッシュを消す"""
+    Circle.objects.invalidate_category_stats()
+
+
+@receiver(post_delete, sender=Circle)
+def invalidate_stats_on_delete(sender, instance, **kwargs):
+    """サークル削除時にカテゴリー別・タグ別のサークル数のキャッシュを消す（タグとの中間行はm2m_changedなしで消える）"""
+    Circle.objects.invalidate_category_stats()
+    Tag.objects.invalidate_popular()
+
+
+@receiver(m2m_changed, sender=Circle.tags.through)
+def invalidate_popular_tags_on_change(sender, action, **kwargs):
+    """サークルのタグが変更された時に人気のタグのキャッシュを消す"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        Tag.objects.invalidate_popular()
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_popular_tags_on_tag_change(sender, instance, **kwargs):
+    """タグの作成・名前変更・削除時に人気のタグのキャッシュを消す"""
+    Tag.objects.invalidate_popular()
+
+
 @receiver(m2m_changed, sender=Circle.members.through)
 def check_banned_users_on_member_add(sender, instance, action, pk_set, **kwargs):
     """メンバー追加時にBANユーザーチェック"""
@@ -54,49 +84,73 @@ def handle_banned_users_change(sender, instance, action, pk_set, **kwargs):
 
 
 @receiver(m2m_changed, sender=Circle.members.through)
-def send_member_notification_to_circle(sender, instance, action, pk_set, **kwargs):
-    """メンバーが変更された時にサークルのメンバーに通知を送信"""
-    if action == 'post_add' and pk_set:
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
-        users = User.objects.filter(id__in=pk_set)
-        for user in users:
-            CircleNotification.objects.create(
-                circle=instance,
-                message=f"ユーザー {user.username} が参加しました"
+def invalidate_membership_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """メンバー変更時にメンバーシップのキャッシュを無効化"""
+    if action in ('post_add', 'post_remove'):
+        # reverse=Trueの場合はinstanceがユーザー、pk_setがサークルID
+        user_ids = [instance.pk] if reverse else pk_set
+        if user_ids:
+            Circle.objects.invalidate_membership(user_ids)
+    elif action == 'post_clear':
+        # clear()では対象ユーザーが分からないので全体のバージョンを上げる
+        Circle.objects.invalidate_membership()
+
+
+@receiver(post_delete, sender=Circle)
+def invalidate_membership_cache_on_delete(sender, instance, **kwargs):
+    """サークル削除時にメンバーシップのキャッシュを無効化"""
+    Circle.objects.invalidate_membership()
+
+
+@receiver(m2m_changed, sender=Circle.members.through)
+def revoke_chat_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """退会・BANされたユーザーのチャット接続に通知（接続時のメンバー確認を取り消す）"""
+    if action == 'post_remove' and pk_set:
+        if reverse:
+            # instanceがユーザー、pk_setがサークルID
+            for circle_id in pk_set:
+                broadcast_on_commit(get_circle_chat_group_name(circle_id), {'type': 'membership_revoked', 'user_ids': [str(instance.pk)]})
+        else:
+            broadcast_on_commit(
+                get_circle_chat_group_name(instance.pk),
+                {'type': 'membership_revoked', 'user_ids': [str(user_id) for user_id in pk_set]}
             )
-    elif action == 'post_remove' and pk_set:
+    elif action == 'post_clear' and not reverse:
+        broadcast_on_commit(get_circle_chat_group_name(instance.pk), {'type': 'membership_revoked', 'user_ids': None})
+
+
+@receiver(post_delete, sender=Circle)
+def revoke_chat_membership_on_delete(sender, instance, **kwargs):
+    """サークル削除時にチャット接続を閉じる"""
+    broadcast_on_commit(get_circle_chat_group_name(instance.pk), {'type': 'membership_revoked', 'user_ids': None})
+
+
+@receiver(m2m_changed, sender=Circle.members.through)
+def send_member_notification_to_circle(sender, instance, action, pk_set, **kwargs):
+    """メンバーが変更された時にサークルのメンバーに通知を送信（コミット時にまとめて作成）"""
+    if action in ('post_add', 'post_remove') and pk_set:
         from django.contrib.auth import get_user_model
         User = get_user_model()
-        users = User.objects.filter(id__in=pk_set)
-        for user in users:
-            CircleNotification.objects.create(
-                circle=instance,
-                message=f"ユーザー {user.username} が退出しました"
-            )
+        usernames = list(User.objects.filter(id__in=pk_set).order_by('username').values_list('username', flat=True))
+        if usernames:
+            queue_member_notification(instance, 'joined' if action == 'post_add' else 'left', usernames)
 
 # channels
 @receiver(post_save, sender=CircleMessage)
 def send_message_to_circle(sender, instance, created, **kwargs):
-    """メッセージが作成された時にサークルのメンバーにWebSocket経由で送信"""
+    """メッセージが作成された時にサークルのメンバーにWebSocket経由で送信（コミット後に送信キューから配信）"""
     if created:
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
-        channel_layer = get_channel_layer()
-        circle_group_name = f'circle_chat_{instance.circle.id}'
-        
-        # WebSocketグループにメッセージを送信
-        async_to_sync(channel_layer.group_send)(
-            circle_group_name,
-            {
-                'type': 'chat_message',
-                'message_id': str(instance.id),
-                'message': instance.content,
-                'user_id': str(instance.user.id),
-                'username': instance.user.username,
-                'timestamp': instance.created_at.isoformat(),
-            }
-        )
-        
-        print(f"メッセージをWebSocketで送信しました: {instance.content}")
\ No newline at end of file
+        # ロールバックされたメッセージは送らない
+        broadcast_on_commit(get_circle_chat_group_name(instance.circle_id), build_chat_message_event(instance))
+
+
+@receiver(post_save, sender=CircleMessage)
+def update_message_search_index(sender, instance, created, **kwargs):
+    """メッセージの保存時に索引を更新（削除したメッセージは索引から外す）"""
+    CircleMessage.objects.update_search_index([instance], created=created)
+
+
+@receiver(post_delete, sender=CircleMessage)
+def remove_message_from_search_index(sender, instance, **kwargs):
+    """メッセージがDBから削除された時（サークルの削除など）に索引から外す"""
+    get_search_backend().remove(CircleMessage.objects.SEARCH_DOC_TYPE, [instance.pk])
@@ -1,3 +1,449 @@
-from django.test import TestCase
+import base64
+import json
+import tempfile
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from ninja_jwt.tokens import AccessToken
+
+from chat.management.commands.loadtest_direct_messages import with_user
+from sns.search import get_search_backend
+from users.models import User
+from .consumers import CircleChatConsumer
+from .models import Circle, CircleMessage, CircleNotification, Tag
+from .write_behind import MessageJournal, MessageWriteBehind, save_messages
+
+
+class CircleListQueryCountTests(TestCase):
+    """サークル一覧のクエリ数がサークル数・メンバー数に比例しないことを確認"""
+
+    def create_circles(self, count, members_per_circle=8):
+        tag = Tag.objects.create(name='tag')
+        # 創始者がusername順で最後になるようにする
+        founder = User.objects.create_user(f'zfounder{Circle.objects.count()}', 'password')
+        users = [User.objects.create_user(f'user{Circle.objects.count()}-{i}', 'password') for i in range(members_per_circle)]
+        for i in range(count):
+            circle = Circle.objects.create(founder=founder, name=f'circle{i}', description='d', is_public=True)
+            circle.members.add(*users)
+            circle.tags.add(tag)
+
+    def test_public_circles_query_count_is_constant(self):
+        self.create_circles(1)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/circle/public')
+        self.assertEqual(response.status_code, 200)
+
+        self.create_circles(10)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/circle/public')
+        self.assertEqual(response.status_code, 200)
+
+        circles = response.json()
+        self.assertEqual(len(circles), 11)
+        for circle in circles:
+            self.assertNotIn('members', circle)
+            # 創始者 + メンバー8人
+            self.assertEqual(circle['member_count'], 9)
+            self.assertEqual(len(circle['member_preview']), Circle.objects.MEMBER_PREVIEW_COUNT)
+            # 創始者はusername順では最後だが、メンバー一覧と同じく先頭に来る
+            self.assertEqual(circle['member_preview'][0]['username'], circle['founder']['username'])
+
+    def test_members_are_paginated_founder_first(self):
+        self.create_circles(1, members_per_circle=5)
+        circle = Circle.objects.get()
+
+        usernames = []
+        cursor = None
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            with self.assertNumQueries(2):
+                page = self.client.get(f'/api/circle/{circle.id}/members', params).json()
+            usernames += [member['username'] for member in page['members']]
+            cursor = page['next_cursor']
+            if not page['has_next']:
+                break
+
+        others = circle.members.exclude(id=circle.founder_id).order_by('username').values_list('username', flat=True)
+        self.assertEqual(usernames, [circle.founder.username, *others])
+
+    def test_members_include_founder_removed_from_members(self):
+        self.create_circles(1, members_per_circle=2)
+        circle = Circle.objects.get()
+        circle.members.remove(circle.founder)
+
+        page = self.client.get(f'/api/circle/{circle.id}/members').json()
+        self.assertEqual(page['members'][0]['username'], circle.founder.username)
+        self.assertEqual(len(page['members']), 3)
+
+    def test_members_cursor_with_wrong_value_types_is_rejected(self):
+        self.create_circles(1, members_per_circle=1)
+        circle = Circle.objects.get()
+
+        for values in ([None, 'a'], [[1], 'a'], ['x', 'a'], ['1', 2]):
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+            response = self.client.get(f'/api/circle/{circle.id}/members', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, values)
+
+
+class MembershipCacheTests(TestCase):
+    """メンバー判定のキャッシュ（共有キャッシュの時だけ有効）"""
+
+    def setUp(self):
+        cache.clear()
+        self.founder = User.objects.create_user('founder', 'password')
+        self.user = User.objects.create_user('user', 'password')
+        self.circle = Circle.objects.create(founder=self.founder, name='c', description='d', is_public=True)
+        self.circle.members.add(self.user)
+
+    def remove_without_signals(self):
+        # 別のワーカーでの退会を想定（このプロセスのシグナルは発火しない）
+        Circle.members.through.objects.filter(circle=self.circle, user=self.user).delete()
+
+    @override_settings(CIRCLE_MEMBERSHIP_CACHE_TIMEOUT=0)
+    def test_process_local_cache_is_not_used(self):
+        self.assertTrue(Circle.objects.is_member(self.user, self.circle.id))
+        self.remove_without_signals()
+        self.assertFalse(Circle.objects.is_member(self.user, self.circle.id))
+
+    @override_settings(CIRCLE_MEMBERSHIP_CACHE_TIMEOUT=600)
+    def test_shared_cache_is_invalidated_on_change(self):
+        self.assertTrue(Circle.objects.is_member(self.user, self.circle.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(Circle.objects.is_member(self.user, self.circle.id))
+        self.circle.members.remove(self.user)
+        self.assertFalse(Circle.objects.is_member(self.user, self.circle.id))
+
+    @override_settings(CIRCLE_MEMBERSHIP_CACHE_TIMEOUT=600)
+    def test_version_does_not_roll_back_after_eviction(self):
+        self.assertTrue(Circle.objects.is_member(self.user, self.circle.id))
+        version = cache.get(Circle.objects.MEMBERSHIP_VERSION_KEY)
+        Circle.objects.invalidate_membership()
+        self.assertGreater(cache.get(Circle.objects.MEMBERSHIP_VERSION_KEY), version)
+
+        # バージョンが追い出されても古いキャッシュは読まれない
+        self.remove_without_signals()
+        cache.delete(Circle.objects.MEMBERSHIP_VERSION_KEY)
+        self.assertFalse(Circle.objects.is_member(self.user, self.circle.id))
+        self.assertGreater(cache.get(Circle.objects.MEMBERSHIP_VERSION_KEY), version)
+
+
+class CircleStatsCacheTests(TestCase):
+    """カテゴリー・タグ別のサークル数のキャッシュ（共有キャッシュの時だけ有効で、シグナルで無効化）"""
+
+    def setUp(self):
+        cache.clear()
+        self.founder = User.objects.create_user('founder', 'password')
+
+    def category_counts(self):
+        response = self.client.get('/api/circle/category')
+        self.assertEqual(response.status_code, 200)
+        return {row['category']: row['circle_count'] for row in response.json()}
+
+    def popular_tags(self):
+        response = self.client.get('/api/circle/tags/popular')
+        self.assertEqual(response.status_code, 200)
+        return [(row['name'], row['circle_count']) for row in response.json()]
+
+    @override_settings(CIRCLE_STATS_CACHE_TIMEOUT=600)
+    def test_category_stats_reflect_changes_immediately(self):
+        self.assertEqual(self.category_counts()['game'], 0)
+        with self.assertNumQueries(0):
+            Circle.objects.get_category_stats()
+
+        circle = Circle.objects.create(founder=self.founder, name='c', description='d', category='game')
+        self.assertEqual(self.category_counts()['game'], 1)
+
+        circle.category = 'music'
+        circle.save()
+        counts = self.category_counts()
+        self.assertEqual((counts['game'], counts['music']), (0, 1))
+
+        circle.delete()
+        self.assertEqual(self.category_counts()['music'], 0)
+
+    @override_settings(CIRCLE_STATS_CACHE_TIMEOUT=600)
+    def test_popular_tags_reflect_changes_immediately(self):
+        tag = Tag.objects.create(name='tag')
+        circle = Circle.objects.create(founder=self.founder, name='c', description='d')
+        self.assertEqual(self.popular_tags(), [('tag', 0)])
+        with self.assertNumQueries(0):
+            Tag.objects.get_popular()
+
+        circle.tags.add(tag)
+        self.assertEqual(self.popular_tags(), [('tag', 1)])
+        Tag.objects.create(name='new')
+        self.assertEqual(self.popular_tags(), [('tag', 1), ('new', 0)])
+        circle.delete()
+        self.assertEqual(self.popular_tags(), [('new', 0), ('tag', 0)])
+
+    @override_settings(CIRCLE_STATS_CACHE_TIMEOUT=0)
+    def test_process_local_cache_is_not_used(self):
+        self.assertEqual(self.category_counts()['game'], 0)
+        # 別のワーカーでの作成を想定（このプロセスのシグナルは発火しない）
+        Circle.objects.bulk_create([Circle(founder=self.founder, name='c', description='d', category='game')])
+        self.assertEqual(self.category_counts()['game'], 1)
+
+
+class OnlineMembersQueryCountTests(TestCase):
+    """接続中メンバーのAPIはメンバー判定以外でDBにアクセスしない"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', 'password')
+        self.circle = Circle.objects.create(founder=self.user, name='c', description='d', is_public=True)
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def get_online(self):
+        response = self.client.get(f'/api/circle/{self.circle.id}/online', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    @override_settings(CIRCLE_MEMBERSHIP_CACHE_TIMEOUT=0)
+    def test_membership_is_checked_in_db_without_shared_cache(self):
+        with self.assertNumQueries(1):
+            self.get_online()
+        with self.assertNumQueries(1):
+            self.get_online()
+
+    @override_settings(CIRCLE_MEMBERSHIP_CACHE_TIMEOUT=600)
+    def test_membership_is_cached_with_shared_cache(self):
+        self.get_online()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_online()['online_count'], 0)
+
+
+class MemberNotificationTests(TestCase):
+    """メンバー変更通知はトランザクションごとにまとめ、ロールバックした分は通知しない"""
+
+    def setUp(self):
+        self.founder = User.objects.create_user('founder', 'password')
+        self.users = [User.objects.create_user(f'user{i}', 'password') for i in range(4)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.circle = Circle.objects.create(founder=self.founder, name='c', description='d', is_public=True)
+        CircleNotification.objects.all().delete()
+
+    @patch('sns.broadcast.broadcast_queue.enqueue')
+    def test_savepoint_rollback_discards_only_its_changes(self, enqueue):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.circle.members.add(self.users[0])
+                try:
+                    with transaction.atomic():
+                        self.circle.members.add(self.users[1])
+                        raise RuntimeError
+                except RuntimeError:
+                    pass
+                self.circle.members.add(self.users[2])
+
+        self.assertEqual(
+            list(CircleNotification.objects.values_list('message', flat=True)),
+            ['ユーザー user0、user2 が参加しました'],
+        )
+        self.assertEqual(enqueue.call_count, 1)
+
+    @patch('sns.broadcast.broadcast_queue.enqueue')
+    def test_released_savepoint_is_merged(self, enqueue):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                with transaction.atomic():
+                    self.circle.members.add(self.users[0])
+                self.circle.members.add(self.users[1])
+
+        self.assertEqual(
+            list(CircleNotification.objects.values_list('message', flat=True)),
+            ['ユーザー user0、user1 が参加しました'],
+        )
+
+
+class CircleMessageSearchTests(TestCase):
+    """サークル内のメッセージの全文検索"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'password')
+        self.circle = Circle.objects.create(founder=self.user, name='c', description='d', is_public=True)
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def search(self, query, **params):
+        response = self.client.get(f'/api/circle/{self.circle.id}/search', {'q': query, **params}, **self.auth)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_results_equal_substring_matches_within_circle(self):
+        contents = ['明日の練習は東京で', '東京駅に集合', '京都合宿の件', '了解です']
+        messages = [CircleMessage.objects.create_message(self.circle, self.user, content) for content in contents]
+        other = Circle.objects.create(founder=self.user, name='other', description='d', is_public=True)
+        CircleMessage.objects.create_message(other, self.user, '東京駅に集合')
+
+        for query in ('東京', '京', '集合', '京都合宿', '大阪'):
+            expected = {str(message.id) for message in messages if query in message.content}
+            found = {message['id'] for message in self.search(query)['messages']}
+            self.assertEqual(found, expected, query)
+
+    def test_deleted_message_is_removed_from_index(self):
+        message = CircleMessage.objects.create_message(self.circle, self.user, '東京駅に集合')
+        CircleMessage.objects.delete_message(message)
+
+        rows = get_search_backend().search(CircleMessage.objects.SEARCH_DOC_TYPE, '東京', scope=self.circle.id)
+        self.assertEqual(rows, [])
+        self.assertEqual(self.search('東京')['messages'], [])
+
+    def test_pages_through_results_with_cursor(self):
+        messages = [CircleMessage.objects.create_message(self.circle, self.user, f'東京{i}') for i in range(5)]
+
+        ids = []
+        cursor = None
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            page = self.search('東京', **params)
+            ids += [message['id'] for message in page['messages']]
+            cursor = page['next_cursor']
+            if not page['has_next']:
+                break
+
+        self.assertEqual(ids, [message['id'] for message in self.search('東京')['messages']])
+        self.assertEqual(sorted(ids), sorted(str(message.id) for message in messages))
+
+    def test_non_member_cannot_search(self):
+        outsider = User.objects.create_user('outsider', 'password')
+        response = self.client.get(
+            f'/api/circle/{self.circle.id}/search', {'q': '東京'},
+            HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(outsider)}',
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+class CircleChatConsumerTests(TransactionTestCase):
+    """サークルチャットのWebSocket接続"""
+
+    def setUp(self):
+        self.founder = User.objects.create_user('founder', 'password')
+        self.user = User.objects.create_user('user', 'password')
+        self.circle = Circle.objects.create(founder=self.founder, name='c', description='d', is_public=True)
+        self.circle.members.add(self.user)
+        self.application = URLRouter([path('ws/circle/<circle_id>/chat/', CircleChatConsumer.as_asgi())])
+
+    def connect(self, circle_id):
+        async def connect():
+            communicator = WebsocketCommunicator(
+                with_user(self.application, self.user), f'/ws/circle/{circle_id}/chat/'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            # 接続直後のオンライン状況
+            self.assertEqual((await communicator.receive_json_from())['type'], 'presence')
+            return communicator
+        return connect()
+
+    async def receive_event(self, communicator, event_type):
+        # 配信はbatchにまとめられることがある
+        while True:
+            frame = await communicator.receive_json_from(2)
+            for event in frame['events'] if frame['type'] == 'batch' else [frame]:
+                if event['type'] == event_type:
+                    return event
+
+    def test_non_canonical_circle_id_receives_revocation(self):
+        async def run():
+            communicator = await self.connect(str(self.circle.id).upper())
+            await database_sync_to_async(Circle.objects.leave_circle)(self.user, self.circle)
+            event = await self.receive_event(communicator, 'membership_revoked')
+            self.assertEqual(event['circle_id'], str(self.circle.id))
+            await communicator.disconnect()
+        async_to_sync(run)()
+
+    def test_failed_save_is_reported_to_client(self):
+        async def run():
+            communicator = await self.connect(self.circle.id)
+            with patch.object(CircleMessage.objects, 'create_member_message', side_effect=RuntimeError('db down')):
+                with self.assertLogs('circle.consumers', 'ERROR'):
+                    await communicator.send_json_to({'type': 'chat_message', 'message': 'hello'})
+                    event = await self.receive_event(communicator, 'error')
+            self.assertEqual(event['message'], 'Failed to save message')
+            await communicator.disconnect()
+        async_to_sync(run)()
+        self.assertFalse(CircleMessage.objects.exists())
+
+
+class MessageJournalRecoveryTests(TestCase):
+    """落ちたワーカーのジャーナルを再生しても、メッセージは1件ずつで削除済みのものは戻らない"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'password')
+        self.circle = Circle.objects.create(founder=self.user, name='c', description='d', is_public=True)
+        self.directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def write_journal(self, contents):
+        journal = MessageJournal(self.directory)
+        # 受け付けたのは再生より前（落ちてから時間が経っている）
+        accepted_at = timezone.now() - timedelta(hours=3)
+        records = [
+            {
+                'id': str(uuid.uuid4()), 'circle_id': str(self.circle.id), 'user_id': str(self.user.id),
+                'content': content, 'created_at': (accepted_at + timedelta(seconds=i)).isoformat(),
+            }
+            for i, content in enumerate(contents)
+        ]
+        for record in records:
+            path = journal.append(record)
+        # 書き込み途中で落ちた最終行
+        with open(path, 'a', encoding='utf-8') as file:
+            file.write('{"id": "')
+        return journal, records
+
+    def crash(self, journal):
+        # プロセスが落ちるとファイルが閉じられてflockが外れる
+        for file in journal._files.values():
+            file.close()
+
+    def search(self, query):
+        # search_messagesは削除済みをDB側で除くので、索引そのものを引く
+        rows = get_search_backend().search(
+            CircleMessage.objects.SEARCH_DOC_TYPE, query, scope=self.circle.id, fields=('body',)
+        )
+        return [str(uuid.UUID(str(doc_id))) for doc_id, _, _ in rows]
+
+    def test_replay_saves_each_message_once_and_keeps_deletions(self):
+        journal, records = self.write_journal(['最初のメッセージ', '二番目のメッセージ', '三番目のメッセージ'])
+        # 1件目は保存済み（セグメントを消す前に落ちた）で、その後に削除されている
+        first = records[0]
+        save_messages([CircleMessage(
+            id=first['id'], circle_id=first['circle_id'], user_id=first['user_id'], content=first['content'],
+            created_at=parse_datetime(first['created_at']),
+        )])
+        CircleMessage.objects.delete_message(CircleMessage.objects.get(id=first['id']))
+        self.crash(journal)
+
+        with self.assertLogs('circle.write_behind', 'WARNING'):
+            self.assertEqual(MessageWriteBehind(self.directory).recover(), 3)
+
+        ids = [record['id'] for record in records]
+        self.assertEqual(CircleMessage.objects.filter(id__in=ids).count(), 3)
+        self.assertTrue(CircleMessage.objects.get(id=first['id']).is_deleted)
+        # 保存される時刻は再生した時刻ではなく受け付けた時刻
+        for record in records:
+            self.assertEqual(
+                CircleMessage.objects.get(id=record['id']).created_at, parse_datetime(record['created_at'])
+            )
+        self.assertEqual(self.search('最初'), [])
+        self.assertEqual(self.search('二番目'), [records[1]['id']])
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+        # もう一度再生しても何も起きない
+        self.assertEqual(MessageWriteBehind(self.directory).recover(), 0)
+        self.assertEqual(CircleMessage.objects.filter(id__in=ids).count(), 3)
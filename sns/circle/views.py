@@ -1,36 +1,41 @@
+import json
+import uuid
 from django.shortcuts import render
+from django.http import StreamingHttpResponse
 from ninja import Router
-from ninja_jwt.authentication import JWTAuth
-from .models import Circle, CircleCategory, CircleMessage, CircleMedia
-from .schemas import CircleSchema, CircleCategorySchema, ResponseSchema, CircleMessageSchema, CircleMessageCreateSchema, CircleMediaCreateSchema, CircleMediaSchema
+from ninja_jwt.authentication import JWTAuth, JWTStatelessUserAuthentication
+from .models import Circle, CircleMessage, CircleMedia, Tag
+from .schemas import CircleSchema, CircleListSchema, CircleMemberPageSchema, CircleCategorySchema, TagStatsSchema, ResponseSchema, CircleMessageSchema, CircleMessagePageSchema, CircleMessageCreateSchema, CircleMediaCreateSchema, CircleMediaSchema, CircleOnlineMembersSchema
+from .presence import get_presence_store
+from sns.pagination import InvalidCursor
+from sns.search import InvalidSearchQuery
 from ninja.files import UploadedFile
 
 # Create your views here.
 router = Router(tags=['circle'])
 
-@router.get("/you", auth=JWTAuth(), response=list[CircleSchema])
+@router.get("/you", auth=JWTAuth(), response=list[CircleListSchema])
 def get_circles(request):
-    circles = Circle.objects.get_circles_by_user(request.user).prefetch_related('tags')
-    return circles
+    circles = Circle.objects.get_circles_by_user(request.user)
+    return Circle.objects.with_list_summary(circles)
 
-@router.get("/public", response=list[CircleSchema])
+@router.get("/public", response=list[CircleListSchema])
 def get_public_circles(request):
-    circles = Circle.objects.get_public_circles().prefetch_related('tags')
-    return circles
+    circles = Circle.objects.get_public_circles()
+    return Circle.objects.with_list_summary(circles)
 
-@router.get("/category/{category}", response=list[CircleSchema])
+@router.get("/category/{category}", response=list[CircleListSchema])
 def get_circles_by_category(request, category: str):
-    circles = Circle.objects.get_circles_by_category(category).prefetch_related('tags')
-    return circles
+    circles = Circle.objects.get_circles_by_category(category)
+    return Circle.objects.with_list_summary(circles)
 
 @router.get("/category", response=list[CircleCategorySchema])
 def get_categories(request):
-    categories = []
-    for category_choice in CircleCategory.choices:
-        category_value = category_choice[0]
-        count = Circle.objects.filter(category=category_value).count()
-        categories.append(CircleCategorySchema(category=category_value, circle_count=count))
-    return categories
+    return Circle.objects.get_category_stats()
+
+@router.get("/tags/popular", response=list[TagStatsSchema])
+def get_popular_tags(request, limit: int = 20):
+    return Tag.objects.get_popular(limit=limit)
 
 @router.get("/{circle_id}", response=CircleSchema)
 def get_circle_detail(request, circle_id: str):
@@ -43,7 +48,7 @@ def get_circle_detail(request, circle_id: str):
             from ninja.errors import HttpError
             raise HttpError(400, "サークルIDの形式が正しくありません")
             
-        circle = Circle.objects.select_related('founder').prefetch_related('tags', 'members').get(id=circle_id)
+        circle = Circle.objects.select_related('founder').prefetch_related('tags').get(id=circle_id)
         
         # 創始者を含む全メンバーを取得
         all_members = circle.get_all_members()
@@ -94,22 +99,103 @@ def send_message(request, circle_id: str, data: CircleMessageCreateSchema):
         'updated_at': message.updated_at
     }
 
-@router.get("/{circle_id}/messages", auth=JWTAuth(), response=list[CircleMessageSchema])
-def get_messages(request, circle_id: str):
-    circle = Circle.objects.get(id=circle_id)
-    messages = CircleMessage.objects.get_messages_by_circle(circle).select_related('user', 'circle')
-    
-    return [
-        {
-            'id': message.id,
-            'circle': message.circle.name,
-            'user': message.user.username,
-            'content': message.content,
-            'created_at': message.created_at,
-            'updated_at': message.updated_at
-        }
-        for message in messages
-    ]
+def get_member_circle_or_error(user, circle_id):
+    """メンバーであることを確認してサークルを取得"""
+    from ninja.errors import HttpError
+    try:
+        uuid.UUID(circle_id)
+    except ValueError:
+        raise HttpError(400, "サークルIDの形式が正しくありません")
+
+    if not Circle.objects.is_member(user, circle_id):
+        raise HttpError(403, "このサークルのメンバーではありません")
+
+    try:
+        return Circle.objects.get(id=circle_id)
+    except Circle.DoesNotExist:
+        raise HttpError(404, "サークルが見つかりません")
+
+@router.get("/{circle_id}/messages", auth=JWTAuth(), response=CircleMessagePageSchema)
+def get_messages(request, circle_id: str, cursor: str = None, limit: int = 50):
+    """サークルのメッセージ履歴を新しい順にカーソルページネーションで取得"""
+    from ninja.errors import HttpError
+    if limit < 1 or limit > 200:
+        raise HttpError(400, "limitは1から200の間で指定してください")
+
+    circle = get_member_circle_or_error(request.user, circle_id)
+    try:
+        page = CircleMessage.objects.get_message_page(circle, cursor=cursor, limit=limit)
+    except InvalidCursor:
+        raise HttpError(400, "カーソルの形式が正しくありません")
+
+    return {
+        'messages': [
+            {
+                'id': message.id,
+                'circle': circle.name,
+                'user': message.user.username,
+                'content': message.content,
+                'created_at': message.created_at,
+                'updated_at': message.updated_at
+            }
+            for message in page['messages']
+        ],
+        'has_next': page['has_next'],
+        'next_cursor': page['next_cursor'],
+    }
+
+@router.get("/{circle_id}/search", auth=JWTAuth(), response=CircleMessagePageSchema)
+def search_messages(request, circle_id: str, q: str, cursor: str = None, limit: int = 50):
+    """サークルのメッセージを全文検索し、関連度の高い順にカーソルページネーションで取得"""
+    from ninja.errors import HttpError
+    if limit < 1 or limit > 200:
+        raise HttpError(400, "limitは1から200の間で指定してください")
+    if len(q) > 100:
+        raise HttpError(400, "検索語は100文字以内で指定してください")
+
+    circle = get_member_circle_or_error(request.user, circle_id)
+    try:
+        page = CircleMessage.objects.search_messages(circle, q, cursor=cursor, limit=limit)
+    except InvalidSearchQuery:
+        raise HttpError(400, "検索語を指定してください")
+    except InvalidCursor:
+        raise HttpError(400, "カーソルの形式が正しくありません")
+
+    return {
+        'messages': [
+            {
+                'id': message.id,
+                'circle': circle.name,
+                'user': message.user.username,
+                'content': message.content,
+                'created_at': message.created_at,
+                'updated_at': message.updated_at
+            }
+            for message in page['messages']
+        ],
+        'has_next': page['has_next'],
+        'next_cursor': page['next_cursor'],
+    }
+
+@router.get("/{circle_id}/messages/export", auth=JWTAuth())
+def export_messages(request, circle_id: str):
+    """サークルのメッセージ履歴をNDJSONでストリーミング出力"""
+    circle = get_member_circle_or_error(request.user, circle_id)
+
+    def generate():
+        for message in CircleMessage.objects.iter_messages_by_circle(circle):
+            yield json.dumps({
+                'id': str(message['id']),
+                'user_id': str(message['user__id']),
+                'user': message['user__username'],
+                'content': message['content'],
+                'created_at': message['created_at'].isoformat(),
+                'updated_at': message['updated_at'].isoformat(),
+            }, ensure_ascii=False) + '\n'
+
+    response = StreamingHttpResponse(generate(), content_type='application/x-ndjson; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="circle-{circle.id}-messages.ndjson"'
+    return response
 
 @router.post("/{circle_id}/media", auth=JWTAuth(), response=CircleMediaSchema)
 def upload_media(request, circle_id: str, file: UploadedFile):
@@ -128,6 +214,23 @@ def upload_media(request, circle_id: str, file: UploadedFile):
         'updated_at': media.updated_at
     }
 
+@router.get("/{circle_id}/members", response=CircleMemberPageSchema)
+def get_members(request, circle_id: uuid.UUID, cursor: str = None, limit: int = 50):
+    """サークルのメンバーを創始者から順にカーソルページネーションで取得"""
+    from ninja.errors import HttpError
+    if limit < 1 or limit > 200:
+        raise HttpError(400, "limitは1から200の間で指定してください")
+
+    try:
+        circle = Circle.objects.get(id=circle_id)
+    except Circle.DoesNotExist:
+        raise HttpError(404, "サークルが見つかりません")
+
+    try:
+        return Circle.objects.get_member_page(circle, cursor=cursor, limit=limit)
+    except InvalidCursor:
+        raise HttpError(400, "カーソルの形式が正しくありません")
+
 @router.get("/{circle_id}/is-member", auth=JWTAuth())
 def is_member(request, circle_id: str):
     is_member = Circle.objects.is_member(request.user, circle_id)
@@ -137,6 +240,31 @@ def is_member(request, circle_id: str):
         "is_member": is_member
     }
 
+@router.get("/{circle_id}/online", auth=JWTStatelessUserAuthentication(), response=CircleOnlineMembersSchema)
+def get_online_members(request, circle_id: uuid.UUID):
+    """サークルチャットの接続中メンバーを取得（/presenceと同じく全ワーカー分を保存先から取る）"""
+    return get_circle_presence(request, circle_id)
+
+@router.get("/{circle_id}/presence", auth=JWTStatelessUserAuthentication(), response=CircleOnlineMembersSchema)
+def get_circle_presence(request, circle_id: uuid.UUID):
+    """
+    全ワーカーを合わせたサークルチャットの接続中メンバーを取得（期限切れの接続は含まない）
+
+    ユーザーはトークンから取り出すのでDBからは読まない。メンバー判定は共有キャッシュ
+    （CIRCLE_MEMBERSHIP_CACHE_TIMEOUTが0以外）の時だけキャッシュされ、LocMemでは毎回1クエリ発行する。
+    """
+    from ninja.errors import HttpError
+
+    if not Circle.objects.is_member(request.user, circle_id):
+        raise HttpError(403, "このサークルのメンバーではありません")
+
+    members = get_presence_store().get_online_members(circle_id)
+    return {
+        "circle_id": circle_id,
+        "online_count": len(members),
+        "members": members,
+    }
+
 @router.get("/{circle_id}/activity", auth=JWTAuth())
 def get_circle_activity(request, circle_id: str, limit: int = 50, until: str = None):
     """サークルのメッセージ、メディア、通知を統合して取得（ポインターページネーション対応）"""
@@ -205,4 +333,4 @@ def get_circle_activity(request, circle_id: str, limit: int = 50, until: str = N
         raise HttpError(404, "サークルが見つかりません")
     except ValidationError:
         from ninja.errors import HttpError
-        raise HttpError(400, "サークルIDの形式が正しくありません")
\ No newline at end of file
+        raise HttpError(400, "サークルIDの形式が正しくありません")
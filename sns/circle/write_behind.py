@@ -0,0 +1,283 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from pathlib import Path
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from sns.broadcast import broadcast_queue
+from .models import Circle, CircleMessage
+from .notifications import get_circle_chat_group_name, build_chat_message_event
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsにはflockがない（write-behindを有効にしない限りこのモジュールは読み込めればよい）
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class MessageJournal:
+    """
+    DBに保存する前のメッセージを追記しておくジャーナル
+
+    - ワーカーごとに自分のセグメントファイルへflock(LOCK_EX)をかけたまま追記する
+    - セグメント内のメッセージが全てDBに保存されたらファイルを削除する
+    - ロックが外れている（持ち主のプロセスが落ちた）セグメントはrecover()で読み直す
+    """
+
+    def __init__(self, directory, fsync=False):
+        if fcntl is None:
+            raise ImproperlyConfigured('チャットのwrite-behindはfcntlが使えるOS（Linux・macOS）でのみ有効にできます')
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.current = None
+        # path -> 開いたままのファイル（閉じるとロックが外れる）
+        self._files = {}
+
+    def append(self, record):
+        """1件追記してセグメントのパスを返す"""
+        if self.current is None:
+            self.current = self.directory / f'{os.getpid()}-{uuid.uuid4().hex}.jsonl'
+            file = open(self.current, 'a', encoding='utf-8')
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._files[self.current] = file
+
+        file = self._files[self.current]
+        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        # OSのバッファまで書き出せばプロセスが落ちても残る（電源断にも備える場合はfsync）
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+        return self.current
+
+    def rotate(self):
+        """以降の追記を新しいセグメントに書く"""
+        self.current = None
+
+    def discard(self, path):
+        """DBへの保存が終わったセグメントを削除"""
+        file = self._files.pop(path, None)
+        if path == self.current:
+            self.current = None
+        path.unlink(missing_ok=True)
+        if file is not None:
+            file.close()
+
+    def release(self, path):
+        """セグメントを削除せずにロックを外す（保存に失敗した時に後でやり直せるように）"""
+        file = self._files.pop(path, None)
+        if file is not None:
+            file.close()
+
+    def recover(self):
+        """持ち主のいないセグメントを(path, records)で返す（ロックを取ったまま、discardで削除する）"""
+        for path in sorted(self.directory.glob('*.jsonl')):
+            if path in self._files:
+                continue
+            try:
+                file = open(path, 'r+', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # 動いている別のワーカーのセグメント
+                file.close()
+                continue
+
+            records = []
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 書き込み途中で落ちた最終行（クライアントにはackしていない）
+                    logger.warning('壊れたジャーナル行を読み飛ばしました: %s', path)
+            self._files[path] = file
+            yield path, records
+
+
+class MessageWriteBehind:
+    """
+    サークルチャットのメッセージをまとめてDBに保存する（write-behind）
+
+    submit()はジャーナルに追記したらすぐにメッセージを配信し、DBへの保存は
+    interval_msごとにbulk_createでまとめて行う。
+
+    耐久性:
+    - ackしたメッセージはジャーナルに書かれているので、プロセスが落ちても
+      次に起動したワーカー（またはrecover_chat_journalコマンド）が保存する
+    - OSごと落ちた場合に備えるにはFSYNCを有効にする（追記ごとにfsyncする）
+    - 保存はIDで冪等（ignore_conflicts）なので、同じメッセージを2回保存しても重複しない
+    - bulk_createはpost_saveを呼ばないので、配信はsubmit()で、全文検索の索引の更新はsave_messages()で行う
+    - created_atは受け付けた時刻（配信時のタイムスタンプ）をジャーナルにも書き、再生時もその時刻で保存する
+    """
+
+    def __init__(self, journal_dir, interval_ms=50, max_batch_size=500, fsync=False):
+        self.interval = interval_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.journal = MessageJournal(journal_dir, fsync=fsync)
+        # (セグメントのパス, CircleMessage)
+        self._pending = []
+        # セグメントごとの未保存のメッセージ数
+        self._segment_counts = {}
+        self._task = None
+        self._recovered = False
+        self.stats = {'submitted': 0, 'saved': 0, 'batches': 0, 'errors': 0, 'recovered': 0}
+
+    async def submit(self, circle_id, user, content):
+        """メッセージを受け付けて配信する（DBへの保存は後でまとめて行う）"""
+        message = CircleMessage(
+            id=uuid.uuid4(),
+            circle_id=circle_id,
+            user=user,
+            content=content,
+            created_at=timezone.now(),
+        )
+        segment = self.journal.append({
+            'id': str(message.id),
+            'circle_id': str(circle_id),
+            'user_id': str(user.id),
+            'content': content,
+            'created_at': message.created_at.isoformat(),
+        })
+        self._pending.append((segment, message))
+        self._segment_counts[segment] = self._segment_counts.get(segment, 0) + 1
+        self.stats['submitted'] += 1
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        broadcast_queue.enqueue(get_circle_chat_group_name(circle_id), build_chat_message_event(message))
+        return message
+
+    async def _run(self):
+        if not self._recovered:
+            try:
+                await database_sync_to_async(self.recover)()
+                self._recovered = True
+            except Exception:
+                logger.exception('チャットメッセージのジャーナルを復元できませんでした')
+
+        while self._pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        """溜まっているメッセージをmax_batch_size件ずつ保存"""
+        # 次のtickで追記されるメッセージは新しいセグメントに書く
+        self.journal.rotate()
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            try:
+                await database_sync_to_async(save_messages)([message for _, message in batch])
+            except Exception:
+                # ジャーナルに残っているので次のtickでやり直す
+                logger.exception('チャットメッセージの保存に失敗しました（%d件）', len(batch))
+                self.stats['errors'] += 1
+                return
+
+            del self._pending[:len(batch)]
+            self.stats['saved'] += len(batch)
+            self.stats['batches'] += 1
+            for segment, _ in batch:
+                self._segment_counts[segment] -= 1
+
+        # 全件保存済みのセグメントを削除（追記中のセグメントは次のflushで）
+        for segment, count in list(self._segment_counts.items()):
+            if count == 0 and segment != self.journal.current:
+                del self._segment_counts[segment]
+                self.journal.discard(segment)
+
+    def recover(self):
+        """落ちたワーカーのジャーナルに残っているメッセージを保存"""
+        recovered = 0
+        for path, records in self.journal.recover():
+            messages = [
+                CircleMessage(
+                    id=record['id'],
+                    circle_id=record['circle_id'],
+                    user_id=record['user_id'],
+                    content=record['content'],
+                    # created_atを書いていない古いジャーナルは再生した時刻になる
+                    created_at=parse_datetime(record['created_at']) if 'created_at' in record else timezone.now(),
+                )
+                for record in records
+            ]
+            try:
+                for offset in range(0, len(messages), self.max_batch_size):
+                    save_messages(messages[offset:offset + self.max_batch_size])
+            except Exception:
+                self.journal.release(path)
+                raise
+            self.journal.discard(path)
+            recovered += len(messages)
+
+        if recovered:
+            logger.info('ジャーナルから%d件のチャットメッセージを復元しました', recovered)
+        self.stats['recovered'] += recovered
+        return recovered
+
+
+def save_messages(messages):
+    """
+    メッセージをまとめて保存（IDが同じものは無視するので何度呼んでもよい）
+
+    送信後にサークルやユーザーが削除されていた場合は、そのメッセージだけ捨てる。
+    bulk_createはシグナルを送らないので、全文検索の索引も同じトランザクションで更新する。
+    """
+    try:
+        _insert_messages(messages)
+    except IntegrityError:
+        from django.contrib.auth import get_user_model
+
+        circle_ids = set(Circle.objects.filter(
+            id__in={message.circle_id for message in messages}
+        ).values_list('id', flat=True))
+        user_ids = set(get_user_model().objects.filter(
+            id__in={message.user_id for message in messages}
+        ).values_list('id', flat=True))
+        valid = [
+            message for message in messages
+            if uuid.UUID(str(message.circle_id)) in circle_ids and uuid.UUID(str(message.user_id)) in user_ids
+        ]
+        logger.warning('存在しないサークル・ユーザーのメッセージを%d件捨てました', len(messages) - len(valid))
+        _insert_messages(valid)
+
+
+def _insert_messages(messages):
+    with transaction.atomic():
+        CircleMessage.objects.bulk_create(messages, ignore_conflicts=True)
+        # ジャーナルの再生では保存済みのメッセージも渡ってくる（その後に編集・削除されていることもある）ので、
+        # 渡されたオブジェクトではなくDBの状態で索引を更新する
+        CircleMessage.objects.update_search_index(
+            CircleMessage.objects.filter(id__in=[message.id for message in messages])
+        )
+
+
+_write_behind = None
+
+
+def get_write_behind():
+    """settings.CIRCLE_CHAT_WRITE_BEHINDが有効ならMessageWriteBehindを返す（無効ならNone）"""
+    global _write_behind
+    config = getattr(settings, 'CIRCLE_CHAT_WRITE_BEHIND', {})
+    if not config.get('ENABLED'):
+        return None
+    if _write_behind is None:
+        _write_behind = MessageWriteBehind(
+            config['JOURNAL_DIR'],
+            interval_ms=config.get('INTERVAL_MS', 50),
+            max_batch_size=config.get('MAX_BATCH_SIZE', 500),
+            fsync=config.get('FSYNC', False),
+        )
+    return _write_behind
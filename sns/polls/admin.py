@@ -17,8 +17,8 @@ class ChoiceInline(admin.TabularInline):
 
 @admin.register(Poll)
 class PollAdmin(admin.ModelAdmin):
-    list_display = ('question', 'get_choices_count', 'get_choices_preview', 'created_at', 'updated_at')
-    list_filter = ('created_at', 'updated_at')
+    list_display = ('question', 'get_choices_count', 'get_choices_preview', 'closes_at', 'created_at', 'updated_at')
+    list_filter = ('closes_at', 'created_at', 'updated_at')
     search_fields = ('question',)
     readonly_fields = ('id', 'created_at', 'updated_at')
     inlines = [ChoiceInline]  # インライン編集を追加
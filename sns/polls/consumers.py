@@ -0,0 +1,70 @@
+import json
+import uuid
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from sns.broadcast import BroadcastBatchMixin
+from .models import Poll
+from .live import get_poll_group_name, build_snapshot_event
+
+
+class PollConsumer(BroadcastBatchMixin, AsyncWebsocketConsumer):
+    """
+    投票結果をリアルタイムで配信するWebSocketコンシューマー
+
+    接続時に現在の投票数（poll_snapshot）を送り、以降はTALLY_INTERVALごとに
+    まとめた増減（poll_tally）を送る。{"type": "sync"}を送るとスナップショットを送り直す。
+    """
+
+    async def connect(self):
+        """WebSocket接続時の処理"""
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        try:
+            self.poll_id = uuid.UUID(str(self.scope['url_route']['kwargs']['poll_id']))
+        except ValueError:
+            await self.close()
+            return
+        if not await database_sync_to_async(Poll.objects.filter(id=self.poll_id).exists)():
+            await self.close()
+            return
+
+        self.poll_group_name = get_poll_group_name(self.poll_id)
+        # 参加してからスナップショットを読むので、その間の投票も取りこぼさない
+        await self.channel_layer.group_add(self.poll_group_name, self.channel_name)
+        await self.accept()
+        await self.send_snapshot()
+
+    async def disconnect(self, close_code):
+        """WebSocket切断時の処理"""
+        # 属性が存在しない場合（認証失敗等）は何もしない
+        if not hasattr(self, 'poll_group_name'):
+            return
+
+        await self.channel_layer.group_discard(self.poll_group_name, self.channel_name)
+
+    async def receive(self, text_data):
+        """WebSocketからメッセージを受信した時の処理"""
+        try:
+            message_type = json.loads(text_data).get('type')
+        except (json.JSONDecodeError, AttributeError):
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Invalid JSON'}))
+            return
+
+        if message_type == 'sync':
+            await self.send_snapshot()
+
+    async def send_snapshot(self):
+        event = await database_sync_to_async(build_snapshot_event)(self.poll_id)
+        await self.send(text_data=json.dumps(event))
+
+    async def poll_tally(self, event):
+        """まとめられた投票数の増減を送信"""
+        await self.send(text_data=json.dumps({
+            'type': 'poll_tally',
+            'poll_id': event['poll_id'],
+            'deltas': event['deltas'],
+            'counts': event['counts'],
+        }))
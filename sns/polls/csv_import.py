@@ -0,0 +1,76 @@
+import csv
+import io
+
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import MAX_CHOICES
+
+# 1回のインポートで作成できる投票の上限
+MAX_IMPORT_ROWS = 200
+CHOICE_COLUMNS = [f'choice{i}' for i in range(1, MAX_CHOICES + 1)]
+
+
+def parse_poll_csv(file):
+    """
+    CSVを(question, choices, closes_at)のリストに変換する
+
+    1行目はヘッダーで、question, closes_at（省略可）, choice1〜choice5の列を持つ。
+    空の選択肢の列は無視する。エラーは{行番号: [メッセージ]}のValidationErrorで返す。
+    """
+    try:
+        text = file.read().decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValidationError('CSVはUTF-8で保存してください。')
+
+    reader = csv.DictReader(io.StringIO(text))
+    try:
+        fieldnames = reader.fieldnames
+    except csv.Error as e:
+        raise ValidationError(f'CSVの形式が正しくありません: {e}')
+    if not fieldnames or 'question' not in fieldnames:
+        raise ValidationError('CSVの1行目にquestion列を含むヘッダーが必要です。')
+
+    rows = []
+    errors = {}
+    try:
+        for row in reader:
+            if len(rows) >= MAX_IMPORT_ROWS:
+                raise ValidationError(f'一度にインポートできる投票は{MAX_IMPORT_ROWS}件までです。')
+
+            closes_at = None
+            raw_closes_at = (row.get('closes_at') or '').strip()
+            if raw_closes_at:
+                try:
+                    closes_at = parse_datetime(raw_closes_at)
+                except ValueError:
+                    closes_at = None
+                if closes_at is None:
+                    errors[reader.line_num] = [f'closes_atの形式が正しくありません: {raw_closes_at}']
+                elif timezone.is_naive(closes_at):
+                    closes_at = timezone.make_aware(closes_at)
+
+            choices = [row[column].strip() for column in CHOICE_COLUMNS if (row.get(column) or '').strip()]
+            rows.append((reader.line_num, ((row.get('question') or '').strip(), choices, closes_at)))
+    except csv.Error as e:
+        # 閉じていない引用符や長すぎるフィールドなど
+        raise ValidationError({reader.line_num: [f'CSVの形式が正しくありません: {e}']})
+
+    if errors:
+        raise ValidationError(errors)
+    if not rows:
+        raise ValidationError('CSVに投票が含まれていません。')
+    return rows
+
+
+def import_polls_from_csv(file):
+    """CSVから投票をまとめて作成（1件でもエラーがあれば何も作成しない）"""
+    from .models import Poll
+
+    rows = parse_poll_csv(file)
+    try:
+        return Poll.objects.bulk_create_polls([poll_data for _, poll_data in rows])
+    except ValidationError as e:
+        # 何件目かのエラーをCSVの行番号に直す
+        raise ValidationError({rows[index][0]: messages for index, messages in e.message_dict.items()})
@@ -0,0 +1,63 @@
+from channels.db import database_sync_to_async
+from django.db import transaction
+
+from sns.broadcast import BroadcastQueue
+from .models import Choice
+
+# 投票数の変化をまとめて送る間隔（秒）。1つの投票について1プロセスからこの間隔で最大1フレーム
+TALLY_INTERVAL = 0.3
+
+
+def get_poll_group_name(poll_id):
+    return f'poll_{poll_id}'
+
+
+def get_vote_counts(poll_id):
+    """{choice_id: 投票数}"""
+    return {
+        str(choice_id): vote_count
+        for choice_id, vote_count in Choice.objects.filter(poll_id=poll_id).values_list('id', 'vote_count')
+    }
+
+
+def build_snapshot_event(poll_id):
+    return {'type': 'poll_snapshot', 'poll_id': str(poll_id), 'counts': get_vote_counts(poll_id)}
+
+
+async def merge_tally_events(events):
+    """
+    同じ投票のTALLY_INTERVAL秒分の差分を合算して1つのイベントにする
+
+    接続時のスナップショットと差分が重なっても数え間違えないように、
+    送る時点の投票数（counts）も付ける。クライアントはcountsで表示を置き換え、
+    deltasは増減のアニメーションなどに使う。
+    """
+    deltas = {}
+    for event in events:
+        for choice_id, delta in event['deltas'].items():
+            deltas[choice_id] = deltas.get(choice_id, 0) + delta
+    deltas = {choice_id: delta for choice_id, delta in deltas.items() if delta}
+    if not deltas:
+        # 票を変更してすぐ戻した場合など
+        return []
+
+    poll_id = events[0]['poll_id']
+    return [{
+        'type': 'poll_tally',
+        'poll_id': poll_id,
+        'deltas': deltas,
+        'counts': await database_sync_to_async(get_vote_counts)(poll_id),
+    }]
+
+
+tally_queue = BroadcastQueue(flush_interval=TALLY_INTERVAL, coalesce=merge_tally_events)
+
+
+def publish_vote_deltas(poll_id, deltas):
+    """{choice_id: 増減}をコミット後に送信キューへ追加（投票ごとには送らず、TALLY_INTERVALごとに合算して送る）"""
+    event = {
+        'type': 'poll_tally',
+        'poll_id': str(poll_id),
+        'deltas': {str(choice_id): delta for choice_id, delta in deltas.items()},
+    }
+    transaction.on_commit(lambda: tally_queue.enqueue(get_poll_group_name(poll_id), event))
@@ -0,0 +1,51 @@
+"""
+既存のDBにChoice.positionを追加する時の手順
+
+positionはNOT NULLで(poll, position)の一意制約とposition < MAX_CHOICESのチェック制約があるので、
+既に選択肢があるDBでそのままmakemigrationsすると同じデフォルト値が入って一意制約に違反する。
+次の3段階でマイグレーションを作って適用する。
+
+1. polls/models.pyのChoiceを一時的に次のように変更してmakemigrations polls → migrate
+     position = models.PositiveSmallIntegerField(null=True, editable=False)
+   （Meta.constraintsの2つの制約もコメントアウトしておく）
+2. python manage.py backfill_choice_positions
+   投票ごとに既存の選択肢へ作成順で0〜n-1を振る
+3. polls/models.pyを元に戻してmakemigrations polls → migrate
+   （NOT NULLへの変更と2つの制約が追加される。既存のNULL行の扱いを聞かれたら
+   2.で埋めてあるので「Ignore for now」を選ぶ。--noinputでも同じ扱いになる）
+
+選択肢がMAX_CHOICESより多い投票があると3.のチェック制約で失敗するので、
+2.で表示された投票の選択肢を整理してから3.に進むこと。
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from polls.models import Choice, MAX_CHOICES
+
+
+class Command(BaseCommand):
+    help = (
+        'positionが空の選択肢がある投票について、選択肢に作成順で0から振り直す'
+        '（positionを後から追加する時の手順はこのコマンドのモジュールのdocstringを参照）'
+    )
+
+    def handle(self, *args, **options):
+        manager = Choice._base_manager
+        poll_ids = list(manager.filter(position__isnull=True).values_list('poll_id', flat=True).distinct())
+
+        too_many = []
+        for poll_id in poll_ids:
+            with transaction.atomic():
+                choices = list(manager.select_for_update().filter(poll_id=poll_id).order_by('created_at', 'id'))
+                for position, choice in enumerate(choices):
+                    choice.position = position
+                manager.bulk_update(choices, ['position'])
+            if len(choices) > MAX_CHOICES:
+                too_many.append((poll_id, len(choices)))
+
+        self.stdout.write(self.style.SUCCESS(f'{len(poll_ids)}件の投票の選択肢にpositionを振りました'))
+
+        if too_many:
+            for poll_id, count in too_many:
+                self.stderr.write(f'投票 {poll_id} には選択肢が{count}件あります（上限{MAX_CHOICES}件）')
+            raise CommandError('選択肢が上限を超えている投票を整理してから制約を追加するマイグレーションを適用してください')
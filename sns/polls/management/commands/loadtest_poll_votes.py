@@ -0,0 +1,73 @@
+import itertools
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import Count
+
+from polls.models import Poll, Vote
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = '多数のユーザーが同時に投票・票の変更を行い、選択肢の投票数に取りこぼしがないか確認する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--voters', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--change-ratio', type=float, default=0.3, help='投票後に選択肢を変更するユーザーの割合')
+
+    def handle(self, *args, **options):
+        poll = Poll.objects.create_poll('loadtest', ['A', 'B', 'C', 'D'])
+        choices = list(poll.poll_choices.all())
+        User.objects.bulk_create(
+            [User(username=f'poll_loadtest_{poll.id.hex[:8]}_{i}') for i in range(options['voters'])]
+        )
+        users = list(User.objects.filter(username__startswith=f'poll_loadtest_{poll.id.hex[:8]}_'))
+
+        # 全員1回投票し、一部のユーザーは別の選択肢に変更する
+        ballots = [(user, random.choice(choices)) for user in users]
+        ballots += [(user, random.choice(choices)) for user in random.sample(users, int(len(users) * options['change_ratio']))]
+        random.shuffle(ballots)
+
+        # スレッドから数えるのでitertools.countを使う（next()はGILの下で1回ずつ進む）
+        self.retries = itertools.count()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            list(executor.map(self.vote, ballots))
+        elapsed = time.perf_counter() - started
+
+        counted = dict(
+            Vote.objects.filter(choice__poll=poll).values('choice_id').annotate(total=Count('id')).values_list('choice_id', 'total')
+        )
+        mismatched = [
+            (choice.choice_text, choice.vote_count, counted.get(choice.id, 0))
+            for choice in poll.poll_choices.all()
+            if choice.vote_count != counted.get(choice.id, 0)
+        ]
+        total = sum(choice.vote_count for choice in poll.poll_choices.all())
+
+        self.stdout.write(
+            f"ballots={len(ballots)} votes={total} threads={options['threads']} "
+            f"{len(ballots) / elapsed:.0f} ballots/s retries={next(self.retries)}"
+        )
+        if mismatched or total != len(users):
+            raise CommandError(f'投票数が一致しません: {mismatched}')
+        self.stdout.write(self.style.SUCCESS('全ての選択肢の投票数が投票テーブルと一致しました'))
+
+    def vote(self, ballot):
+        user, choice = ballot
+        try:
+            while True:
+                try:
+                    return Vote.objects.cast_vote(user, choice)
+                except OperationalError:
+                    # SQLiteは書き込みが1つずつなので、ロック待ちがタイムアウトしたらやり直す
+                    next(self.retries)
+                    time.sleep(random.random() * 0.01)
+        finally:
+            connection.close()
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from polls.models import Choice
+
+
+class Command(BaseCommand):
+    help = '選択肢の投票数を投票テーブルと照合して修正する'
+
+    def handle(self, *args, **options):
+        repaired = Choice.objects.reconcile()
+        self.stdout.write(self.style.SUCCESS(f'{repaired}件の選択肢の投票数を修正しました'))
@@ -1,47 +1,164 @@
 from django.db import models
 from django.conf import settings
 import uuid
-from django.db.models import Sum
+from django.db import transaction
+from django.utils import timezone
+from sns.pagination import paginate_by_created_at
+from django.db.models import F, Count
 from django.core.exceptions import ValidationError
 
+MAX_CHOICES = 5
+MIN_CHOICES = 2
+
+
 class PollManager(models.Manager):
-    def create_poll(self, question, choices):
-        if len(choices) > 5:
+    def build_poll(self, question, choices, closes_at=None):
+        """
+        保存せずに投票と選択肢を組み立てて検証する（DBにはアクセスしない）
+
+        選択肢にはpositionを0から振る。選択肢数の上限はpositionの
+        CheckConstraintとUniqueConstraintでDBでも保証される。
+        """
+        if len(choices) > MAX_CHOICES:
             raise ValidationError('投票には最大5つまでの選択肢しか設定できません。')
-        if len(choices) < 2:
+        if len(choices) < MIN_CHOICES:
             raise ValidationError('投票には最低2つの選択肢が必要です。')
-        
-        poll = self.model(question=question)
-        poll.save()
-        for choice in choices:
-            Choice.objects.create(poll=poll, choice_text=choice)
+
+        poll = self.model(question=question, closes_at=closes_at)
+        poll.clean_fields()
+        choice_objects = []
+        for position, choice_text in enumerate(choices):
+            choice = Choice(poll=poll, choice_text=choice_text, position=position)
+            choice.clean_fields(exclude=['poll'])
+            choice_objects.append(choice)
+        return poll, choice_objects
+
+    def create_poll(self, question, choices, closes_at=None):
+        """投票と選択肢を1つのトランザクションで作成（選択肢は1回のINSERT）"""
+        poll, choice_objects = self.build_poll(question, choices, closes_at)
+        with transaction.atomic():
+            poll.save(force_insert=True)
+            Choice.objects.bulk_create(choice_objects)
         return poll
 
+    def bulk_create_polls(self, polls_data):
+        """
+        (question, choices, closes_at)のリストからまとめて投票を作成（CSVインポート用）
+
+        先に全件を検証し、1件でもエラーがあれば何も作成せずに
+        {行番号: エラー}を付けたValidationErrorを送出する。
+        作成は投票と選択肢それぞれ1回のINSERTで行う。
+        """
+        polls = []
+        choices = []
+        errors = {}
+        for index, (question, choice_texts, closes_at) in enumerate(polls_data):
+            try:
+                poll, choice_objects = self.build_poll(question, choice_texts, closes_at)
+            except ValidationError as e:
+                errors[index] = e.messages
+                continue
+            polls.append(poll)
+            choices.extend(choice_objects)
+
+        if errors:
+            raise ValidationError(errors)
+
+        with transaction.atomic():
+            self.bulk_create(polls)
+            Choice.objects.bulk_create(choices)
+        return polls
+
+    def get_poll_page(self, user, status=None, cursor=None, limit=20):
+        """
+        (created_at, id)のキーセットで新しい順に投票を取得
+
+        選択肢はprefetch_relatedでまとめて取得し、ユーザー自身の投票（my_choice_id）は
+        サブクエリでannotateするので、件数に関係なく2クエリで済む。
+        statusは'active'（受付中）か'closed'（締切済み）で絞り込む。
+        """
+        polls = self.get_queryset().annotate(
+            my_choice_id=models.Subquery(
+                Vote.objects.filter(user=user, choice__poll=models.OuterRef('pk')).values('choice_id')[:1]
+            )
+        ).prefetch_related('poll_choices')
+
+        now = timezone.now()
+        if status == 'active':
+            polls = polls.filter(models.Q(closes_at__isnull=True) | models.Q(closes_at__gt=now))
+        elif status == 'closed':
+            polls = polls.filter(closes_at__lte=now)
+
+        polls, has_next, next_cursor = paginate_by_created_at(polls, cursor, limit)
+        return {
+            'polls': polls,
+            'has_next': has_next,
+            'next_cursor': next_cursor,
+        }
+
 class Poll(models.Model):
     id = models.UUIDField(primary_key=True, editable=False, unique=True, default=uuid.uuid4)
     question = models.CharField(max_length=200)
+    # 締切（Noneなら締め切らない）
+    closes_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     objects = PollManager()
 
+    @property
+    def is_closed(self):
+        return self.closes_at is not None and self.closes_at <= timezone.now()
+
     def __str__(self):
         return self.question
 
+class ChoiceManager(models.Manager):
+    def adjust_vote_counts(self, deltas):
+        """{choice_id: 増減}で投票数をF()で更新（数え直さないので同時投票でも取りこぼさない）"""
+        # 票の移動が逆向きに同時に起きてもデッドロックしないように常に同じ順で更新する
+        for choice_id, delta in sorted(deltas.items(), key=lambda item: str(item[0])):
+            if choice_id is not None and delta:
+                self.filter(pk=choice_id).update(vote_count=F('vote_count') + delta)
+
+    def reconcile(self):
+        """投票テーブルから数え直してずれているvote_countを修正し、修正件数を返す"""
+        totals = dict(Vote.objects.values('choice_id').annotate(total=Count('id')).values_list('choice_id', 'total'))
+        repaired = 0
+        for choice_id, vote_count in self.values_list('id', 'vote_count'):
+            expected = totals.get(choice_id, 0)
+            if vote_count != expected:
+                self.filter(pk=choice_id).update(vote_count=expected)
+                repaired += 1
+        return repaired
+
 class Choice(models.Model):
     id = models.UUIDField(primary_key=True, editable=False, unique=True, default=uuid.uuid4)
     poll = models.ForeignKey(Poll, on_delete=models.CASCADE, related_name='poll_choices')
     choice_text = models.CharField(max_length=200)
+    # 投票内での表示順（0〜MAX_CHOICES-1）。投票ごとに一意なので選択肢数の上限にもなる
+    position = models.PositiveSmallIntegerField(editable=False)
     vote_count = models.IntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ChoiceManager()
+
+    class Meta:
+        ordering = ('position',)
+        constraints = [
+            models.UniqueConstraint(fields=('poll', 'position'), name='unique_choice_position_per_poll'),
+            models.CheckConstraint(check=models.Q(position__lt=MAX_CHOICES), name='choice_position_lt_max_choices'),
+        ]
+
     def save(self, *args, **kwargs):
-        # 新規作成の場合のみチェック
-        if not self.pk:
-            existing_choices_count = Choice.objects.filter(poll=self.poll).count()
-            if existing_choices_count >= 5:
+        # 管理画面などから1つずつ追加する場合は空いているpositionを使う
+        if self.position is None:
+            used = set(Choice.objects.filter(poll=self.poll).values_list('position', flat=True))
+            free = [position for position in range(MAX_CHOICES) if position not in used]
+            if not free:
                 raise ValidationError(f'投票「{self.poll.question}」には既に5つの選択肢があります。これ以上追加できません。')
+            self.position = free[0]
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -51,6 +168,28 @@ class Choice(models.Model):
 class VoteManager(models.Manager):
     def get_total_vote_count(self, choice):
         return self.filter(choice=choice).count()
+
+    def cast_vote(self, user, choice):
+        """
+        投票する（同じ投票で既に投票していれば選択肢を変更する）
+
+        投票の保存と選択肢の投票数の増減（シグナル）を1つのトランザクションで行う。
+        """
+        with transaction.atomic():
+            if transaction.get_connection().features.has_select_for_update:
+                # 同じ投票への投票を投票の行ロックで直列化する
+                # （初回の投票どうしは下のUPDATEが0行になり、行ロックを取れないため）
+                Poll.objects.select_for_update().only('id').get(pk=choice.poll_id)
+            # SQLiteでは最初に既存の投票をUPDATEしてデータベースの書き込みロックを取る。
+            # SELECTから始めると書き込みへの昇格がロック待ちせずに失敗する
+            touched = self.filter(user=user, choice__poll_id=choice.poll_id).update(updated_at=timezone.now())
+            if not touched:
+                return self.create(user=user, choice=choice)
+            vote = self.get(user=user, choice__poll_id=choice.poll_id)
+            if vote.choice_id != choice.id:
+                vote.choice = choice
+                vote.save()
+            return vote
     
 class Vote(models.Model):
     id = models.UUIDField(primary_key=True, editable=False, unique=True, default=uuid.uuid4)
@@ -1,5 +1,5 @@
 from ninja import Schema
-from typing import List
+from typing import List, Optional
 import uuid
 from datetime import datetime
 
@@ -17,12 +17,27 @@ class PollSchema(Schema):
     id: uuid.UUID
     question: str
     choices: List[ChoiceSchema]
+    closes_at: Optional[datetime] = None
     created_at: datetime
     updated_at: datetime
 
+class PollListItemSchema(PollSchema):
+    is_closed: bool
+    my_choice_id: Optional[uuid.UUID] = None  # ログインユーザーが投票した選択肢
+
+class PollPageSchema(Schema):
+    polls: List[PollListItemSchema]
+    has_next: bool
+    next_cursor: Optional[str] = None
+
 class CreatePollSchema(Schema):
     question: str
     choices: List[str]  # 選択肢のテキストのリスト
+    closes_at: Optional[datetime] = None
+
+class PollImportResultSchema(Schema):
+    created: int
+    poll_ids: List[uuid.UUID]
 
 class VoteSchema(Schema):
     id: uuid.UUID
@@ -1,19 +1,47 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from .models import Poll, Choice, Vote
+from .live import publish_vote_deltas
+
+
+def apply_vote_deltas(vote, deltas):
+    """選択肢の投票数を増減し、投票結果を購読しているクライアントにも送る"""
+    Choice.objects.adjust_vote_counts(deltas)
+
+    poll_ids = {}
+    if Vote.choice.is_cached(vote):
+        poll_ids[vote.choice_id] = vote.choice.poll_id
+    missing = [choice_id for choice_id in deltas if choice_id not in poll_ids]
+    if missing:
+        poll_ids.update(Choice.objects.filter(pk__in=missing).values_list('id', 'poll_id'))
+
+    deltas_by_poll = {}
+    for choice_id, delta in deltas.items():
+        if choice_id in poll_ids:
+            deltas_by_poll.setdefault(poll_ids[choice_id], {})[choice_id] = delta
+    for poll_id, poll_deltas in deltas_by_poll.items():
+        publish_vote_deltas(poll_id, poll_deltas)
+
+
+@receiver(post_init, sender=Vote)
+def remember_vote_choice(sender, instance, **kwargs):
+    """票の移動を検出できるように読み込んだ時の選択肢を覚えておく"""
+    # 遅延読み込みのフィールドにアクセスするとクエリが走るので__dict__から読む
+    instance._saved_choice_id = instance.__dict__.get('choice_id')
+
 
-# fuck this fucking signal, i don't think this works well
-# lucky if this works
 @receiver(post_save, sender=Vote)
 def update_vote_count_on_save(sender, instance, created, **kwargs):
-    """投票が作成または更新された時に選択肢の投票数を更新"""
-    choice = instance.choice
-    choice.vote_count = choice.choice_votes.count()
-    choice.save()
+    """投票が作成または変更された時に選択肢の投票数を増減"""
+    if created:
+        apply_vote_deltas(instance, {instance.choice_id: 1})
+    elif instance._saved_choice_id != instance.choice_id:
+        # 変更前の選択肢から1票減らし、変更後の選択肢に1票足す
+        apply_vote_deltas(instance, {instance._saved_choice_id: -1, instance.choice_id: 1})
+    instance._saved_choice_id = instance.choice_id
+
 
 @receiver(post_delete, sender=Vote)
 def update_vote_count_on_delete(sender, instance, **kwargs):
-    """投票が削除された時に選択肢の投票数を更新"""
-    choice = instance.choice
-    choice.vote_count = choice.choice_votes.count()
-    choice.save()
\ No newline at end of file
+    """投票が削除された時に選択肢の投票数を減らす"""
+    apply_vote_deltas(instance, {instance._saved_choice_id or instance.choice_id: -1})
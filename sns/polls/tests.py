@@ -1,3 +1,258 @@
-from django.test import TestCase
+import csv
+import threading
+import time
+from datetime import timedelta
+from unittest.mock import AsyncMock, patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from ninja_jwt.tokens import AccessToken
+
+from users.models import User
+from .live import get_poll_group_name, merge_tally_events, tally_queue
+from .models import MAX_CHOICES, Choice, Poll, Vote
+
+
+class PollListQueryCountTests(TestCase):
+    """投票一覧のクエリ数が投票の件数に比例しないことを確認"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'password')
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def create_polls(self, count, closes_at=None):
+        polls = [Poll.objects.create_poll(f'poll{i}', ['A', 'B', 'C'], closes_at=closes_at) for i in range(count)]
+        for poll in polls:
+            Vote.objects.cast_vote(self.user, poll.poll_choices.first())
+        return polls
+
+    def test_query_count_is_constant(self):
+        self.create_polls(1)
+        # 認証のユーザー取得 + 投票 + 選択肢
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/polls/', **self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        self.create_polls(15)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/polls/', **self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        polls = response.json()['polls']
+        self.assertEqual(len(polls), 16)
+        for poll in polls:
+            self.assertEqual(len(poll['choices']), 3)
+            self.assertIn(poll['my_choice_id'], [choice['id'] for choice in poll['choices']])
+
+    def test_status_filter_and_pagination(self):
+        self.create_polls(3)
+        closed = self.create_polls(2, closes_at=timezone.now() - timedelta(minutes=1))
+
+        response = self.client.get('/api/polls/', {'status': 'closed'}, **self.headers)
+        self.assertEqual({poll['id'] for poll in response.json()['polls']}, {str(poll.id) for poll in closed})
+
+        ids = []
+        cursor = None
+        while True:
+            params = {'status': 'active', 'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            page = self.client.get('/api/polls/', params, **self.headers).json()
+            ids += [poll['id'] for poll in page['polls']]
+            cursor = page['next_cursor']
+            if not page['has_next']:
+                break
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(len(set(ids)), 3)
+
+
+class VoteCountTests(TestCase):
+    """投票・票の移動・取り消しで選択肢の投票数が増減することを確認"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'password')
+        self.poll = Poll.objects.create_poll('poll', ['A', 'B'])
+        self.a, self.b = self.poll.poll_choices.order_by('position')
+
+    def assertVoteCounts(self, a, b):
+        self.assertEqual(
+            list(self.poll.poll_choices.order_by('position').values_list('vote_count', flat=True)), [a, b]
+        )
+
+    def test_vote_move_and_delete(self):
+        vote = Vote.objects.cast_vote(self.user, self.a)
+        self.assertVoteCounts(1, 0)
+
+        # 別の選択肢に変更すると元の選択肢から1票減る
+        Vote.objects.cast_vote(self.user, self.b)
+        self.assertVoteCounts(0, 1)
+        self.assertEqual(Vote.objects.filter(user=self.user).count(), 1)
+
+        # 同じ選択肢にもう一度投票しても変わらない
+        Vote.objects.cast_vote(self.user, self.b)
+        self.assertVoteCounts(0, 1)
+
+        Vote.objects.get(pk=vote.pk).delete()
+        self.assertVoteCounts(0, 0)
+
+    def test_reconcile_repairs_drifted_counts(self):
+        Vote.objects.cast_vote(self.user, self.a)
+        Choice.objects.filter(pk=self.a.pk).update(vote_count=5)
+        Choice.objects.filter(pk=self.b.pk).update(vote_count=-1)
+
+        self.assertEqual(Choice.objects.reconcile(), 2)
+        self.assertVoteCounts(1, 0)
+        self.assertEqual(Choice.objects.reconcile(), 0)
+
+
+class CreatePollTests(TestCase):
+    """投票の作成・選択肢の位置の制約・CSVインポート"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'password')
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def test_create_poll_inserts_poll_and_choices_once_each(self):
+        with CaptureQueriesContext(connection) as queries:
+            poll = Poll.objects.create_poll('poll', ['A', 'B', 'C', 'D', 'E'])
+        inserts = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(list(poll.poll_choices.values_list('choice_text', 'position')), [
+            ('A', 0), ('B', 1), ('C', 2), ('D', 3), ('E', 4),
+        ])
+
+    def test_choice_position_constraints(self):
+        poll = Poll.objects.create_poll('poll', ['A', 'B', 'C', 'D', 'E'])
+
+        # 同じ位置の選択肢
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Choice.objects.bulk_create([Choice(poll=poll, choice_text='F', position=0)])
+        # 6つ目の選択肢（位置がMAX_CHOICES以上）
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Choice.objects.bulk_create([Choice(poll=poll, choice_text='F', position=MAX_CHOICES)])
+        # 管理画面などから1つずつ追加する場合は空きがないと検証エラー
+        with self.assertRaises(ValidationError):
+            Choice.objects.create(poll=poll, choice_text='F')
+        self.assertEqual(poll.poll_choices.count(), MAX_CHOICES)
+
+    def import_csv(self, text):
+        file = SimpleUploadedFile('polls.csv', text.encode('utf-8'), content_type='text/csv')
+        return self.client.post('/api/polls/import', {'file': file}, **self.headers)
+
+    def test_csv_import_is_all_or_nothing(self):
+        response = self.import_csv(
+            'question,closes_at,choice1,choice2,choice3\n'
+            'q1,,A,B,\n'
+            'q2,,A,,\n'
+            'q3,2030-01-01T00:00:00,A,B,C\n'
+        )
+        self.assertEqual(response.status_code, 400)
+        # 選択肢が1つしかない3行目のエラー
+        self.assertIn('3行目', response.json()['detail'])
+        self.assertFalse(Poll.objects.exists())
+
+        response = self.import_csv('question,closes_at,choice1,choice2\nq1,,A,B\nq2,,C,D\n')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual(Choice.objects.count(), 4)
+
+    def test_csv_import_rejects_malformed_csv(self):
+        oversized = 'x' * (csv.field_size_limit() + 1)
+        response = self.import_csv(f'question,choice1,choice2\nq1,A,{oversized}\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('CSVの形式が正しくありません', response.json()['detail'])
+        self.assertFalse(Poll.objects.exists())
+
+
+class VoteTallyBroadcastTests(TransactionTestCase):
+    """投票数の変化は投票ごとではなくTALLY_INTERVALごとに合算して1回送る"""
+
+    def wait_for_group_send(self, group_send, timeout=3):
+        deadline = time.monotonic() + timeout
+        while not group_send.await_count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_votes_within_one_tick_are_merged(self):
+        users = [User.objects.create_user(f'student{i}', 'password') for i in range(3)]
+        poll = Poll.objects.create_poll('poll', ['A', 'B', 'C'])
+        a, b, c = poll.poll_choices.order_by('position')
+
+        group_send = AsyncMock()
+        with patch.object(get_channel_layer(), 'group_send', group_send), \
+                patch.object(tally_queue, 'flush_interval', 0.5):
+            Vote.objects.cast_vote(users[0], a)
+            Vote.objects.cast_vote(users[1], a)
+            Vote.objects.cast_vote(users[2], b)
+            # 票の移動は元の選択肢の-1と移動先の+1
+            Vote.objects.cast_vote(users[0], b)
+
+            self.wait_for_group_send(group_send)
+            # 次のtickに残っているイベントがないことも確認する
+            time.sleep(tally_queue.flush_interval * 2)
+
+        group_send.assert_awaited_once()
+        group, event = group_send.await_args.args
+        self.assertEqual(group, get_poll_group_name(poll.id))
+        self.assertEqual(event, {
+            'type': 'poll_tally',
+            'poll_id': str(poll.id),
+            'deltas': {str(a.id): 1, str(b.id): 2},
+            'counts': {str(a.id): 1, str(b.id): 2, str(c.id): 0},
+        })
+
+    def test_cancelled_out_deltas_are_not_sent(self):
+        events = [
+            {'type': 'poll_tally', 'poll_id': 'p', 'deltas': {'a': 1}},
+            {'type': 'poll_tally', 'poll_id': 'p', 'deltas': {'a': -1}},
+        ]
+        self.assertEqual(async_to_sync(merge_tally_events)(events), [])
+
+
+class ConcurrentVoteTests(TransactionTestCase):
+    """同じユーザーの初回投票が同時に来ても投票は1件だけになることを確認"""
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # インメモリのSQLiteは共有キャッシュなので、書き込みが重なるとロック待ちせずにエラーになる
+            self.skipTest('ファイルのSQLiteかPostgreSQLのテストDBで実行する')
+
+    def cast_votes_concurrently(self, user, choices):
+        barrier = threading.Barrier(len(choices))
+        errors = []
+
+        def vote(choice):
+            try:
+                barrier.wait()
+                Vote.objects.cast_vote(user, choice)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=vote, args=(choice,)) for choice in choices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_first_votes_from_same_user(self):
+        user = User.objects.create_user('student', 'password')
+        poll = Poll.objects.create_poll('poll', ['A', 'B'])
+        choices = list(poll.poll_choices.order_by('position'))
+
+        errors = self.cast_votes_concurrently(user, choices)
+
+        self.assertEqual(errors, [])
+        votes = Vote.objects.filter(user=user, choice__poll=poll)
+        self.assertEqual(votes.count(), 1)
+        # 投票数の集計も1票だけ
+        self.assertEqual(
+            sum(poll.poll_choices.values_list('vote_count', flat=True)), 1
+        )
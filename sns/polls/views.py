@@ -1,16 +1,33 @@
 from django.shortcuts import render, get_object_or_404
 from .models import Poll, Choice, Vote
-from .schemas import PollSchema, CreatePollSchema, VoteSchema, ChoiceSchema
+from .schemas import PollSchema, PollListItemSchema, PollPageSchema, PollImportResultSchema, CreatePollSchema, VoteSchema, ChoiceSchema
 from ninja import Router
+from ninja.files import UploadedFile
+from django.core.exceptions import ValidationError
+from .csv_import import import_polls_from_csv
 from ninja_jwt.authentication import JWTAuth
-from typing import List
+from sns.pagination import InvalidCursor
 
 router = Router(tags=["polls"])
 
+def validation_error_message(error):
+    """ValidationErrorを1つのメッセージにまとめる（CSVの行ごとのエラーには「n行目: 」を付ける）"""
+    if not hasattr(error, 'error_dict'):
+        return ' / '.join(error.messages)
+    return ' / '.join(
+        f'{f"{key}行目" if isinstance(key, int) else key}: {message}'
+        for key, messages in error.message_dict.items()
+        for message in messages
+    )
+
 @router.post("/create", response=PollSchema, auth=JWTAuth())
 def create_poll(request, poll_data: CreatePollSchema):
     """新しい投票を作成"""
-    poll = Poll.objects.create_poll(poll_data.question, poll_data.choices)
+    from ninja.errors import HttpError
+    try:
+        poll = Poll.objects.create_poll(poll_data.question, poll_data.choices, closes_at=poll_data.closes_at)
+    except ValidationError as e:
+        raise HttpError(400, validation_error_message(e))
     return PollSchema(
         id=poll.id,
         question=poll.question,
@@ -21,29 +38,66 @@ def create_poll(request, poll_data: CreatePollSchema):
                 vote_count=choice.vote_count
             ) for choice in poll.poll_choices.all()
         ],
+        closes_at=poll.closes_at,
         created_at=poll.created_at,
         updated_at=poll.updated_at
     )
 
-@router.get("/", response=List[PollSchema])
-def get_polls(request):
-    """すべての投票を取得"""
-    polls = Poll.objects.all()
-    return [
-        PollSchema(
-            id=poll.id,
-            question=poll.question,
-            choices=[
-                ChoiceSchema(
-                    id=choice.id,
-                    choice_text=choice.choice_text,
-                    vote_count=choice.vote_count
-                ) for choice in poll.poll_choices.all()
-            ],
-            created_at=poll.created_at,
-            updated_at=poll.updated_at
-        ) for poll in polls
-    ]
+@router.post("/import", response=PollImportResultSchema, auth=JWTAuth())
+def import_polls(request, file: UploadedFile):
+    """
+    CSVから投票をまとめて作成
+
+    ヘッダー: question,closes_at,choice1,choice2,choice3,choice4,choice5
+    （closes_atと使わない選択肢の列は空でよい）
+    """
+    from ninja.errors import HttpError
+    try:
+        polls = import_polls_from_csv(file)
+    except ValidationError as e:
+        raise HttpError(400, validation_error_message(e))
+
+    return {
+        'created': len(polls),
+        'poll_ids': [poll.id for poll in polls],
+    }
+
+@router.get("/", response=PollPageSchema, auth=JWTAuth())
+def get_polls(request, status: str = None, cursor: str = None, limit: int = 20):
+    """投票を新しい順にカーソルページネーションで取得（statusはactive/closed）"""
+    from ninja.errors import HttpError
+    if status not in (None, 'active', 'closed'):
+        raise HttpError(400, "statusはactiveかclosedを指定してください")
+    if limit < 1 or limit > 100:
+        raise HttpError(400, "limitは1から100の間で指定してください")
+
+    try:
+        page = Poll.objects.get_poll_page(request.user, status=status, cursor=cursor, limit=limit)
+    except InvalidCursor:
+        raise HttpError(400, "カーソルの形式が正しくありません")
+
+    return {
+        'polls': [
+            PollListItemSchema(
+                id=poll.id,
+                question=poll.question,
+                choices=[
+                    ChoiceSchema(
+                        id=choice.id,
+                        choice_text=choice.choice_text,
+                        vote_count=choice.vote_count
+                    ) for choice in poll.poll_choices.all()
+                ],
+                closes_at=poll.closes_at,
+                is_closed=poll.is_closed,
+                my_choice_id=poll.my_choice_id,
+                created_at=poll.created_at,
+                updated_at=poll.updated_at
+            ) for poll in page['polls']
+        ],
+        'has_next': page['has_next'],
+        'next_cursor': page['next_cursor'],
+    }
 
 @router.get("/{poll_id}", response=PollSchema)
 def get_poll(request, poll_id: str):
@@ -59,62 +113,46 @@ def get_poll(request, poll_id: str):
                 vote_count=choice.vote_count
             ) for choice in poll.poll_choices.all()
         ],
+        closes_at=poll.closes_at,
         created_at=poll.created_at,
         updated_at=poll.updated_at
     )
 
+def ensure_poll_open(poll):
+    """締め切られた投票には投票できない"""
+    if poll.is_closed:
+        from ninja.errors import HttpError
+        raise HttpError(400, "この投票は締め切られています")
+
 @router.post("/{poll_id}/vote", response=VoteSchema, auth=JWTAuth())
 def vote(request, poll_id: str, choice_id: str):
     """投票する"""
     poll = get_object_or_404(Poll, id=poll_id)
     choice = get_object_or_404(Choice, id=choice_id, poll=poll)
+    ensure_poll_open(poll)
     
-    # 同じ投票内での既存の投票をチェック
-    existing_vote = Vote.objects.filter(
-        user=request.user, 
-        choice__poll=poll
-    ).first()
-    
-    if existing_vote:
-        # 既存の投票を更新
-        existing_vote.choice = choice
-        existing_vote.save()
-        vote_obj = existing_vote
-    else:
-        # 新しい投票を作成
-        vote_obj = Vote.objects.create(user=request.user, choice=choice)
+    # 同じ投票内で既に投票していれば選択肢を変更する
+    vote_obj = Vote.objects.cast_vote(request.user, choice)
     
     return VoteSchema(
         id=vote_obj.id,
-        choice_id=vote_obj.choice.id,
-        user_id=vote_obj.user.id,
+        choice_id=vote_obj.choice_id,
+        user_id=vote_obj.user_id,
         created_at=vote_obj.created_at
     )
 
 @router.post("/vote/{choice_id}", response=VoteSchema, auth=JWTAuth())
 def vote_by_choice(request, choice_id: str):
     """選択肢IDで直接投票する（よりシンプルなAPI）"""
-    choice = get_object_or_404(Choice, id=choice_id)
-    poll = choice.poll
-    
-    # 同じ投票内での既存の投票をチェック
-    existing_vote = Vote.objects.filter(
-        user=request.user, 
-        choice__poll=poll
-    ).first()
+    choice = get_object_or_404(Choice.objects.select_related('poll'), id=choice_id)
+    ensure_poll_open(choice.poll)
     
-    if existing_vote:
-        # 既存の投票を更新
-        existing_vote.choice = choice
-        existing_vote.save()
-        vote_obj = existing_vote
-    else:
-        # 新しい投票を作成
-        vote_obj = Vote.objects.create(user=request.user, choice=choice)
+    # 同じ投票内で既に投票していれば選択肢を変更する
+    vote_obj = Vote.objects.cast_vote(request.user, choice)
     
     return VoteSchema(
         id=vote_obj.id,
-        choice_id=vote_obj.choice.id,
-        user_id=vote_obj.user.id,
+        choice_id=vote_obj.choice_id,
+        user_id=vote_obj.user_id,
         created_at=vote_obj.created_at
     )
\ No newline at end of file
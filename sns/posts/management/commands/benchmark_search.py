@@ -0,0 +1,81 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from posts.models import Post
+
+User = get_user_model()
+
+WORDS = [
+    '東京', 'タワー', 'ラーメン', '猫', 'カフェ', '映画', '旅行', 'サッカー', 'プログラミング', '天気',
+    '週末', '友達', '写真', '音楽', 'ライブ', '京都', '紅葉', '温泉', '新幹線', '読書',
+    'python', 'django', 'sqlite', 'coffee', 'weekend', 'music', 'travel', 'photo', 'game', 'code',
+]
+
+
+class Command(BaseCommand):
+    help = '投稿の検索を、icontainsによる部分一致と全文検索の索引で比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=100_000, help='シードする投稿数')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--queries', nargs='+', default=['ラーメン', '東京タワー', '猫', 'django', '紅葉の京都'])
+        parser.add_argument('--samples', type=int, default=20, help='検索語ごとの計測回数')
+        parser.add_argument('--skip-seed', action='store_true', help='既存データをそのまま使う')
+
+    def handle(self, *args, **options):
+        if not options['skip_seed']:
+            self.seed(options['posts'], options['batch_size'])
+
+        page_size = options['page_size']
+        self.stdout.write(f"{'query':>12} {'icontains p50':>14} {'icontains p99':>14} {'index p50':>12} {'index p99':>12}")
+
+        for query in options['queries']:
+            icontains = self.measure(options['samples'], lambda: list(
+                Post.objects.get_non_deleted_posts().filter(is_public=True)
+                .filter(Q(title__icontains=query) | Q(content__icontains=query))
+                .order_by('-created_at')[:page_size]
+            ))
+            index = self.measure(options['samples'], lambda: Post.objects.search_posts(query, limit=page_size))
+            self.stdout.write(
+                f'{query:>12} {icontains[0]:>12.2f}ms {icontains[1]:>12.2f}ms {index[0]:>10.2f}ms {index[1]:>10.2f}ms'
+            )
+
+    def seed(self, count, batch_size):
+        """bulk_createはシグナルを送らないので、索引にも同じバッチで入れる"""
+        user, _ = User.objects.get_or_create(username='benchmark_search_user')
+        existing = Post.objects.filter(user=user).count()
+        remaining = count - existing
+        self.stdout.write(f'{remaining}件の投稿をシードします')
+
+        rng = random.Random(0)
+        while remaining > 0:
+            size = min(batch_size, remaining)
+            posts = Post.objects.bulk_create(
+                [
+                    Post(
+                        user=user,
+                        title='の'.join(rng.sample(WORDS, 2)),
+                        content='、'.join(rng.sample(WORDS, 12)) + 'について書きました。',
+                    )
+                    for _ in range(size)
+                ],
+                batch_size=batch_size,
+            )
+            Post.objects.update_search_index(posts, created=True)
+            remaining -= size
+
+    def measure(self, samples, func):
+        timings = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        p99_index = min(len(timings) - 1, int(len(timings) * 0.99))
+        return statistics.median(timings), timings[p99_index]
@@ -0,0 +1,77 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from posts.models import Post
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'タイムラインのキーセットページネーションとOFFSETページネーションのレイテンシを比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=1_000_000, help='シードする投稿数')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--depths', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+        parser.add_argument('--samples', type=int, default=50, help='各深さでの計測回数')
+        parser.add_argument('--skip-seed', action='store_true', help='既存データをそのまま使う')
+
+    def handle(self, *args, **options):
+        if not options['skip_seed']:
+            self.seed(options['posts'], options['batch_size'])
+
+        page_size = options['page_size']
+        self.stdout.write(f"{'depth':>8} {'keyset p50':>12} {'keyset p99':>12} {'offset p50':>12} {'offset p99':>12}")
+
+        for depth in options['depths']:
+            cursor = self.walk_to_depth(depth, page_size)
+            if depth > 1 and cursor is None:
+                self.stdout.write(f'{depth:>8} データが足りません')
+                break
+
+            keyset = self.measure(options['samples'], lambda: Post.objects.get_timeline(cursor=cursor, limit=page_size))
+            offset_start = (depth - 1) * page_size
+            offset = self.measure(
+                options['samples'],
+                lambda: list(Post.objects.get_non_deleted_posts().order_by('-created_at', '-id')[offset_start:offset_start + page_size]),
+            )
+            self.stdout.write(
+                f'{depth:>8} {keyset[0]:>10.2f}ms {keyset[1]:>10.2f}ms {offset[0]:>10.2f}ms {offset[1]:>10.2f}ms'
+            )
+
+    def seed(self, count, batch_size):
+        user, _ = User.objects.get_or_create(username='benchmark_timeline_user')
+        existing = Post.objects.filter(user=user).count()
+        remaining = count - existing
+        self.stdout.write(f'{remaining}件の投稿をシードします')
+
+        while remaining > 0:
+            size = min(batch_size, remaining)
+            Post.objects.bulk_create(
+                [Post(user=user, title='benchmark', content='benchmark') for _ in range(size)],
+                batch_size=batch_size,
+            )
+            remaining -= size
+
+    def walk_to_depth(self, depth, page_size):
+        """指定ページの直前までカーソルを進める"""
+        cursor = None
+        for _ in range(depth - 1):
+            cursor = Post.objects.get_timeline(cursor=cursor, limit=page_size)['next_cursor']
+            if cursor is None:
+                return None
+        return cursor
+
+    def measure(self, samples, func):
+        timings = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        p99_index = min(len(timings) - 1, int(len(timings) * 0.99))
+        return statistics.median(timings), timings[p99_index]
@@ -0,0 +1,37 @@
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from posts.models import Post
+from sns.sampling import generate_random_key
+
+
+class Command(BaseCommand):
+    help = (
+        '投稿とユーザーのrandom_keyを振り直す（random_keyの列を追加した時点の既存行は'
+        'マイグレーションのデフォルト値で全て同じキーになっているので、追加後に1回実行する）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # 削除済みの投稿なども含めて全行を振り直す
+        for model in (Post, get_user_model()):
+            manager = model._base_manager
+            count = 0
+            ids = manager.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=batch_size)
+            while batch := list(islice(ids, batch_size)):
+                with transaction.atomic():
+                    manager.bulk_update(
+                        [model(pk=pk, random_key=generate_random_key()) for pk in batch], ['random_key']
+                    )
+                count += len(batch)
+            self.stdout.write(f'{model._meta.label}: {count}件のrandom_keyを振り直しました')
+
+        # 古いキーで作ったサンプルプールを使わないようにする
+        cache.delete_many(['posts:random_within_last_day', 'users:random'])
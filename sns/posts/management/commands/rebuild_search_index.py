@@ -0,0 +1,34 @@
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from circle.models import CircleMessage
+from posts.models import Post
+from sns.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = '投稿とサークルのメッセージから全文検索の索引を作り直す（bulk_createなどシグナルを通らずに保存したデータ用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.ensure_schema()
+
+        targets = (
+            (Post.objects, Post.objects.get_non_deleted_posts().filter(is_public=True)),
+            (CircleMessage.objects, CircleMessage.objects.filter(is_deleted=False)),
+        )
+        for manager, queryset in targets:
+            # 作り直している間も検索できるよう、1つのトランザクションで入れ替える
+            with transaction.atomic():
+                backend.clear(manager.SEARCH_DOC_TYPE)
+                count = 0
+                objects = queryset.order_by().iterator(chunk_size=options['batch_size'])
+                while batch := list(islice(objects, options['batch_size'])):
+                    manager.update_search_index(batch, created=True)
+                    count += len(batch)
+            self.stdout.write(f'{manager.SEARCH_DOC_TYPE}: {count}件を索引に入れました')
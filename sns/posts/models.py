@@ -3,6 +3,9 @@ import uuid
 from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
+from sns.pagination import paginate_by_created_at
+from sns.sampling import generate_random_key, get_random_sample
+from sns.search import SearchDocument, get_search_backend, get_search_page
 
 class PostManager(models.Manager):
     def get_queryset(self):
@@ -14,11 +17,34 @@ class PostManager(models.Manager):
     def get_posts_by_user(self, user):
         return self.get_queryset().filter(user=user)
 
-    def search_posts(self, query):
-        return self.get_queryset().filter(title__icontains=query)
+    SEARCH_DOC_TYPE = 'post'
+
+    def search_posts(self, query, cursor=None, limit=20, fields=('title', 'body')):
+        """全文検索の索引から公開中の投稿を関連度順に取得（タイトルは本文の2倍に重み付け）"""
+        page = get_search_page(
+            self.get_non_deleted_posts().filter(is_public=True),
+            self.SEARCH_DOC_TYPE, query, fields=fields, cursor=cursor, limit=limit,
+        )
+        return {
+            'posts': page['results'],
+            'has_next': page['has_next'],
+            'next_cursor': page['next_cursor'],
+        }
     
-    def search_posts_by_content(self, query):
-        return self.get_queryset().filter(content__icontains=query)
+    def search_posts_by_content(self, query, cursor=None, limit=20):
+        return self.search_posts(query, cursor=cursor, limit=limit, fields=('body',))
+
+    def update_search_index(self, posts, created=False):
+        """公開中の投稿を索引に入れ、削除済み・非公開の投稿は索引から外す（createdは全て新規作成した投稿の場合）"""
+        posts = list(posts)
+        backend = get_search_backend()
+        backend.index(self.SEARCH_DOC_TYPE, [
+            SearchDocument(post.id, None, post.title, post.content)
+            for post in posts if not post.is_deleted and post.is_public
+        ], replace=not created)
+        # 作成したばかりのものは索引に無いので外す必要もない
+        if not created:
+            backend.remove(self.SEARCH_DOC_TYPE, [post.id for post in posts if post.is_deleted or not post.is_public])
     
     def get_non_deleted_posts(self):
         return self.get_queryset().filter(is_deleted=False)
@@ -26,8 +52,21 @@ class PostManager(models.Manager):
     def get_new_posts(self, count=10):
         return self.get_non_deleted_posts().order_by('-created_at')[:count]
     
+    def get_timeline(self, cursor=None, limit=20):
+        """(created_at, id)のキーセットでタイムラインを取得（深いページでもOFFSETを使わない）"""
+        posts, has_next, next_cursor = paginate_by_created_at(self.get_non_deleted_posts(), cursor, limit)
+        return {
+            'posts': posts,
+            'has_next': has_next,
+            'next_cursor': next_cursor,
+        }
+
     def get_random_within_last_day(self, count=10):
-        return self.get_non_deleted_posts().filter(created_at__gte=timezone.now() - timedelta(days=1)).order_by('?')[:count]
+        since = timezone.now() - timedelta(days=1)
+        return get_random_sample(
+            self.get_non_deleted_posts().filter(created_at__gte=since), count,
+            cache_key='posts:random_within_last_day', window=('created_at', since),
+        )
     
     def post(self, user, title, content):
         post = self.model(user=user, title=title, content=content)
@@ -65,6 +104,8 @@ class Post(models.Model):
     deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
     is_deleted = models.BooleanField(default=False)
     is_public = models.BooleanField(default=True)
+    # ランダム取得用（ORDER BY ?の代わりにインデックスで位置を決める）
+    random_key = models.FloatField(default=generate_random_key, db_index=True, editable=False)
 
     def __str__(self):
         return self.title
@@ -75,6 +116,10 @@ class Post(models.Model):
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['created_at']),
+            # タイムラインのキーセットページネーション用
+            models.Index(fields=['is_deleted', '-created_at', '-id'], name='post_timeline_idx'),
+            # 期間で絞ったランダム取得でrandom_keyをたどる時に、範囲外の行をインデックスだけで読み飛ばす
+            models.Index(fields=['random_key', 'created_at', 'is_deleted'], name='post_random_window_idx'),
         ]
 
     def delete(self, *args, **kwargs):
@@ -1,6 +1,7 @@
 from ninja import Schema
 from datetime import datetime
 import uuid
+from typing import Optional
 
 class PostSchema(Schema):
     id: uuid.UUID
@@ -13,4 +14,18 @@ class PostSchema(Schema):
 
 class CreatePostSchema(Schema):
     title: str
-    content: str
\ No newline at end of file
+    content: str
+
+class PostTimelineSchema(Schema):
+    posts: list[PostSchema]
+    has_next: bool
+    next_cursor: Optional[str] = None
+
+class PostSearchResultSchema(PostSchema):
+    # 小さいほど関連度が高い
+    search_score: float
+
+class PostSearchPageSchema(Schema):
+    posts: list[PostSearchResultSchema]
+    has_next: bool
+    next_cursor: Optional[str] = None
@@ -0,0 +1,19 @@
+from django.db.models.signals import post_migrate, post_save, post_delete
+from django.dispatch import receiver
+from sns.search import ensure_search_schema, get_search_backend
+from .models import Post
+
+# 全文検索の索引のテーブル（投稿とサークルのメッセージで共用）はmigrateの後に作成する
+post_migrate.connect(ensure_search_schema, dispatch_uid='sns.search.ensure_search_schema')
+
+
+@receiver(post_save, sender=Post)
+def update_post_search_index(sender, instance, created, **kwargs):
+    """投稿の保存時に索引を更新（削除・非公開にした投稿は索引から外す）"""
+    Post.objects.update_search_index([instance], created=created)
+
+
+@receiver(post_delete, sender=Post)
+def remove_post_from_search_index(sender, instance, **kwargs):
+    """投稿がDBから削除された時に索引から外す"""
+    get_search_backend().remove(Post.objects.SEARCH_DOC_TYPE, [instance.pk])
@@ -1,3 +1,147 @@
+import base64
+import json
+import uuid
+
 from django.test import TestCase
+from django.utils import timezone
+
+from sns.search import InvalidSearchQuery, get_search_backend, parse_query, tokenize
+from users.models import User
+from .models import Post
+
+
+class TimelinePaginationTests(TestCase):
+    """タイムラインのキーセットページネーション"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'password')
+
+    def test_pages_through_posts_with_equal_created_at(self):
+        posts = [Post.objects.post(self.user, f'title{i}', 'content') for i in range(7)]
+        # 全件同じcreated_atにしてidだけで順序が決まるようにする
+        created_at = timezone.now()
+        Post.objects.filter(id__in=[post.id for post in posts]).update(created_at=created_at)
+
+        ids = []
+        cursor = None
+        while True:
+            params = {'limit': 3}
+            if cursor:
+                params['cursor'] = cursor
+            page = self.client.get('/api/posts/timeline', params).json()
+            ids += [post['id'] for post in page['posts']]
+            cursor = page['next_cursor']
+            if not page['has_next']:
+                break
+
+        expected = sorted((str(post.id) for post in posts), key=lambda post_id: post_id.replace('-', ''), reverse=True)
+        self.assertEqual(ids, expected)
+
+    def test_invalid_cursor_is_rejected(self):
+        for cursor in ('not-a-cursor', 'WyJ4Il0', 'WyJ4IiwieSJd'):
+            response = self.client.get('/api/posts/timeline', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+
+    def test_cursor_with_wrong_value_types_is_rejected(self):
+        pk = str(uuid.uuid4())
+        # 形式としては読めるが中身の型や値が正しくないカーソル
+        for values in (['2024-13-45T00:00:00', pk], [1, 2], ['2024-01-01T00:00:00', 5], [None, pk], ['2024-01-01T00:00:00', 'x']):
+            cursor = self.raw_cursor(values)
+            response = self.client.get('/api/posts/timeline', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, values)
+
+    def raw_cursor(self, values):
+        raw = json.dumps(values).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+class SearchTokenizeTests(TestCase):
+    """索引に入れる語と検索語の分割"""
+
+    def test_tokenize_splits_cjk_into_bigrams(self):
+        self.assertEqual(tokenize('東京タワー'), ['東京', '京タ', 'タワ', 'ワー', 'ー'])
+        # 英数字は単語ごと、全角・大文字は揃える
+        self.assertEqual(tokenize('Ｄｊａｎｇｏ 4.2と東京'), ['django', '4', '2', 'と東', '東京', '京'])
+
+    def test_parse_query(self):
+        self.assertEqual(parse_query('東京タワー'), [(['東京', '京タ', 'タワ', 'ワー'], False)])
+        self.assertEqual(parse_query('東 Djan'), [(['東'], True), (['djan'], True)])
+        with self.assertRaises(InvalidSearchQuery):
+            parse_query('・、 ！')
+
+
+class PostSearchTests(TestCase):
+    """投稿の全文検索"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'password')
+
+    def search(self, query, **params):
+        response = self.client.get('/api/posts/search', {'q': query, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def indexed(self, query):
+        return {uuid.UUID(str(doc_id)) for doc_id, _, _ in get_search_backend().search(Post.objects.SEARCH_DOC_TYPE, query)}
+
+    def test_results_equal_substring_matches(self):
+        texts = [
+            ('東京タワーに行った', '展望台から富士山が見えた'),
+            ('京都の寺', '東京から新幹線で京都へ'),
+            ('大阪', '東の空が明るい'),
+            ('タワーマンション', 'ワンルーム'),
+            ('日記', '今日は雨'),
+        ]
+        posts = [Post.objects.post(self.user, title, content) for title, content in texts]
+
+        for query in ('東京', '東', '京都', 'タワー', 'ワー', '富士山', '雨', '東京タワー', '名古屋'):
+            expected = {str(post.id) for post in posts if query in post.title or query in post.content}
+            found = {post['id'] for post in self.search(query)['posts']}
+            self.assertEqual(found, expected, query)
+
+    def test_title_is_weighted_above_body(self):
+        in_body = Post.objects.post(self.user, '日記', '今日は東京に行った')
+        in_title = Post.objects.post(self.user, '東京', '今日は出かけた')
+        self.assertEqual([post['id'] for post in self.search('東京')['posts']], [str(in_title.id), str(in_body.id)])
+
+    def test_private_and_deleted_posts_are_removed_from_index(self):
+        private = Post.objects.post(self.user, '東京', 'a')
+        deleted = Post.objects.post(self.user, '東京', 'b')
+        removed = Post.objects.post(self.user, '東京', 'c')
+        self.assertEqual(self.indexed('東京'), {private.id, deleted.id, removed.id})
+
+        private.private()
+        deleted.delete()
+        # DBからの削除（Post.deleteは論理削除なのでクエリセットから消す）
+        Post.objects.filter(id=removed.id).delete()
+        self.assertEqual(self.indexed('東京'), set())
+        self.assertEqual(self.search('東京')['posts'], [])
+
+        # 公開に戻すと索引にも戻る
+        private.public()
+        self.assertEqual(self.indexed('東京'), {private.id})
+
+    def test_pages_through_results_with_cursor(self):
+        posts = [Post.objects.post(self.user, f'東京{i}', '本文') for i in range(7)]
+
+        ids = []
+        cursor = None
+        while True:
+            params = {'limit': 3}
+            if cursor:
+                params['cursor'] = cursor
+            page = self.search('東京', **params)
+            ids += [post['id'] for post in page['posts']]
+            cursor = page['next_cursor']
+            if not page['has_next']:
+                break
+
+        self.assertEqual(ids, [post['id'] for post in self.search('東京', limit=100)['posts']])
+        self.assertEqual(sorted(ids), sorted(str(post.id) for post in posts))
 
-# Create your tests here.
+    def test_invalid_query_and_cursor_are_rejected(self):
+        self.assertEqual(self.client.get('/api/posts/search', {'q': '、'}).status_code, 400)
+        for values in ([None, 1], ['x', 1], [1]):
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+            response = self.client.get('/api/posts/search', {'q': '東京', 'cursor': cursor})
+            self.assertEqual(response.status_code, 400, values)
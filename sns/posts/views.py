@@ -1,8 +1,11 @@
 from .models import Post
 from ninja import Router
-from .schemas import PostSchema, CreatePostSchema
+from .schemas import PostSchema, CreatePostSchema, PostTimelineSchema, PostSearchPageSchema
 from typing import List
 from ninja_jwt.authentication import JWTAuth
+from ninja.errors import HttpError
+from sns.pagination import InvalidCursor
+from sns.search import InvalidSearchQuery
 
 router = Router(tags=['posts'])
 
@@ -11,6 +14,30 @@ def get_latest_posts(request):
     posts = Post.objects.get_new_posts(count=10)
     return posts
 
+@router.get('/timeline', response=PostTimelineSchema)
+def get_timeline(request, cursor: str = None, limit: int = 20):
+    """タイムラインをカーソルページネーションで取得"""
+    if limit < 1 or limit > 100:
+        raise HttpError(400, "limitは1から100の間で指定してください")
+    try:
+        return Post.objects.get_timeline(cursor=cursor, limit=limit)
+    except InvalidCursor:
+        raise HttpError(400, "カーソルの形式が正しくありません")
+
+@router.get('/search', response=PostSearchPageSchema)
+def search_posts(request, q: str, cursor: str = None, limit: int = 20):
+    """公開中の投稿を全文検索し、関連度の高い順にカーソルページネーションで取得"""
+    if limit < 1 or limit > 100:
+        raise HttpError(400, "limitは1から100の間で指定してください")
+    if len(q) > 100:
+        raise HttpError(400, "検索語は100文字以内で指定してください")
+    try:
+        return Post.objects.search_posts(q, cursor=cursor, limit=limit)
+    except InvalidSearchQuery:
+        raise HttpError(400, "検索語を指定してください")
+    except InvalidCursor:
+        raise HttpError(400, "カーソルの形式が正しくありません")
+
 @router.get('/random-within-last-day', response=List[PostSchema])
 def get_random_posts(request):
     posts = Post.objects.get_random_within_last_day(count=10)
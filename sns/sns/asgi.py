@@ -11,9 +11,11 @@ import os
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from django.urls import path
 from circle.consumers import CircleChatConsumer, CircleNotificationConsumer
+from chat.consumers import DirectMessageConsumer
+from polls.consumers import PollConsumer
+from sns.websocket_auth import JWTAuthMiddlewareStack
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sns.settings')
@@ -21,11 +23,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sns.settings')
 websocket_urlpatterns = [
     path('ws/circle/<circle_id>/chat/', CircleChatConsumer.as_asgi()),
     path('ws/circle/<circle_id>/notifications/', CircleNotificationConsumer.as_asgi()),
+    path('ws/chat/', DirectMessageConsumer.as_asgi()),
+    path('ws/polls/<poll_id>/', PollConsumer.as_asgi()),
 ]
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "websocket": JWTAuthMiddlewareStack(
         URLRouter(websocket_urlpatterns)
     ),
 })
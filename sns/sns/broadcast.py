@@ -0,0 +1,224 @@
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import SyncToAsync
+from channels.consumer import get_handler_name
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastQueue:
+    """
+    WebSocketグループへの送信を溜めて、まとめて送る送信キュー
+
+    - 送信はリクエストのスレッドではなくイベントループ上のワーカーで行う
+      （Daphne上ではメインのイベントループ、それ以外では専用スレッドのループ）
+    - flush_interval秒の間に同じグループに溜まったイベントは1回のgroup_sendにまとめる
+    - coalesceを渡すと、同じグループのイベントのリストをcoalesce(events)が返すイベントに
+      まとめ直してから送る（差分を合算するなど、途中のイベントが不要な場合に使う。
+      coalesceはコルーチン関数でもよい）
+    - キューの長さと送信までのレイテンシを記録する
+    """
+
+    def __init__(self, flush_interval=0.02, max_batch_size=100, latency_window=1000, coalesce=None):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.coalesce = coalesce
+        self._lock = threading.Lock()
+        # イベントループごとの未送信イベントと起床用のEvent
+        self._workers = {}
+        self._fallback_loop = None
+        self._latencies = deque(maxlen=latency_window)
+        self._stats = {
+            'enqueued': 0,
+            'sent_events': 0,
+            'sent_batches': 0,
+            'errors': 0,
+            'max_queue_depth': 0,
+        }
+
+    def enqueue(self, group, event):
+        """送信するイベントを追加（呼び出し元はブロックしない）"""
+        loop = self._get_loop()
+        with self._lock:
+            worker = self._workers.get(loop)
+            if worker is None:
+                worker = self._start_worker(loop)
+            pending, wakeup = worker
+            pending.append((group, event, time.perf_counter()))
+            self._stats['enqueued'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], self._queue_depth())
+        loop.call_soon_threadsafe(wakeup.set)
+
+    def get_metrics(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = dict(self._stats)
+            metrics['queue_depth'] = self._queue_depth()
+        if latencies:
+            metrics['send_latency_ms'] = {
+                'p50': latencies[len(latencies) // 2],
+                'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+                'max': latencies[-1],
+            }
+        else:
+            metrics['send_latency_ms'] = None
+        return metrics
+
+    def _queue_depth(self):
+        return sum(len(pending) for pending, _ in self._workers.values())
+
+    def _get_loop(self):
+        """
+        送信に使うイベントループを選ぶ
+
+        InMemoryChannelLayerはループをまたいで使えないので、
+        コンシューマーと同じASGIサーバーのループがあればそれを使う。
+        """
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+        if loop is not None and loop.is_running():
+            return loop
+
+        # manage.pyのコマンドなどASGIサーバーの外では専用スレッドのループで送る
+        with self._lock:
+            if self._fallback_loop is None:
+                self._fallback_loop = asyncio.new_event_loop()
+                threading.Thread(target=self._fallback_loop.run_forever, name='broadcast-queue', daemon=True).start()
+            return self._fallback_loop
+
+    def _start_worker(self, loop):
+        # 止まったループのワーカーは捨てる
+        for stale in [stale for stale in self._workers if stale.is_closed()]:
+            del self._workers[stale]
+
+        worker = (deque(), asyncio.Event())
+        self._workers[loop] = worker
+        # 最初にenqueueしたスレッドのcontextvars（database_sync_to_asyncの中など）を
+        # ワーカーが引き継がないように空のコンテキストで起動する
+        contextvars.Context().run(asyncio.run_coroutine_threadsafe, self._worker(loop, *worker), loop)
+        return worker
+
+    def _drain(self, pending):
+        with self._lock:
+            items = list(pending)
+            pending.clear()
+        return items
+
+    async def _worker(self, loop, pending, wakeup):
+        try:
+            while True:
+                await wakeup.wait()
+                wakeup.clear()
+                # flush_intervalの間に来たイベントをまとめて送る
+                await asyncio.sleep(self.flush_interval)
+                items = self._drain(pending)
+                if items:
+                    await self._send(items)
+        finally:
+            with self._lock:
+                if self._workers.get(loop, (None,))[0] is pending:
+                    del self._workers[loop]
+
+    async def _send(self, items):
+        channel_layer = get_channel_layer()
+        grouped = {}
+        for group, event, enqueued_at in items:
+            grouped.setdefault(group, []).append((event, enqueued_at))
+
+        for group, entries in grouped.items():
+            if self.coalesce is not None:
+                try:
+                    events = self.coalesce([event for event, _ in entries])
+                    if inspect.isawaitable(events):
+                        events = await events
+                except Exception:
+                    logger.exception('送信するイベントをまとめられませんでした: %s', group)
+                    with self._lock:
+                        self._stats['errors'] += 1
+                    continue
+                if not events:
+                    continue
+                # レイテンシはまとめる前の各イベントについて記録する
+                chunks = [(events, entries)]
+            else:
+                chunks = []
+                for start in range(0, len(entries), self.max_batch_size):
+                    chunk = entries[start:start + self.max_batch_size]
+                    chunks.append(([event for event, _ in chunk], chunk))
+
+            for events, chunk in chunks:
+                message = events[0] if len(events) == 1 else {'type': 'broadcast_batch', 'events': events}
+                try:
+                    await channel_layer.group_send(group, message)
+                except Exception:
+                    logger.exception('WebSocketへの送信に失敗しました: %s', group)
+                    with self._lock:
+                        self._stats['errors'] += 1
+                    continue
+
+                now = time.perf_counter()
+                with self._lock:
+                    self._stats['sent_events'] += len(chunk)
+                    self._stats['sent_batches'] += 1
+                    self._latencies.extend((now - enqueued_at) * 1000 for _, enqueued_at in chunk)
+
+
+broadcast_queue = BroadcastQueue()
+
+
+def broadcast_on_commit(group, event):
+    """トランザクションがコミットされた後に送信キューへ追加（ロールバック時は送らない）"""
+    transaction.on_commit(lambda: broadcast_queue.enqueue(group, event))
+
+
+class BroadcastBatchMixin:
+    """まとめて届いたイベントを各ハンドラーで処理し、クライアントへは1フレームで送るコンシューマー用Mixin"""
+
+    async def broadcast_batch(self, event):
+        frames = []
+        self._batch_frames = frames
+        try:
+            for inner_event in event['events']:
+                handler = getattr(self, get_handler_name(inner_event), None)
+                if handler is not None:
+                    await handler(inner_event)
+        finally:
+            del self._batch_frames
+
+        await self._send_frames(frames)
+
+    async def _send_frames(self, frames):
+        if len(frames) == 1:
+            await super().send(text_data=frames[0])
+        elif frames:
+            await super().send(text_data=json.dumps({
+                'type': 'batch',
+                'events': [json.loads(frame) for frame in frames],
+            }))
+        frames.clear()
+
+    async def close(self, code=None, reason=None):
+        # まとめている途中のフレームは閉じる前に送る
+        frames = getattr(self, '_batch_frames', None)
+        if frames:
+            await self._send_frames(frames)
+        await super().close(code=code, reason=reason)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        frames = getattr(self, '_batch_frames', None)
+        if frames is not None and text_data is not None and not close:
+            frames.append(text_data)
+            return
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import sqlite3
+import string
+import random
+import threading
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    SQLiteファイルを共有するチャネルレイヤー
+
+    Redisを用意せずに複数のDaphneワーカー間の配信を確認するためのローカル用。
+    メッセージはポーリングで受信するので本番ではRedisを使うこと。
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, poll_interval=0.01):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._setup()
+
+    # 接続とテーブル
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _setup(self):
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS channel_messages ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, expires REAL NOT NULL, body TEXT NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS channel_messages_channel ON channel_messages (channel, id)')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS channel_groups ('
+            'group_name TEXT NOT NULL, channel TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (group_name, channel))'
+        )
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    # チャネル
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+        await self._run(self._send_many, [channel], json.dumps(message))
+
+    def _send_many(self, channels, body, ignore_full=False):
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM channel_messages WHERE expires < ?', (now,))
+            for channel in channels:
+                queued = connection.execute(
+                    'SELECT COUNT(*) FROM channel_messages WHERE channel = ?', (channel,)
+                ).fetchone()[0]
+                if queued >= self.get_capacity(channel):
+                    if ignore_full:
+                        continue
+                    raise ChannelFull(channel)
+                connection.execute(
+                    'INSERT INTO channel_messages (channel, expires, body) VALUES (?, ?, ?)',
+                    (channel, now + self.expiry, body),
+                )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        while True:
+            body = await self._run(self._pop, channel)
+            if body is not None:
+                return json.loads(body)
+            await asyncio.sleep(self.poll_interval)
+
+    def _pop(self, channel):
+        connection = self._connection()
+        select = 'SELECT id, body FROM channel_messages WHERE channel = ? AND expires >= ? ORDER BY id LIMIT 1'
+        # 空振りのポーリングで書き込みロックを取らないよう、まずロックなしで確認する（WALなので送信側を待たせない）
+        if connection.execute(select, (channel, time.time())).fetchone() is None:
+            return None
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(select, (channel, time.time())).fetchone()
+            if row is not None:
+                connection.execute('DELETE FROM channel_messages WHERE id = ?', (row[0],))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return row[1] if row is not None else None
+
+    async def new_channel(self, prefix='specific.'):
+        suffix = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        return f'{prefix}sqlite!{suffix}'
+
+    # グループ
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(
+            self._execute,
+            'INSERT OR REPLACE INTO channel_groups (group_name, channel, expires) VALUES (?, ?, ?)',
+            (group, channel, time.time() + self.group_expiry),
+        )
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(
+            self._execute,
+            'DELETE FROM channel_groups WHERE group_name = ? AND channel = ?',
+            (group, channel),
+        )
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self._run(self._group_send, group, json.dumps(message))
+
+    def _group_send(self, group, body):
+        channels = [
+            row[0] for row in self._connection().execute(
+                'SELECT channel FROM channel_groups WHERE group_name = ? AND expires >= ?',
+                (group, time.time()),
+            )
+        ]
+        if channels:
+            # グループ送信では満杯のチャネルは読み飛ばす（InMemoryChannelLayerと同じ挙動）
+            self._send_many(channels, body, ignore_full=True)
+
+    def _execute(self, sql, params=()):
+        self._connection().execute(sql, params)
+
+    # テスト・後片付け用
+
+    async def flush(self):
+        await self._run(self._execute, 'DELETE FROM channel_messages')
+        await self._run(self._execute, 'DELETE FROM channel_groups')
+
+    async def close(self):
+        pass
@@ -0,0 +1,72 @@
+import base64
+import json
+import uuid
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    """カーソルの形式が正しくない場合の例外"""
+
+
+def encode_cursor(*values):
+    """キーセットページネーション用の値を不透明なカーソル文字列に変換"""
+    payload = []
+    for value in values:
+        if isinstance(value, datetime):
+            payload.append(value.isoformat())
+        else:
+            payload.append(str(value))
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """カーソル文字列を値のリストに戻す（datetimeの復元は呼び出し側で行う）"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(str(e))
+
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor('cursor size mismatch')
+    return values
+
+
+def paginate(queryset, limit, cursor_values):
+    """
+    limit+1件取得して次のページがあるか判定し、(items, has_next, next_cursor)を返す
+
+    cursor_valuesはページ最後の要素から次のカーソルに入れる値のタプルを返す関数。
+    """
+    items = list(queryset[:limit + 1])
+    has_next = len(items) > limit
+    items = items[:limit]
+
+    next_cursor = None
+    if has_next and items:
+        next_cursor = encode_cursor(*cursor_values(items[-1]))
+    return items, has_next, next_cursor
+
+
+def paginate_by_created_at(queryset, cursor=None, limit=20):
+    """(created_at, id)のキーセットで新しい順に取得（深いページでもOFFSETを使わない、idはUUID）"""
+    queryset = queryset.order_by('-created_at', '-id')
+
+    if cursor:
+        created_at, pk = decode_cursor(cursor, 2)
+        if not isinstance(created_at, str) or not isinstance(pk, str):
+            raise InvalidCursor('cursor values must be strings')
+        try:
+            created_at = parse_datetime(created_at)
+            pk = uuid.UUID(pk)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise InvalidCursor(str(e))
+        if created_at is None:
+            raise InvalidCursor('invalid created_at')
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    return paginate(queryset, limit, lambda obj: (obj.created_at, obj.id))
@@ -0,0 +1,73 @@
+import random
+
+from django.core.cache import cache
+
+# サンプルプールのデフォルト設定
+DEFAULT_POOL_SIZE = 500
+DEFAULT_POOL_TIMEOUT = 60
+# 期間で絞る場合、範囲内がプールのこの倍数以下なら範囲のインデックスから全件読んで選ぶ
+WINDOW_SCAN_FACTOR = 4
+
+
+def generate_random_key():
+    """ランダムサンプリング用のキー（random_keyフィールドのデフォルト値）"""
+    return random.random()
+
+
+def build_sample_pool(queryset, pool_size=DEFAULT_POOL_SIZE):
+    """random_keyのインデックスを使ってランダムな位置からIDを取得（ORDER BY ?を使わない）"""
+    pivot = random.random()
+    ids = list(
+        queryset.filter(random_key__gte=pivot)
+        .order_by('random_key')
+        .values_list('id', flat=True)[:pool_size]
+    )
+    # 末尾に届いた場合は先頭から補う
+    if len(ids) < pool_size:
+        ids += list(
+            queryset.filter(random_key__lt=pivot)
+            .order_by('random_key')
+            .values_list('id', flat=True)[:pool_size - len(ids)]
+        )
+    return ids
+
+
+def build_window_sample_pool(queryset, field, since, pool_size=DEFAULT_POOL_SIZE):
+    """
+    field >= sinceの範囲からプールを作る
+
+    範囲内の件数が少ない（テーブル全体に対する割合が小さい）と、random_keyのインデックスを
+    たどってもなかなか範囲内の行に当たらずO(n)になる。まず範囲のインデックスから
+    pool_size * WINDOW_SCAN_FACTOR件まで読み、全件読めた場合はそこから一様に選ぶ。
+    それより多い場合は範囲内の割合が大きいので、random_keyのインデックスをたどる。
+    """
+    queryset = queryset.filter(**{f'{field}__gte': since})
+    limit = pool_size * WINDOW_SCAN_FACTOR
+    ids = list(queryset.order_by(f'-{field}').values_list('id', flat=True)[:limit + 1])
+    if len(ids) <= limit:
+        return random.sample(ids, min(pool_size, len(ids)))
+    return build_sample_pool(queryset, pool_size)
+
+
+def get_random_sample(queryset, count, cache_key, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT, window=None):
+    """
+    キャッシュされたサンプルプールからcount件をランダムに取得
+
+    windowに(field, since)を渡すと、build_window_sample_poolで範囲内からプールを作る。
+    """
+    pool = cache.get(cache_key)
+    if pool is None:
+        if window is None:
+            pool = build_sample_pool(queryset, pool_size)
+        else:
+            pool = build_window_sample_pool(queryset, *window, pool_size=pool_size)
+        cache.set(cache_key, pool, timeout)
+
+    picked = random.sample(pool, min(count, len(pool)))
+    if not picked:
+        return []
+
+    # プール作成後に削除されたものはここで除外される
+    objects = list(queryset.filter(id__in=picked))
+    random.shuffle(objects)
+    return objects
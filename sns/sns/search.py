@@ -0,0 +1,313 @@
+import re
+import unicodedata
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from sns.pagination import encode_cursor, decode_cursor, InvalidCursor
+
+# 漢字・ひらがな・カタカナ（々〆ーを含み、中黒は含まない）の連続はn-gramに分割する
+_CJK = '\u3005\u3006\u3040-\u30fa\u30fc-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_TOKEN_RE = re.compile(f'(?P<cjk>[{_CJK}]+)|(?P<word>(?:(?![{_CJK}])[^\\W_])+)')
+
+
+class InvalidSearchQuery(ValueError):
+    """検索語から索引を引ける語が取り出せない場合の例外"""
+
+
+# 索引に入れる1件分（doc_idはUUID、scopeは絞り込み用のID（サークルなど、無ければ''））
+SearchDocument = namedtuple('SearchDocument', ['doc_id', 'scope', 'title', 'body'])
+
+
+def _normalize(text):
+    # 全角英数字・半角カナを揃えて大文字小文字を区別しない
+    return unicodedata.normalize('NFKC', text or '').casefold()
+
+
+def tokenize(text):
+    """
+    索引に入れる語のリストに分割
+
+    英数字は単語ごと、漢字・かなの連続はbi-gram（"東京タワー" -> 東京 京タ タワ ワー ー）にする。
+    連続の最後の1文字も入れておくと、1文字の検索語を前方一致で引ける。
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(_normalize(text)):
+        if match.group('word'):
+            tokens.append(match.group('word'))
+            continue
+        run = match.group('cjk')
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return tokens
+
+
+def parse_query(query):
+    """
+    検索語を(語のリスト, 前方一致か)のフレーズに分割
+
+    漢字・かなの連続は索引と同じbi-gramを隣り合うフレーズとして引くので、部分一致と同じ結果になる。
+    1文字の場合と英数字の単語は前方一致にする。
+    """
+    phrases = []
+    for match in _TOKEN_RE.finditer(_normalize(query)):
+        if match.group('word'):
+            phrases.append(([match.group('word')], True))
+            continue
+        run = match.group('cjk')
+        if len(run) == 1:
+            phrases.append(([run], True))
+        else:
+            phrases.append(([run[i:i + 2] for i in range(len(run) - 1)], False))
+    if not phrases:
+        raise InvalidSearchQuery('no searchable terms')
+    return phrases
+
+
+def _hex(value):
+    return uuid.UUID(str(value)).hex
+
+
+class SQLiteSearchBackend:
+    """
+    SQLiteのFTS5を使った全文検索の索引（ローカル・SQLite運用時用）
+
+    - 本文はtokenize()で分割済みの語を空白区切りで入れる（FTS5側はunicode61で空白を区切りに使うだけ）
+    - 索引はDBと同じ接続で更新するので、保存と同じトランザクションでコミット・ロールバックされる
+    - doc_idとscope（"doc_type サークルのID"）も索引に入れ、更新・削除や絞り込みもMATCHで引く
+    """
+
+    def ensure_schema(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(doc_id, scope, title, body)'
+            )
+
+    def index(self, doc_type, documents, replace=True):
+        """documentsを索引に入れる（新規作成したものだけの場合はreplace=Falseで古い行の削除を省く）"""
+        documents = {_hex(document.doc_id): document for document in documents}
+        if not documents:
+            return
+        with connection.cursor() as cursor:
+            if replace:
+                self._delete(cursor, doc_type, documents)
+            cursor.executemany(
+                'INSERT INTO search_index (doc_id, scope, title, body) VALUES (%s, %s, %s, %s)',
+                [
+                    (
+                        doc_id,
+                        f'{doc_type} {_hex(document.scope)}' if document.scope else doc_type,
+                        ' '.join(tokenize(document.title)),
+                        ' '.join(tokenize(document.body)),
+                    )
+                    for doc_id, document in documents.items()
+                ],
+            )
+
+    def remove(self, doc_type, doc_ids):
+        doc_ids = {_hex(doc_id) for doc_id in doc_ids}
+        if doc_ids:
+            with connection.cursor() as cursor:
+                self._delete(cursor, doc_type, doc_ids)
+
+    def clear(self, doc_type):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM search_index WHERE rowid IN '
+                '(SELECT rowid FROM search_index WHERE search_index MATCH %s)',
+                [f'scope : "{doc_type}"'],
+            )
+
+    def search(self, doc_type, query, scope=None, fields=('title', 'body'), after=None, limit=20):
+        """
+        関連度の高い順に(doc_id, score, key)を返す（scoreは小さいほど関連度が高い）
+
+        afterに前のページの最後の(score, key)を渡すと、その続きを返す。
+        keyは同じscoreの並び順を決める値（ここではFTS5のrowid）。
+        """
+        # サークルのIDはUUIDなので、絞り込む時はdoc_typeを付けずにIDだけで引く
+        scope_phrase = _hex(scope) if scope else doc_type
+        terms = ' AND '.join(
+            '"' + ' '.join(tokens) + '"' + ('*' if prefix else '') for tokens, prefix in parse_query(query)
+        )
+        match = f'scope : "{scope_phrase}" AND {{{" ".join(fields)}}} : ({terms})'
+
+        params = [match]
+        keyset = ''
+        if after is not None:
+            try:
+                score, rowid = float(after[0]), int(after[1])
+            except (ValueError, TypeError) as e:
+                raise InvalidCursor(str(e))
+            keyset = 'WHERE score > %s OR (score = %s AND rowid > %s)'
+            params += [score, score, rowid]
+        with connection.cursor() as cursor:
+            # doc_id・scopeの一致は関連度に含めず、タイトルを本文の2倍に重み付けする。
+            # 並べ替えはrowidとscoreだけで行い、doc_idは1ページ分の行からだけ読む
+            cursor.execute(
+                'SELECT search_index.doc_id, page.score, page.rowid FROM ('
+                'SELECT rowid, score FROM ('
+                'SELECT rowid, bm25(search_index, 0.0, 0.0, 2.0, 1.0) AS score '
+                'FROM search_index WHERE search_index MATCH %s'
+                f') {keyset} ORDER BY score, rowid LIMIT %s'
+                ') page JOIN search_index ON search_index.rowid = page.rowid '
+                'ORDER BY page.score, page.rowid',
+                params + [limit],
+            )
+            return cursor.fetchall()
+
+    def _delete(self, cursor, doc_type, doc_ids):
+        doc_ids = ' OR '.join(f'"{doc_id}"' for doc_id in doc_ids)
+        cursor.execute(
+            'DELETE FROM search_index WHERE rowid IN '
+            '(SELECT rowid FROM search_index WHERE search_index MATCH %s)',
+            [f'scope : "{doc_type}" AND doc_id : ({doc_ids})'],
+        )
+
+
+class PostgresSearchBackend:
+    """
+    PostgreSQLのtsvectorを使った全文検索の索引
+
+    - tokenize()で分割済みの語をsimple設定でtsvectorにする（日本語もSQLiteと同じbi-gramで引ける。
+      DBのLC_CTYPEがUTF-8のロケールである必要がある）
+    - タイトルは重みA、本文は重みBで1つのtsvectorにまとめ、GINインデックスで引く
+    """
+
+    def ensure_schema(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS search_document ('
+                'doc_type varchar(50) NOT NULL, doc_id varchar(32) NOT NULL, '
+                "scope varchar(32) NOT NULL DEFAULT '', vector tsvector NOT NULL, "
+                'PRIMARY KEY (doc_type, doc_id))'
+            )
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS search_document_vector_idx ON search_document USING GIN (vector)'
+            )
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS search_document_scope_idx ON search_document (doc_type, scope)'
+            )
+
+    def index(self, doc_type, documents, replace=True):
+        # ON CONFLICTで更新するのでreplaceに関係なく1回のINSERTで済む
+        documents = {_hex(document.doc_id): document for document in documents}
+        if not documents:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO search_document (doc_type, doc_id, scope, vector) VALUES ('
+                "%s, %s, %s, setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')) "
+                'ON CONFLICT (doc_type, doc_id) DO UPDATE SET scope = EXCLUDED.scope, vector = EXCLUDED.vector',
+                [
+                    (
+                        doc_type,
+                        doc_id,
+                        _hex(document.scope) if document.scope else '',
+                        ' '.join(tokenize(document.title)),
+                        ' '.join(tokenize(document.body)),
+                    )
+                    for doc_id, document in documents.items()
+                ],
+            )
+
+    def remove(self, doc_type, doc_ids):
+        doc_ids = [_hex(doc_id) for doc_id in doc_ids]
+        if doc_ids:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'DELETE FROM search_document WHERE doc_type = %s AND doc_id = ANY(%s)', [doc_type, doc_ids]
+                )
+
+    def clear(self, doc_type):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM search_document WHERE doc_type = %s', [doc_type])
+
+    def search(self, doc_type, query, scope=None, fields=('title', 'body'), after=None, limit=20):
+        """関連度の高い順に(doc_id, score, key)を返す（SQLiteSearchBackend.searchと同じ、keyはdoc_id）"""
+        weights = ''.join({'title': 'A', 'body': 'B'}[field] for field in fields)
+        tsquery = ' & '.join(
+            '(' + ' <-> '.join(f"'{token}':{'*' if prefix else ''}{weights}" for token in tokens) + ')'
+            for tokens, prefix in parse_query(query)
+        )
+
+        params = [tsquery, doc_type]
+        scope_filter = ''
+        if scope:
+            scope_filter = 'AND scope = %s '
+            params.append(_hex(scope))
+        keyset = ''
+        if after is not None:
+            try:
+                score, doc_id = float(after[0]), _hex(after[1])
+            except (ValueError, TypeError) as e:
+                raise InvalidCursor(str(e))
+            keyset = 'WHERE score > %s OR (score = %s AND doc_id > %s)'
+            params += [score, score, doc_id]
+        with connection.cursor() as cursor:
+            # ts_rank_cdは大きいほど関連度が高いので、SQLiteのbm25に合わせて符号を反転する
+            cursor.execute(
+                'SELECT doc_id, score, doc_id FROM ('
+                'SELECT doc_id, -ts_rank_cd(vector, query)::float8 AS score '
+                "FROM search_document, to_tsquery('simple', %s) query "
+                f'WHERE doc_type = %s {scope_filter}AND vector @@ query'
+                f') matches {keyset} ORDER BY score, doc_id LIMIT %s',
+                params + [limit],
+            )
+            return cursor.fetchall()
+
+
+_search_backend = None
+
+
+def get_search_backend():
+    """settings.SEARCH_BACKENDで指定された索引（未指定ならDBの種類に合わせる）"""
+    global _search_backend
+    if _search_backend is None:
+        config = getattr(settings, 'SEARCH_BACKEND', None)
+        if config is None:
+            backend = 'sns.search.PostgresSearchBackend' if connection.vendor == 'postgresql' else 'sns.search.SQLiteSearchBackend'
+            config = {'BACKEND': backend}
+        _search_backend = import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+    return _search_backend
+
+
+def ensure_search_schema(**kwargs):
+    """migrateの後に索引のテーブルを作成（post_migrateに接続する）"""
+    get_search_backend().ensure_schema()
+
+
+def get_search_page(queryset, doc_type, query, scope=None, fields=('title', 'body'), cursor=None, limit=20):
+    """
+    索引から関連度順に1ページ分を取得し、querysetのオブジェクトで返す
+
+    (score, key)のキーセットでページネーションする。索引に残っていても
+    querysetに含まれない（削除済みなど）オブジェクトは除く。
+    """
+    after = decode_cursor(cursor, 2) if cursor else None
+
+    # limit+1件取得して次のページがあるか判定
+    rows = get_search_backend().search(doc_type, query, scope=scope, fields=fields, after=after, limit=limit + 1)
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    objects = queryset.in_bulk([uuid.UUID(doc_id) for doc_id, _, _ in rows])
+    results = []
+    for doc_id, score, _ in rows:
+        obj = objects.get(uuid.UUID(doc_id))
+        if obj is not None:
+            obj.search_score = score
+            results.append(obj)
+
+    next_cursor = None
+    if has_next and rows:
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][2])
+
+    return {
+        'results': results,
+        'has_next': has_next,
+        'next_cursor': next_cursor,
+    }
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
 
@@ -152,6 +153,15 @@ DATABASES = {
     }
 }
 
+# 投稿・サークルのメッセージの全文検索の索引（DBの中に置き、保存と同じトランザクションで更新する）
+SEARCH_BACKEND = {
+    'BACKEND': (
+        'sns.search.PostgresSearchBackend'
+        if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql'
+        else 'sns.search.SQLiteSearchBackend'
+    ),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -202,8 +212,114 @@ MEDIA_ROOT = BASE_DIR / 'media'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Channels configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+# CHANNEL_LAYER_BACKENDで切り替える
+#   memory      : プロセス内のみ（デフォルト、Daphneワーカー1つの開発用）
+#   redis       : channels_redis（本番・複数ワーカー用、REDIS_URLで接続先を指定）
+#   redis_pubsub: channels_redisのPub/Sub版
+#   sqlite      : SQLiteファイルを共有するローカル用（Redisなしで複数ワーカーを試す時）
+CHANNEL_LAYER_BACKEND = os.environ.get('CHANNEL_LAYER_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
+
+if CHANNEL_LAYER_BACKEND == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+                'capacity': int(os.environ.get('CHANNEL_LAYER_CAPACITY', 1000)),
+                'expiry': int(os.environ.get('CHANNEL_LAYER_EXPIRY', 60)),
+            },
+        }
+    }
+elif CHANNEL_LAYER_BACKEND == 'redis_pubsub':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        }
+    }
+elif CHANNEL_LAYER_BACKEND == 'sqlite':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'sns.channel_layers.SQLiteChannelLayer',
+            'CONFIG': {
+                'path': os.environ.get('CHANNEL_LAYER_SQLITE_PATH', str(BASE_DIR / 'channel_layer.sqlite3')),
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
+    }
+
+# サークルチャットのオンライン状況の保存先（複数ワーカーで共有できるようチャネルレイヤーと同じ所に置く）
+if CHANNEL_LAYER_BACKEND in ('redis', 'redis_pubsub'):
+    CIRCLE_PRESENCE = {
+        'BACKEND': 'circle.presence.RedisPresenceStore',
+        'CONFIG': {
+            'url': REDIS_URL,
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == 'sqlite':
+    CIRCLE_PRESENCE = {
+        'BACKEND': 'circle.presence.SQLitePresenceStore',
+        'CONFIG': {
+            'path': CHANNEL_LAYERS['default']['CONFIG']['path'],
+        },
+    }
+else:
+    CIRCLE_PRESENCE = {
+        'BACKEND': 'circle.presence.MemoryPresenceStore',
+    }
+
+# キャッシュ（ワーカー間で共有したい値があるのでチャネルレイヤーと同じ所に置く）
+#   CIRCLE_MEMBERSHIP_CACHE_TIMEOUT: サークルのメンバー判定をキャッシュする秒数（0ならキャッシュしない）
+#   CIRCLE_STATS_CACHE_TIMEOUT: カテゴリー・タグ別のサークル数をキャッシュする秒数（0ならキャッシュしない）
+#   CHAT_UNREAD_COUNT_CACHE_TIMEOUT: DMの未読数をキャッシュする秒数（0ならキャッシュしない）
+#   LocMemは無効化が他のワーカーに届かないので、どれも共有キャッシュの時だけキャッシュする
+if CHANNEL_LAYER_BACKEND in ('redis', 'redis_pubsub'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('CACHE_REDIS_URL', REDIS_URL),
+            'KEY_PREFIX': 'sns',
+        }
+    }
+    CIRCLE_MEMBERSHIP_CACHE_TIMEOUT = 600
+    CIRCLE_STATS_CACHE_TIMEOUT = 600
+    CHAT_UNREAD_COUNT_CACHE_TIMEOUT = 300
+elif CHANNEL_LAYER_BACKEND == 'sqlite':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_DIR', str(BASE_DIR / 'cache')),
+        }
+    }
+    CIRCLE_MEMBERSHIP_CACHE_TIMEOUT = 600
+    CIRCLE_STATS_CACHE_TIMEOUT = 600
+    CHAT_UNREAD_COUNT_CACHE_TIMEOUT = 300
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
     }
+    CIRCLE_MEMBERSHIP_CACHE_TIMEOUT = 0
+    CIRCLE_STATS_CACHE_TIMEOUT = 0
+    CHAT_UNREAD_COUNT_CACHE_TIMEOUT = 0
+
+# サークルチャットのメッセージをまとめて保存する（write-behind、デフォルトは無効）
+#   有効にするとメッセージはジャーナルに追記した時点で配信・ackされ、
+#   DBにはINTERVAL_MSごとにbulk_createでまとめて保存される（詳細はcircle/write_behind.py）
+CIRCLE_CHAT_WRITE_BEHIND = {
+    'ENABLED': os.environ.get('CIRCLE_CHAT_WRITE_BEHIND', '0') == '1',
+    'INTERVAL_MS': int(os.environ.get('CIRCLE_CHAT_WRITE_BEHIND_INTERVAL_MS', 50)),
+    'MAX_BATCH_SIZE': int(os.environ.get('CIRCLE_CHAT_WRITE_BEHIND_MAX_BATCH_SIZE', 500)),
+    'JOURNAL_DIR': os.environ.get('CIRCLE_CHAT_JOURNAL_DIR', str(BASE_DIR / 'chat_journal')),
+    # 電源断でもackしたメッセージを失わないようにする場合は有効にする（追記ごとにfsync）
+    'FSYNC': os.environ.get('CIRCLE_CHAT_JOURNAL_FSYNC', '0') == '1',
 }
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import sys
+import tempfile
+from pathlib import Path
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+from django.utils.module_loading import import_string
+from ninja_jwt.tokens import AccessToken
+
+from users.models import User
+
+
+class BroadcastMetricsTests(TestCase):
+    """WebSocket送信キューの状態を返すAPI"""
+
+    def get_metrics(self, user):
+        return self.client.get(
+            '/api/system/broadcast/metrics', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}'
+        )
+
+    def test_only_staff_can_read_metrics(self):
+        user = User.objects.create_user('user', 'password')
+        self.assertEqual(self.get_metrics(user).status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        response = self.get_metrics(user)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('queue_depth', response.json())
+
+
+# 別プロセスからgroup_sendするスクリプト（引数: バックエンド、CONFIGのJSON、グループ名）
+GROUP_SEND_SCRIPT = """
+import asyncio, json, sys
+from django.utils.module_loading import import_string
+layer = import_string(sys.argv[1])(**json.loads(sys.argv[2]))
+asyncio.run(layer.group_send(sys.argv[3], {'type': 'direct_message', 'message': 'from another process'}))
+"""
+
+
+def redis_available():
+    try:
+        import channels_redis  # noqa: F401
+        import redis
+        return redis.Redis.from_url(settings.REDIS_URL, socket_connect_timeout=1).ping()
+    except Exception:
+        return False
+
+
+class ChannelLayerMultiProcessTests(SimpleTestCase):
+    """別プロセス（別のDaphneワーカー相当）からのgroup_sendが受信側に届くことを確認"""
+
+    def assert_delivered_across_processes(self, backend, config):
+        layer = import_string(backend)(**config)
+        group = 'channel_layer_multiprocess_test'
+
+        async def scenario():
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            # 受信を待っている間に別プロセスから送る
+            receiving = asyncio.ensure_future(layer.receive(channel))
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-c', GROUP_SEND_SCRIPT, backend, json.dumps(config), group,
+                cwd=str(settings.BASE_DIR),
+            )
+            self.assertEqual(await process.wait(), 0)
+            try:
+                return await asyncio.wait_for(receiving, timeout=5)
+            finally:
+                await layer.group_discard(group, channel)
+
+        message = async_to_sync(scenario)()
+        self.assertEqual(message, {'type': 'direct_message', 'message': 'from another process'})
+
+    def test_sqlite_channel_layer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assert_delivered_across_processes(
+                'sns.channel_layers.SQLiteChannelLayer',
+                {'path': str(Path(directory) / 'channel_layer.sqlite3')},
+            )
+
+    def test_sqlite_channel_layer_empty_poll_does_not_lock(self):
+        from sns.channel_layers import SQLiteChannelLayer
+
+        with tempfile.TemporaryDirectory() as directory:
+            layer = SQLiteChannelLayer(path=str(Path(directory) / 'channel_layer.sqlite3'))
+            statements = []
+            layer._connection().set_trace_callback(statements.append)
+            self.assertIsNone(layer._pop('specific.empty'))
+            self.assertNotIn('BEGIN IMMEDIATE', statements)
+
+    @skipUnless(redis_available(), 'Redis is not available')
+    def test_redis_channel_layer(self):
+        self.assert_delivered_across_processes(
+            'channels_redis.core.RedisChannelLayer',
+            {'hosts': [settings.REDIS_URL]},
+        )
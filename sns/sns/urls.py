@@ -29,6 +29,7 @@ from calendar_module.views import router as calendar_router
 from chat.views import router as chat_router
 from circle.views import router as circle_router
 from emojis.views import router as emojis_router
+from sns.views import router as system_router
 api = NinjaExtraAPI(title='SNS API', version='1.0.0', docs=Redoc())
 api.add_router('posts', posts_router)
 api.add_router('users', users_router)
@@ -38,6 +39,7 @@ api.add_router('calendar', calendar_router)
 api.add_router('chat', chat_router)
 api.add_router('circle', circle_router)
 api.add_router('emojis', emojis_router)
+api.add_router('system', system_router)
 api.register_controllers(NinjaJWTDefaultController)
 
 urlpatterns = [
@@ -0,0 +1,16 @@
+from ninja import Router
+from ninja.errors import HttpError
+from ninja_jwt.authentication import JWTAuth
+
+from sns.broadcast import broadcast_queue
+
+# アプリをまたいで使う仕組み（WebSocket送信キューなど）の管理用API
+router = Router(tags=['system'])
+
+
+@router.get("/broadcast/metrics", auth=JWTAuth())
+def get_broadcast_metrics(request):
+    """WebSocket送信キュー（チャット・DM・投票で共用）の状態（キューの長さ・送信までのレイテンシ）を取得（スタッフのみ）"""
+    if not request.user.is_staff:
+        raise HttpError(403, "権限がありません")
+    return broadcast_queue.get_metrics()
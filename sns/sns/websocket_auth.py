@@ -0,0 +1,86 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from ninja_jwt.authentication import JWTBaseAuthentication
+from ninja_jwt.exceptions import AuthenticationFailed, InvalidToken
+from ninja_jwt.settings import api_settings
+
+# new WebSocket(url, ['jwt', token]) の形でトークンを渡す
+JWT_SUBPROTOCOL = 'jwt'
+# 再接続が集中してもusersテーブルを引かないようにユーザーを短時間キャッシュする
+USER_CACHE_TIMEOUT = 60
+
+
+def get_user_cache_key(user_id):
+    return f'websocket_auth:user:{user_id}'
+
+
+def get_token_from_scope(scope):
+    """サブプロトコルまたはクエリ文字列（?token=）からアクセストークンを取り出す"""
+    subprotocols = scope.get('subprotocols') or []
+    if JWT_SUBPROTOCOL in subprotocols:
+        index = subprotocols.index(JWT_SUBPROTOCOL)
+        if index + 1 < len(subprotocols):
+            return subprotocols[index + 1], JWT_SUBPROTOCOL
+
+    tokens = parse_qs(scope.get('query_string', b'').decode()).get('token')
+    if tokens:
+        return tokens[0], None
+    return None, None
+
+
+class WebSocketJWTAuthentication(JWTBaseAuthentication):
+    """REST APIのJWTAuthと同じ検証で、ユーザーだけキャッシュから取得する"""
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        key = get_user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(validated_token)
+            cache.set(key, user, USER_CACHE_TIMEOUT)
+        elif not user.is_active:
+            raise AuthenticationFailed('User is inactive')
+        return user
+
+    def authenticate(self, raw_token):
+        try:
+            # 署名と有効期限の検証だけなのでDBにはアクセスしない
+            validated_token = self.get_validated_token(raw_token)
+            return self.get_user(validated_token)
+        except (InvalidToken, AuthenticationFailed):
+            return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """ninja_jwtのアクセストークンでWebSocket接続のscope['user']を設定するミドルウェア"""
+
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.authentication = WebSocketJWTAuthentication()
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        raw_token, subprotocol = get_token_from_scope(scope)
+        if raw_token:
+            scope['user'] = await database_sync_to_async(self.authentication.authenticate)(raw_token)
+        else:
+            scope['user'] = AnonymousUser()
+
+        if subprotocol:
+            # サブプロトコルを返さないとブラウザが接続を切るので、acceptに付け足す
+            original_send = send
+
+            async def send(message):
+                if message['type'] == 'websocket.accept' and not message.get('subprotocol'):
+                    message = {**message, 'subprotocol': subprotocol}
+                await original_send(message)
+
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    return JWTAuthMiddleware(inner)
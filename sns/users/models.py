@@ -2,6 +2,7 @@ from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 import uuid
 from .utils import Prefectures
+from sns.sampling import generate_random_key, get_random_sample
 
 class UserManager(BaseUserManager):
     def create_user(self, username, password=None, **extra_fields):
@@ -26,7 +27,8 @@ class UserManager(BaseUserManager):
         return self.create_user(username, password, **extra_fields)
     
     def get_users_randomly(self, amount: int):
-        return self.order_by('?')[:amount]
+        users = self.get_queryset().select_related('profile')
+        return get_random_sample(users, amount, cache_key='users:random')
 
 class User(AbstractBaseUser, PermissionsMixin):
     id = models.UUIDField(primary_key=True, editable=False, unique=True, default=uuid.uuid4)
@@ -34,6 +36,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     username = models.CharField(max_length=255, unique=True)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
+    # ランダム取得用（ORDER BY ?の代わりにインデックスで位置を決める）
+    random_key = models.FloatField(default=generate_random_key, db_index=True, editable=False)
 
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = []
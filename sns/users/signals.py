@@ -1,8 +1,17 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from .models import User, UserProfile
+from sns.websocket_auth import get_user_cache_key
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
-        UserProfile.objects.create(user=instance, display_name=instance.username)
\ No newline at end of file
+        UserProfile.objects.create(user=instance, display_name=instance.username)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_websocket_user_cache(sender, instance, **kwargs):
+    """WebSocket認証用にキャッシュしたユーザーを破棄（無効化・削除がすぐに反映されるように）"""
+    from django.core.cache import cache
+    cache.delete(get_user_cache_key(instance.pk))
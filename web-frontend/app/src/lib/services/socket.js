@@ -1,4 +1,5 @@
 // django channelsの接続設定を記述
+import { apiClient } from './django.js';
 
 class SocketClient {
     constructor() {
@@ -9,6 +10,16 @@ class SocketClient {
         this.baseUrl = 'ws://localhost:8000/ws';
     }
 
+    /**
+     * JWTのアクセストークンをサブプロトコルで渡してWebSocketを作成
+     * @param {string} socketUrl - 接続先URL
+     * @returns {WebSocket} WebSocket接続
+     */
+    createSocket(socketUrl) {
+        const token = apiClient.getAuthToken();
+        return token ? new WebSocket(socketUrl, ['jwt', token]) : new WebSocket(socketUrl);
+    }
+
     /**
      * サークルチャットに接続
      * @param {string} circleId - サークルID
@@ -28,7 +39,7 @@ class SocketClient {
         }
 
         const socketUrl = `${this.baseUrl}/circle/${circleId}/chat/`;
-        const socket = new WebSocket(socketUrl);
+        const socket = this.createSocket(socketUrl);
 
         // デフォルトコールバック
         const defaultCallbacks = {
@@ -40,6 +51,9 @@ class SocketClient {
             onUserLeft: (data) => console.log('User left:', data),
             onUserTyping: (data) => console.log('User typing:', data),
             onUserStopTyping: (data) => console.log('User stopped typing:', data),
+            onPresence: (data) => console.log('Presence:', data),
+            onMembershipRevoked: (data) => console.log('Membership revoked:', data),
+            onMessageAck: (data) => console.log('Message acknowledged:', data),
             ...callbacks
         };
 
@@ -50,33 +64,53 @@ class SocketClient {
             defaultCallbacks.onOpen(event);
         };
 
+        const handleMessage = (data) => {
+            switch (data.type) {
+                case 'batch':
+                    // サーバー側でまとめて送られたイベントを順に処理
+                    data.events.forEach(handleMessage);
+                    break;
+                case 'chat_message':
+                    defaultCallbacks.onMessage(data);
+                    break;
+                case 'presence':
+                    // 参加・退出はサーバー側でまとめて送られる
+                    data.joined.forEach((user) => defaultCallbacks.onUserJoined({ type: 'user_joined', ...user }));
+                    data.left.forEach((user) => defaultCallbacks.onUserLeft({ type: 'user_left', ...user }));
+                    defaultCallbacks.onPresence(data);
+                    break;
+                case 'user_joined':
+                    defaultCallbacks.onUserJoined(data);
+                    break;
+                case 'user_left':
+                    defaultCallbacks.onUserLeft(data);
+                    break;
+                case 'user_typing':
+                    defaultCallbacks.onUserTyping(data);
+                    break;
+                case 'user_stop_typing':
+                    defaultCallbacks.onUserStopTyping(data);
+                    break;
+                case 'message_ack':
+                    // write-behind有効時、サーバーが採番したメッセージIDが返される
+                    defaultCallbacks.onMessageAck(data);
+                    break;
+                case 'membership_revoked':
+                    // 退会・BANされた場合はサーバーから切断される（再接続しない）
+                    defaultCallbacks.onMembershipRevoked(data);
+                    break;
+                case 'error':
+                    console.error('Server error:', data.message);
+                    defaultCallbacks.onError(data);
+                    break;
+                default:
+                    console.log('Unknown message type:', data.type);
+            }
+        };
+
         socket.onmessage = (event) => {
             try {
-                const data = JSON.parse(event.data);
-                
-                switch (data.type) {
-                    case 'chat_message':
-                        defaultCallbacks.onMessage(data);
-                        break;
-                    case 'user_joined':
-                        defaultCallbacks.onUserJoined(data);
-                        break;
-                    case 'user_left':
-                        defaultCallbacks.onUserLeft(data);
-                        break;
-                    case 'user_typing':
-                        defaultCallbacks.onUserTyping(data);
-                        break;
-                    case 'user_stop_typing':
-                        defaultCallbacks.onUserStopTyping(data);
-                        break;
-                    case 'error':
-                        console.error('Server error:', data.message);
-                        defaultCallbacks.onError(data);
-                        break;
-                    default:
-                        console.log('Unknown message type:', data.type);
-                }
+                handleMessage(JSON.parse(event.data));
             } catch (error) {
                 console.error('Error parsing message:', error);
                 defaultCallbacks.onError(error);
@@ -88,8 +122,8 @@ class SocketClient {
             this.connections.delete(connectionKey);
             defaultCallbacks.onClose(event);
             
-            // 異常終了の場合は再接続を試行
-            if (event.code !== 1000) {
+            // 異常終了の場合は再接続を試行（メンバーでなくなった場合は除く）
+            if (event.code !== 1000 && event.code !== 4403) {
                 this.attemptReconnect(connectionKey, circleId, defaultCallbacks);
             }
         };
@@ -123,7 +157,7 @@ class SocketClient {
         }
 
         const socketUrl = `${this.baseUrl}/notifications/`;
-        const socket = new WebSocket(socketUrl);
+        const socket = this.createSocket(socketUrl);
 
         // デフォルトコールバック
         const defaultCallbacks = {
@@ -141,21 +175,27 @@ class SocketClient {
             defaultCallbacks.onOpen(event);
         };
 
+        const handleNotification = (data) => {
+            switch (data.type) {
+                case 'batch':
+                    // サーバー側でまとめて送られた通知を順に処理
+                    data.events.forEach(handleNotification);
+                    break;
+                case 'circle_notification':
+                    defaultCallbacks.onNotification(data);
+                    break;
+                case 'error':
+                    console.error('Notification server error:', data.message);
+                    defaultCallbacks.onError(data);
+                    break;
+                default:
+                    console.log('Unknown notification type:', data.type);
+            }
+        };
+
         socket.onmessage = (event) => {
             try {
-                const data = JSON.parse(event.data);
-                
-                switch (data.type) {
-                    case 'circle_notification':
-                        defaultCallbacks.onNotification(data);
-                        break;
-                    case 'error':
-                        console.error('Notification server error:', data.message);
-                        defaultCallbacks.onError(data);
-                        break;
-                    default:
-                        console.log('Unknown notification type:', data.type);
-                }
+                handleNotification(JSON.parse(event.data));
             } catch (error) {
                 console.error('Error parsing notification:', error);
                 defaultCallbacks.onError(error);
@@ -184,10 +224,195 @@ class SocketClient {
         return socket;
     }
 
+    /**
+     * 投票結果のリアルタイム配信に接続
+     * 接続時にonSnapshot、以降はサーバー側でまとめた増減ごとにonTallyが呼ばれる
+     * （どちらもcountsに現在の投票数が入っているので、表示はcountsで置き換える）
+     * @param {string} pollId - 投票ID
+     * @param {object} callbacks - イベントコールバック
+     * @returns {WebSocket} WebSocket接続
+     */
+    connectToPoll(pollId, callbacks = {}) {
+        const connectionKey = `poll_${pollId}`;
+
+        // 既存の接続があれば返す
+        if (this.connections.has(connectionKey)) {
+            const existingSocket = this.connections.get(connectionKey);
+            if (existingSocket.readyState === WebSocket.OPEN ||
+                existingSocket.readyState === WebSocket.CONNECTING) {
+                return existingSocket;
+            }
+        }
+
+        const socketUrl = `${this.baseUrl}/polls/${pollId}/`;
+        const socket = this.createSocket(socketUrl);
+
+        // デフォルトコールバック
+        const defaultCallbacks = {
+            onOpen: () => console.log(`Connected to poll ${pollId}`),
+            onSnapshot: (data) => console.log('Received poll snapshot:', data),
+            onTally: (data) => console.log('Received poll tally:', data),
+            onClose: () => console.log(`Disconnected from poll ${pollId}`),
+            onError: (error) => console.error('Poll WebSocket error:', error),
+            ...callbacks
+        };
+
+        socket.onopen = (event) => {
+            console.log(`Poll WebSocket connected: ${socketUrl}`);
+            this.reconnectAttempts.set(connectionKey, 0);
+            defaultCallbacks.onOpen(event);
+        };
+
+        const handlePollMessage = (data) => {
+            switch (data.type) {
+                case 'batch':
+                    data.events.forEach(handlePollMessage);
+                    break;
+                case 'poll_snapshot':
+                    defaultCallbacks.onSnapshot(data);
+                    break;
+                case 'poll_tally':
+                    defaultCallbacks.onTally(data);
+                    break;
+                case 'error':
+                    console.error('Poll server error:', data.message);
+                    defaultCallbacks.onError(data);
+                    break;
+                default:
+                    console.log('Unknown poll message type:', data.type);
+            }
+        };
+
+        socket.onmessage = (event) => {
+            try {
+                handlePollMessage(JSON.parse(event.data));
+            } catch (error) {
+                console.error('Error parsing poll message:', error);
+                defaultCallbacks.onError(error);
+            }
+        };
+
+        socket.onclose = (event) => {
+            console.log(`Poll WebSocket closed: ${socketUrl}`, event);
+            this.connections.delete(connectionKey);
+            defaultCallbacks.onClose(event);
+
+            // 異常終了の場合は再接続を試行（接続時にスナップショットが送り直される）
+            if (event.code !== 1000) {
+                this.attemptReconnect(connectionKey, pollId, defaultCallbacks);
+            }
+        };
+
+        socket.onerror = (error) => {
+            console.error(`Poll WebSocket error: ${socketUrl}`, error);
+            defaultCallbacks.onError(error);
+        };
+
+        this.connections.set(connectionKey, socket);
+
+        return socket;
+    }
+
+    /**
+     * ダイレクトメッセージに接続
+     * 自分宛て・自分が送ったメッセージ、相手のタイピング状態、既読通知が届く
+     * @param {object} callbacks - イベントコールバック
+     * @returns {WebSocket} WebSocket接続
+     */
+    connectToDirectMessages(callbacks = {}) {
+        const connectionKey = 'direct_messages';
+
+        // 既存の接続があれば返す
+        if (this.connections.has(connectionKey)) {
+            const existingSocket = this.connections.get(connectionKey);
+            if (existingSocket.readyState === WebSocket.OPEN ||
+                existingSocket.readyState === WebSocket.CONNECTING) {
+                return existingSocket;
+            }
+        }
+
+        const socketUrl = `${this.baseUrl}/chat/`;
+        const socket = this.createSocket(socketUrl);
+
+        // デフォルトコールバック
+        const defaultCallbacks = {
+            onOpen: () => console.log('Connected to direct messages'),
+            onMessage: (data) => console.log('Received direct message:', data),
+            onUserTyping: (data) => console.log('User typing:', data),
+            onUserStopTyping: (data) => console.log('User stopped typing:', data),
+            onReadReceipt: (data) => console.log('Read receipt:', data),
+            onClose: () => console.log('Disconnected from direct messages'),
+            onError: (error) => console.error('Direct message WebSocket error:', error),
+            ...callbacks
+        };
+
+        socket.onopen = (event) => {
+            console.log(`Direct message WebSocket connected: ${socketUrl}`);
+            this.reconnectAttempts.set(connectionKey, 0);
+            defaultCallbacks.onOpen(event);
+        };
+
+        const handleDirectMessage = (data) => {
+            switch (data.type) {
+                case 'batch':
+                    // サーバー側でまとめて送られたイベントを順に処理
+                    data.events.forEach(handleDirectMessage);
+                    break;
+                case 'direct_message':
+                    defaultCallbacks.onMessage(data);
+                    break;
+                case 'user_typing':
+                    defaultCallbacks.onUserTyping(data);
+                    break;
+                case 'user_stop_typing':
+                    defaultCallbacks.onUserStopTyping(data);
+                    break;
+                case 'read_receipt':
+                    defaultCallbacks.onReadReceipt(data);
+                    break;
+                case 'error':
+                    console.error('Direct message server error:', data.message);
+                    defaultCallbacks.onError(data);
+                    break;
+                default:
+                    console.log('Unknown direct message type:', data.type);
+            }
+        };
+
+        socket.onmessage = (event) => {
+            try {
+                handleDirectMessage(JSON.parse(event.data));
+            } catch (error) {
+                console.error('Error parsing direct message:', error);
+                defaultCallbacks.onError(error);
+            }
+        };
+
+        socket.onclose = (event) => {
+            console.log(`Direct message WebSocket closed: ${socketUrl}`, event);
+            this.connections.delete(connectionKey);
+            defaultCallbacks.onClose(event);
+
+            // 異常終了の場合は再接続を試行
+            if (event.code !== 1000) {
+                this.attemptReconnect(connectionKey, null, defaultCallbacks);
+            }
+        };
+
+        socket.onerror = (error) => {
+            console.error(`Direct message WebSocket error: ${socketUrl}`, error);
+            defaultCallbacks.onError(error);
+        };
+
+        this.connections.set(connectionKey, socket);
+
+        return socket;
+    }
+
     /**
      * 再接続を試行
      * @param {string} connectionKey - 接続キー
-     * @param {string} circleId - サークルID（チャットの場合）
+     * @param {string} circleId - サークルID（チャットの場合）、投票ID（投票の場合）
      * @param {object} callbacks - コールバック
      */
     attemptReconnect(connectionKey, circleId, callbacks) {
@@ -205,6 +430,10 @@ class SocketClient {
                     this.connectToCircleChat(circleId, callbacks);
                 } else if (connectionKey === 'notifications') {
                     this.connectToNotifications(callbacks);
+                } else if (connectionKey.startsWith('poll_')) {
+                    this.connectToPoll(circleId, callbacks);
+                } else if (connectionKey === 'direct_messages') {
+                    this.connectToDirectMessages(callbacks);
                 }
             }, delay);
         } else {
@@ -248,6 +477,58 @@ class SocketClient {
         }
     }
 
+    /**
+     * ダイレクトメッセージを送信
+     * @param {string} receiverId - 相手のユーザーID
+     * @param {string} message - メッセージ内容
+     * @returns {boolean} 送信できたかどうか
+     */
+    sendDirectMessage(receiverId, message) {
+        const socket = this.connections.get('direct_messages');
+
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({
+                type: 'direct_message',
+                receiver_id: receiverId,
+                message: message
+            }));
+            return true;
+        }
+        console.error('Direct message socket not connected');
+        return false;
+    }
+
+    /**
+     * ダイレクトメッセージのタイピング状態を送信
+     * @param {string} receiverId - 相手のユーザーID
+     * @param {boolean} isTyping - タイピング中かどうか
+     */
+    sendDirectTypingStatus(receiverId, isTyping) {
+        const socket = this.connections.get('direct_messages');
+
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({
+                type: isTyping ? 'typing' : 'stop_typing',
+                receiver_id: receiverId
+            }));
+        }
+    }
+
+    /**
+     * 相手から届いたメッセージを既読にする（相手には既読通知が届く）
+     * @param {string} receiverId - 相手のユーザーID
+     */
+    markDirectMessagesRead(receiverId) {
+        const socket = this.connections.get('direct_messages');
+
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({
+                type: 'read',
+                receiver_id: receiverId
+            }));
+        }
+    }
+
     /**
      * 特定の接続を切断
      * @param {string} connectionKey - 接続キー
@@ -276,6 +557,21 @@ class SocketClient {
         this.disconnect('notifications');
     }
 
+    /**
+     * 投票結果の配信から切断
+     * @param {string} pollId - 投票ID
+     */
+    disconnectFromPoll(pollId) {
+        this.disconnect(`poll_${pollId}`);
+    }
+
+    /**
+     * ダイレクトメッセージから切断
+     */
+    disconnectFromDirectMessages() {
+        this.disconnect('direct_messages');
+    }
+
     /**
      * すべての接続を切断
      */